@@ -0,0 +1,90 @@
+#################################################################################
+#
+# Written by: Johnathon Gard, Erin Maloney
+# Purpose: Save the SSA data classes in the background
+#
+# save_all() takes a copy of every data class and hands the copies to a pool
+# of threads that write them with SSA_Data_Class.save(), which already writes
+# to a temporary name and renames it into place. The acquisition can go on
+# with the live objects straight away. The returned SaveHandle can be polled
+# with done() or waited on with wait(), which gives the path, size and time of
+# every file written.
+#
+#################################################################################
+
+import collections
+import concurrent.futures
+import copy
+import os
+import time
+
+# One written file: where it went, how many bytes and how long it took
+SaveResult = collections.namedtuple('SaveResult', ['path', 'nbytes', 'seconds'])
+
+
+def path_size(path):
+    if(os.path.isdir(path)):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def save_one(data, save_all, fmt):
+    start = time.perf_counter()
+    path = data.save(save_all, fmt)
+    return SaveResult(path, path_size(path), time.perf_counter() - start)
+
+
+class SaveHandle:
+
+    def __init__(self, futures):
+        self.futures = futures
+        self.start = time.perf_counter()
+
+    def done(self):
+        return all([f.done() for f in self.futures])
+
+    def wait(self, timeout=None):
+        '''
+        Block until every file is written, raises the first error any of the saves hit.
+        Returns the list of SaveResult, in the order the data classes were given
+        '''
+        concurrent.futures.wait(self.futures, timeout=timeout)
+        if(not self.done()):
+            raise TimeoutError('Saves still running after {} s'.format(timeout))
+        return [f.result() for f in self.futures]
+
+    def report(self):
+        '''
+        Waits for the saves and prints the size and throughput of each file
+        '''
+        results = self.wait()
+        elapsed = time.perf_counter() - self.start
+        for r in results:
+            print("{:<48s} {:9.2f} MB {:8.3f} s {:9.1f} MB/s".format(
+                r.path, r.nbytes / 1e6, r.seconds, r.nbytes / 1e6 / max(r.seconds, 1e-9)))
+        total = sum([r.nbytes for r in results])
+        print("{:<48s} {:9.2f} MB {:8.3f} s {:9.1f} MB/s".format('total', total / 1e6, elapsed, total / 1e6 / max(elapsed, 1e-9)))
+        return results
+
+
+def save_all(data, save_all=True, fmt='pickle', background=True, workers=4):
+    '''
+    Saves every SSA_Data_Class in data. In the background the classes are copied first and written from a
+    pool of workers threads, otherwise they are written one after the other before returning.
+    Returns a SaveHandle
+    '''
+    if(not background):
+        futures = []
+        for d in data:
+            f = concurrent.futures.Future()
+            f.set_result(save_one(d, save_all, fmt))
+            futures.append(f)
+        return SaveHandle(futures)
+
+    # Snapshot before returning, the caller is free to change or reuse the live objects
+    snapshots = [copy.deepcopy(d) for d in data]
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ssa-save')
+    handle = SaveHandle([executor.submit(save_one, d, save_all, fmt) for d in snapshots])
+    # The workers finish what was submitted, and the interpreter waits for them before exiting
+    executor.shutdown(wait=False)
+    return handle
@@ -1,10 +1,12 @@
 # import named_serial
+import contextlib
 import struct
+from squid_ssa_char.modules import serial_queue
 
 
 class BadChanSimple:
 
-    def __init__(self, chan=0, cardaddr=3, serialport=None):
+    def __init__(self, chan=0, cardaddr=3, serialport=None, batching=False, max_batch=0):
 
         self.serialport=serialport
 
@@ -12,6 +14,10 @@ class BadChanSimple:
             import named_serial
             self.serialport = named_serial.Serial(port='rack', shared=True)
 
+        # With batching the registers of send_channel() go out in a single serial write
+        if batching and not isinstance(self.serialport, serial_queue.CommandQueue):
+            self.serialport = serial_queue.CommandQueue(self.serialport, max_batch=max_batch)
+
         self.chan = chan
         self.cardaddr = cardaddr
 
@@ -47,9 +53,16 @@ class BadChanSimple:
         self.send_wreg4()
 
     def send_channel(self):
-        self.send_wreg2()
-        self.send_wreg4()
-        self.send_wreg5()
+        with self.hold():
+            self.send_wreg2()
+            self.send_wreg4()
+            self.send_wreg5()
+
+    def hold(self):
+        # Context manager, registers sent inside the with block share one serial write when batching
+        if isinstance(self.serialport, serial_queue.CommandQueue):
+            return self.serialport.hold()
+        return contextlib.nullcontext()
 
     def send_wreg2(self):
         wreg = 2 << 25
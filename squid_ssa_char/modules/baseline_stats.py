@@ -0,0 +1,107 @@
+#################################################################################
+#
+# Written by: Johnathon Gard, Erin Maloney
+# Purpose: Streaming statistics of the baseline noise
+#
+# The baselines are taken over several DAQ blocks rather than one. Each block
+# is folded into running statistics as it arrives and then dropped, so memory
+# use depends only on the block size and not on how many blocks are taken.
+#
+# RunningMoments keeps the count, mean, sum of squared deviations (Welford,
+# with the Chan et al. update to merge a whole block at once), minimum and
+# maximum of every column. WelchPSD averages the periodogram of Hann windowed,
+# half overlapping segments of every block into a one sided noise spectrum.
+#
+#################################################################################
+
+import numpy as np
+
+
+class RunningMoments:
+    '''
+    Running mean, variance and extrema of each column of (ncol, ...) blocks, taken over every other axis.
+    With keep=2 each (column, row) of (ncol, nrow, ...) blocks gets its own statistics.
+    '''
+
+    def __init__(self, keep=1):
+        self.keep = keep
+        self.n = 0
+        self.mean = None
+        self.m2 = None      # Sum of squared deviations from the mean
+        self.min = None
+        self.max = None
+
+    def update(self, block):
+        block = np.asarray(block, dtype=np.float64)
+        axes = tuple(range(self.keep, block.ndim))
+        nb = int(np.prod(block.shape[self.keep:]))
+        mean_b = block.mean(axis=axes)
+        m2_b = np.square(block - block.mean(axis=axes, keepdims=True)).sum(axis=axes)
+        if(self.n == 0):
+            self.mean, self.m2 = mean_b, m2_b
+            self.min, self.max = block.min(axis=axes), block.max(axis=axes)
+        else:
+            n = self.n + nb
+            delta = mean_b - self.mean
+            self.mean = self.mean + delta * nb / n
+            self.m2 = self.m2 + m2_b + np.square(delta) * self.n * nb / n
+            self.min = np.minimum(self.min, block.min(axis=axes))
+            self.max = np.maximum(self.max, block.max(axis=axes))
+        self.n += nb
+
+    @property
+    def var(self):
+        return self.m2 / self.n
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    @property
+    def range(self):
+        return self.max - self.min
+
+
+class WelchPSD:
+    '''
+    Averaged one sided power spectral density of each column of (ncol, nrow, npts) blocks. Every row is a
+    separate time series, their spectra are averaged together, with keep=2 each row keeps its own. Units
+    are counts**2/Hz with sample_rate in Hz, or counts**2 per cycle/sample when it is not known.
+    '''
+
+    def __init__(self, nperseg, sample_rate=None, keep=1):
+        self.keep = keep
+        self.nperseg = int(nperseg)
+        self.sample_rate = sample_rate
+        self.window = np.hanning(self.nperseg)
+        self.n_segments = 0
+        self.power = None
+
+    def update(self, block):
+        block = np.asarray(block, dtype=np.float64)
+        if(block.shape[-1] < self.nperseg):
+            raise ValueError('Blocks of {} points are shorter than a {} point segment'.format(block.shape[-1], self.nperseg))
+        # Half overlapping segments as views: (ncol, nrow, nseg, nperseg)
+        segments = np.lib.stride_tricks.sliding_window_view(block, self.nperseg, axis=-1)[..., ::self.nperseg // 2, :]
+        segments = segments - segments.mean(axis=-1, keepdims=True)
+        axes = tuple(range(self.keep, segments.ndim - 1))
+        power = np.square(np.abs(np.fft.rfft(segments * self.window, axis=-1))).sum(axis=axes)
+        self.power = power if(self.power is None) else self.power + power
+        self.n_segments += int(np.prod(segments.shape[self.keep:-1]))
+
+    @property
+    def freq(self):
+        return np.fft.rfftfreq(self.nperseg, 1.0 / (self.sample_rate or 1.0))
+
+    @property
+    def psd(self):
+        psd = self.power / (self.n_segments * (self.sample_rate or 1.0) * np.sum(np.square(self.window)))
+        # One sided, everything but DC (and Nyquist for an even nperseg) has the negative frequencies folded in
+        psd[..., 1:(self.nperseg + 1) // 2] *= 2
+        return psd
+
+    def noise_floor(self):
+        '''
+        Median of each column's PSD above DC, which spectral lines barely move
+        '''
+        return np.median(self.psd[..., 1:], axis=-1)
@@ -0,0 +1,272 @@
+#################################################################################
+#
+# Written by: Johnathon Gard, Erin Maloney
+# Purpose: SA bias sweep strategies for phase0_0
+#
+# Each column gets its own sweep object. The phase asks every sweep for the
+# next bias to visit with next_bias(), measures all of the columns at once and
+# hands each sweep its result with record(). A sweep returns None once it is
+# done. next_bias() is called once per point, sweeps with needs_feedback set
+# must have the last point recorded before they are asked for the next one.
+#
+# The adaptive sweeps start with a coarse pass over the whole range and then
+# only spend points near Icmax and Icmin, at the resolution a linear sweep of
+# bias_sweep_npoints would have had:
+#
+#   linear        - bias_sweep_npoints evenly spaced points, the original sweep
+#   coarse_fine   - coarse pass, then every fine step around Icmax and Icmin
+#   binary_search - coarse pass, then a golden section search for the peak of
+#                   the modulation depth (Icmax) and a bisection of the
+#                   threshold crossing (Icmin)
+#
+# With early_stop set, an IcEstimator follows the points taken in increasing
+# bias (the linear sweep, or the coarse pass of the adaptive ones). Once it is
+# confident of both Icmax and Icmin the rest of those points are skipped.
+#
+#################################################################################
+
+import abc
+import math
+import numpy as np
+
+SWEEP_TYPES = ('linear', 'coarse_fine', 'binary_search')
+
+GOLDEN = (math.sqrt(5.0) - 1.0) / 2.0
+
+
+def find_ic_indices(vmod, vphi_std, icmin_threshold):
+    '''
+    Picks Icmax and Icmin out of a sweep sorted by bias. Icmax is the point with the largest modulation depth,
+    Icmin is the last point below Icmax whose V-Phi std is under icmin_threshold.
+    Returns (icmax_idx, icmin_idx), icmin_idx is None when no point below Icmax is under the threshold
+    '''
+    icmax_idx = int(np.argmax(vmod))
+    flat = np.where(np.asarray(vphi_std[:icmax_idx]) < icmin_threshold)[0]
+    icmin_idx = int(flat[-1]) if(len(flat) > 0) else None
+    return icmax_idx, icmin_idx
+
+
+class IcEstimator:
+    '''
+    Incremental Icmax/Icmin estimate for points fed in increasing bias. Icmax is confident once the modulation
+    depth has stayed more than fall_fraction below its peak for fall_points points in a row. Icmin is confident
+    once a point below the peak is under the V-Phi std threshold and a later one below the peak is not.
+    '''
+    def __init__(self, icmin_threshold, fall_fraction=0.1, fall_points=8):
+        self.icmin_threshold = icmin_threshold
+        self.fall_fraction = fall_fraction
+        self.fall_points = fall_points
+        self.biases = []
+        self.vmod = []
+        self.vphi_std = []
+        self.fall_count = 0
+        self.done = False
+        self.stop_bias = None
+        self.stop_reason = ''
+
+    def update(self, bias, vmod, vphi_std):
+        '''
+        Adds one point, returns True once both Ics are confident
+        '''
+        self.biases.append(bias)
+        self.vmod.append(vmod)
+        self.vphi_std.append(vphi_std)
+        if(self.done):
+            return True
+
+        peak = max(self.vmod)
+        if(vmod < (1.0 - self.fall_fraction) * peak):
+            self.fall_count += 1
+        else:
+            self.fall_count = 0
+        if(self.fall_count < self.fall_points):
+            return False
+
+        icmax_idx, icmin_idx = find_ic_indices(self.vmod, self.vphi_std, self.icmin_threshold)
+        # The peak itself has to be modulating, a peak in the noise before Icmin is no peak at all
+        icmin_found = (icmin_idx is not None) and (self.vphi_std[icmax_idx] >= self.icmin_threshold)
+        if(icmin_found):
+            self.done = True
+            self.stop_bias = bias
+            self.stop_reason = 'early stop: Icmax {} and Icmin {} found, modulation {} points more than {:.0%} below its peak'.format(
+                self.biases[icmax_idx], self.biases[icmin_idx], self.fall_points, self.fall_fraction)
+        return self.done
+
+
+class LinearSweep:
+    '''
+    Visits bias_sweep_npoints evenly spaced points, the results do not change the points visited
+    '''
+    needs_feedback = False
+
+    def __init__(self, start, stop, npoints, early_stop=None):
+        self.points = np.linspace(start, stop, npoints, dtype=np.int32)
+        self.max_points = npoints
+        self.early_stop = early_stop
+        self._idx = 0
+
+    @property
+    def stopped(self):
+        # Points handed out before the stop was known are not wanted any more
+        return self.early_stop is not None and self.early_stop.done
+
+    def next_bias(self):
+        # Moves on by itself, so the phase can ask for the next point before the last one is recorded
+        if(self._idx < len(self.points) and not self.stopped):
+            self._idx += 1
+            return self.points[self._idx - 1]
+        return None
+
+    def record(self, bias, vmod, vphi_std):
+        if(self.early_stop is not None):
+            self.early_stop.update(bias, vmod, vphi_std)
+
+
+class AdaptiveSweep(abc.ABC):
+    '''
+    Base of the sweeps that pick their next point from the results so far. Subclasses write _points() as a
+    generator that yields a bias and is sent back the (vmod, vphi_std) measured there.
+    '''
+    needs_feedback = True
+    stopped = False     # Never runs ahead of its results, so there is never a point to throw away
+
+    def __init__(self, start, stop, npoints, coarse_npoints, icmin_threshold, early_stop=None):
+        self.early_stop = early_stop
+        self.start = start
+        self.stop = stop
+        self.coarse_npoints = coarse_npoints
+        self.icmin_threshold = icmin_threshold
+        # Refine down to the step a linear sweep of npoints would have used
+        self.coarse_step = (stop - start) / (coarse_npoints - 1)
+        self.fine_step = max((stop - start) / (npoints - 1), 1)
+        self.results = {}   # bias -> (vmod, vphi_std)
+        self._gen = self._points()
+        self._pending = next(self._gen, None)
+
+    def next_bias(self):
+        return self._pending
+
+    def record(self, bias, vmod, vphi_std):
+        try:
+            self._pending = self._gen.send((vmod, vphi_std))
+        except StopIteration:
+            self._pending = None
+
+    def _measure(self, bias):
+        # Only yields to the phase for points that have not been visited yet
+        bias = np.int32(bias)
+        if(bias not in self.results):
+            self.results[bias] = yield bias
+        return self.results[bias]
+
+    def _coarse_pass(self):
+        for bias in np.linspace(self.start, self.stop, self.coarse_npoints, dtype=np.int32):
+            vmod, vphi_std = yield from self._measure(bias)
+            if(self.early_stop is not None and self.early_stop.update(bias, vmod, vphi_std)):
+                break
+        biases = np.array(sorted(self.results), dtype=np.int32)
+        vmod = np.array([self.results[b][0] for b in biases])
+        vphi_std = np.array([self.results[b][1] for b in biases])
+        icmax_idx, icmin_idx = find_ic_indices(vmod, vphi_std, self.icmin_threshold)
+        return biases, icmax_idx, icmin_idx
+
+    @abc.abstractmethod
+    def _points(self):
+        pass
+
+
+class CoarseFineSweep(AdaptiveSweep):
+    '''
+    Coarse pass over the range, then every fine step in the coarse intervals around Icmax and just above Icmin
+    '''
+    def __init__(self, start, stop, npoints, coarse_npoints, icmin_threshold, early_stop=None):
+        super().__init__(start, stop, npoints, coarse_npoints, icmin_threshold, early_stop)
+        steps_per_coarse = math.ceil(self.coarse_step / self.fine_step)
+        self.max_points = coarse_npoints + 3 * steps_per_coarse + 2
+
+    def _points(self):
+        biases, icmax_idx, icmin_idx = yield from self._coarse_pass()
+        last = len(biases) - 1
+        windows = [(biases[max(icmax_idx - 1, 0)], biases[min(icmax_idx + 1, last)])]
+        if(icmin_idx is not None):
+            windows.append((biases[icmin_idx], biases[icmin_idx + 1]))
+
+        refine = set()
+        for lo, hi in windows:
+            nsteps = math.ceil((hi - lo) / self.fine_step)
+            refine.update(np.linspace(lo, hi, nsteps + 1, dtype=np.int32))
+        # Go up in bias so the ramps between points stay short
+        for bias in sorted(refine):
+            yield from self._measure(bias)
+
+
+class BinarySearchSweep(AdaptiveSweep):
+    '''
+    Coarse pass to bracket Icmax and Icmin, then bisection of the Icmin threshold crossing and a golden section
+    search of the modulation depth peak, each down to the fine step
+    '''
+    def __init__(self, start, stop, npoints, coarse_npoints, icmin_threshold, early_stop=None):
+        super().__init__(start, stop, npoints, coarse_npoints, icmin_threshold, early_stop)
+        ratio = max(self.coarse_step / self.fine_step, 1.0)
+        self.max_points = coarse_npoints + math.ceil(math.log2(ratio)) + math.ceil(math.log(2 * ratio) / -math.log(GOLDEN)) + 4
+
+    def _points(self):
+        biases, icmax_idx, icmin_idx = yield from self._coarse_pass()
+        last = len(biases) - 1
+
+        # Icmin: the V-Phi std crosses the threshold somewhere between the last flat point and the next one
+        if(icmin_idx is not None):
+            lo, hi = int(biases[icmin_idx]), int(biases[icmin_idx + 1])
+            while(hi - lo > self.fine_step):
+                mid = (lo + hi) // 2
+                _, vphi_std = yield from self._measure(mid)
+                if(vphi_std < self.icmin_threshold):
+                    lo = mid
+                else:
+                    hi = mid
+
+        # Icmax: the modulation depth peak is inside the coarse points either side of the coarse maximum
+        a, b = int(biases[max(icmax_idx - 1, 0)]), int(biases[min(icmax_idx + 1, last)])
+        c = int(round(b - GOLDEN * (b - a)))
+        d = int(round(a + GOLDEN * (b - a)))
+        while(b - a > self.fine_step):
+            vmod_c, _ = yield from self._measure(c)
+            vmod_d, _ = yield from self._measure(d)
+            if(vmod_c > vmod_d):
+                b, d = d, c
+                c = int(round(b - GOLDEN * (b - a)))
+            else:
+                a, c = c, d
+                d = int(round(a + GOLDEN * (b - a)))
+
+
+def column_setting(value, col):
+    '''
+    Config values that can be given once for every column or as a list with one entry per column
+    '''
+    return value[col] if(isinstance(value, (list, tuple))) else value
+
+
+def make_sweep(phase_conf, icmin_threshold, col=0):
+    '''
+    Builds the sweep for column index col from the phase0_0 config, icmin_threshold is in the same units as the
+    V-Phi std
+    '''
+    sweep_type = phase_conf.get('bias_sweep_type', 'linear')
+    start = phase_conf['bias_sweep_start']
+    stop = phase_conf['bias_sweep_end']
+    npoints = phase_conf['bias_sweep_npoints']
+    early_stop = None
+    if(column_setting(phase_conf.get('early_stop', False), col)):
+        early_stop = IcEstimator(icmin_threshold,
+                                 column_setting(phase_conf.get('early_stop_fall_fraction', 0.1), col),
+                                 column_setting(phase_conf.get('early_stop_fall_points', 8), col))
+    if(sweep_type == 'linear'):
+        return LinearSweep(start, stop, npoints, early_stop)
+
+    coarse_npoints = phase_conf.get('bias_sweep_coarse_npoints', 32)
+    if(sweep_type == 'coarse_fine'):
+        return CoarseFineSweep(start, stop, npoints, coarse_npoints, icmin_threshold, early_stop)
+    if(sweep_type == 'binary_search'):
+        return BinarySearchSweep(start, stop, npoints, coarse_npoints, icmin_threshold, early_stop)
+    raise ValueError('Unknown bias_sweep_type {}, expected one of {}'.format(sweep_type, ', '.join(SWEEP_TYPES)))
@@ -1,60 +1,224 @@
+import collections
 import numpy as np
-from nasa_client import easyClient
+
+from squid_ssa_char.modules import instrument
+
+# Raw buffers from Daq.acquire_average_roll() and the slice settings they were taken with
+RawAcquisition = collections.namedtuple('RawAcquisition', ['points_per_slice', 'averages', 'buffers'])
+
+
+def average_slices(data, points_per_slice):
+    #
+    # Averages a (ncol, nrow, nslices * points_per_slice, 2) buffer over its slices.
+    # The sample axis is reshaped into (nslices, points_per_slice) and reduced in a
+    # single pass, so both channels come back from one reduction with no per column
+    # loop. Any trailing partial slice is ignored, the same as the original loop.
+    # Returns an array of shape (ncol, nrow, points_per_slice, 2)
+    #
+    ncol, nrow, npts, nchan = data.shape
+    slices = npts // points_per_slice
+    if(slices == 0):
+        raise ValueError("average_slices() needs at least {} points, got {}".format(points_per_slice, npts))
+    # Slicing off the partial slice keeps this a view when the buffer is an exact multiple
+    periods = data[:, :, :slices * points_per_slice, :].reshape(ncol, nrow, slices, points_per_slice, nchan)
+    return periods.mean(axis=2)
+
+
+def align_to_fb_min(data, out=None, index=None, columns=None):
+    #
+    # Rolls every trace of a (..., npts, 2) buffer so that its FB minimum lands on sample 0.
+    # All of the roll offsets come from one argmin along the sample axis and both channels
+    # are then moved with a single gather of (err, fb) sample pairs. out (same shape and type
+    # as data) and index ((..., npts) intp) can be preallocated to avoid allocating per call.
+    # Raises Daq.FeedBackException naming every column/row pair with a constant FB. columns
+    # gives the DAQ column number of each column of data, for a buffer cut down to Daq.columns.
+    # Returns two arrays: fb, err with shape (..., npts), these are views into out
+    #
+    npts = data.shape[-2]
+    lead = data.shape[:-2]
+    fb = data[..., 1]
+
+    # Constant feedback has no minimum to roll to, collect every offender before raising
+    const = fb.max(axis=-1) == fb.min(axis=-1)
+    if(const.any()):
+        # Fold any extra leading axes (periods) so each column/row pair is named once
+        const = const.reshape(const.shape[:2] + (-1,)).any(axis=-1)
+        bad = ', '.join('C={}, R={}'.format(col if(columns is None) else columns[col], row)
+                        for col, row in np.argwhere(const))
+        raise Daq.FeedBackException("FB value is constant, this will cause erratic behavior in take_data_roll(). " + bad)
+
+    # Build flat gather indices: trace start + (offset + sample) % npts
+    offsets = fb.argmin(axis=-1).reshape(-1, 1)
+    if(index is None):
+        index = np.empty(lead + (npts,), dtype=np.intp)
+    flat_index = index.reshape(-1, npts)
+    np.add(offsets, np.arange(npts), out=flat_index)
+    np.subtract(flat_index, npts, out=flat_index, where=(flat_index >= npts))
+    flat_index += (np.arange(flat_index.shape[0]) * npts).reshape(-1, 1)
+
+    # The indices are in range by construction, mode='clip' skips numpy's buffered bounds checking
+    out = np.take(data.reshape(-1, 2), index, axis=0, out=out, mode='clip')
+    return out[..., 1], out[..., 0]
 
 
 class Daq:
 
-    def __init__(self, tri_period=512, averages=10):
-        self.c = easyClient.EasyClient(clockmhz=125)
+    def __init__(self, tri_period=512, averages=10, batch_align=True, single_acquisition=False, client=None, columns=None):
+        # Anything with the easyClient interface can be passed in as client (e.g. the simulator),
+        # otherwise connect to DASTARD. Imported here so the helpers work without nasa_client installed
+        if(client is None):
+            from nasa_client import easyClient
+            client = easyClient.EasyClient(clockmhz=125)
+        self.c = client
         self.c.setupAndChooseChannels()
         self.pointsPerSlice = tri_period
         self.averages = averages
+        # When True take_data_roll() aligns all traces at once into reused buffers
+        self.batch_align = batch_align
+        # When True take_average_data_roll() grabs all of the periods with one getNewData call
+        self.single_acquisition = single_acquisition
+        # DAQ column numbers to keep, None keeps all of them. Everything returned is sized for these columns,
+        # in this order, use column_index() to find a column in the returned arrays
+        self.columns = columns
+        self._align_buffers = {}
+        # Timed spans of every acquisition and processing step go to tracer, see modules/instrument.py
+        self.tracer = instrument.NULL_TRACER
+        self.reset_stats()
 
-    def take_average_data(self):
+    def reset_stats(self):
+        self.n_reads = 0            # getNewData calls
+        self.n_bytes_received = 0   # Bytes getNewData returned
+        self.n_bytes_kept = 0       # Bytes left after cutting them down to the columns and channels needed
+
+    def stats(self):
+        return {'reads': self.n_reads, 'MB received': self.n_bytes_received / 1e6, 'MB kept': self.n_bytes_kept / 1e6}
+
+    @property
+    def columns(self):
+        return self._columns
+
+    @columns.setter
+    def columns(self, columns):
+        self._columns = None if(columns is None) else [int(c) for c in columns]
+        # A run of neighbouring columns is a slice, a view, anything else has to be gathered
+        self._select = None
+        if(self._columns is not None):
+            first = self._columns[0] if(self._columns) else 0
+            if(self._columns == list(range(first, first + len(self._columns)))):
+                self._select = slice(first, first + len(self._columns))
+            else:
+                self._select = np.array(self._columns, dtype=np.intp)
+
+    def column_index(self, column):
         #
-        # Gathers data from easyClient and averages one period of it over as many periods as possible in the data.
-        # Returns two arrays: fb, err
+        # Position of DAQ column number column in the arrays this class returns
         #
-        data = self.c.getNewData(minimumNumPoints=self.pointsPerSlice * self.averages, exactNumPoints=True)
+        if(self._columns is None):
+            return column
+        return self._columns.index(column)
 
-        slices = np.int_(data.shape[2] / self.pointsPerSlice)
-        start = 0
-        end = start + self.pointsPerSlice
+    def column_number(self, index):
+        #
+        # DAQ column number of position index in the arrays this class returns, the inverse of column_index()
+        #
+        if(self._columns is None):
+            return int(index)
+        return self._columns[index]
 
-        i = 0
-        fb = np.zeros((self.c.ncol, self.c.nrow, self.pointsPerSlice))
-        err = np.zeros((self.c.ncol, self.c.nrow, self.pointsPerSlice))
+    @instrument.traced('daq.get_data', 'daq')
+    def get_data(self, npoints, err_only=False):
+        #
+        # Every acquisition goes through here. DASTARD hands over every column and both channels, they
+        # are cut down to the selected columns, and to the error channel with err_only, as soon as they
+        # arrive so nothing after this touches data that is not needed.
+        # Returns an array of shape (ncol, nrow, npoints, 2), or (ncol, nrow, npoints) with err_only
+        #
+        data = self.c.getNewData(minimumNumPoints=npoints, exactNumPoints=True)
+        self.n_reads += 1
+        self.n_bytes_received += data.nbytes
+        if(err_only):
+            data = data[..., 0]
+        if(self._select is not None):
+            data = data[self._select]
+        self.n_bytes_kept += data.nbytes
+        return data
 
-        while i != slices:
-            for col in range(self.c.ncol):
-                fb[col] += data[col, :, start:end, 1]
-                err[col] += data[col, :, start:end, 0]
-            start += self.pointsPerSlice
-            end += self.pointsPerSlice
-            i += 1
+    @instrument.traced('daq.take_average_data', 'daq')
+    def take_average_data(self):
+        #
+        # Gathers data from easyClient and averages one period of it over as many periods as possible in the data.
+        # Returns two arrays: fb, err
+        #
+        data = self.get_data(self.pointsPerSlice * self.averages)
+        avg = average_slices(data, self.pointsPerSlice)
 
-        return fb / slices, err / slices
+        return avg[..., 1], avg[..., 0]
 
+    @instrument.traced('daq.take_data', 'daq')
     def take_data(self):
         #
         #
-        data = self.c.getNewData(minimumNumPoints=self.pointsPerSlice, exactNumPoints=True)
-
-        fb = np.zeros((self.c.ncol, self.c.nrow, self.pointsPerSlice))
-        err = np.zeros((self.c.ncol, self.c.nrow, self.pointsPerSlice))
+        data = self.get_data(self.pointsPerSlice)
 
         fb = data[:, :, :, 1]
         err = data[:, :, :, 0]
 
         return fb, err
 
+    @instrument.traced('daq.take_err_average', 'daq')
+    def take_err_average(self, npoints):
+        #
+        # Cheap read used while waiting for the system to settle, npoints of data averaged
+        # over the rows and samples of the error channel.
+        # Returns one array: err with shape (ncol,)
+        #
+        return self.get_data(npoints, err_only=True).mean(axis=(1, 2))
+
+    @instrument.traced('daq.take_err_block', 'daq')
+    def take_err_block(self):
+        #
+        # One unaveraged block of pointsPerSlice * averages points of the error channel, plus the same block
+        # averaged down to one period. Used to build up the baseline statistics a block at a time.
+        # Returns two arrays: err with shape (ncol, nrow, pointsPerSlice * averages), avg_err (ncol, nrow, pointsPerSlice)
+        #
+        err = self.get_data(self.pointsPerSlice * max(self.averages, 1), err_only=True)
+        return err, average_slices(err[..., np.newaxis], self.pointsPerSlice)[..., 0]
+
+    @instrument.traced('daq.take_data_roll', 'daq')
     def take_data_roll(self, avg_all_rows=False):
         # 
         # The assumption of for this method is that there is a triangle on the FB data channel
         # this method will then roll the error data to the next zero value in the FB.
         # it will put the roll value from the first column and use that for the rest of the
         # columns  
-        data = self.c.getNewData(minimumNumPoints=self.pointsPerSlice, exactNumPoints=True)
+        # With batch_align the returned (ncol, nrow, npts) arrays are reused buffers that
+        # the next call overwrites, copy them if they need to be kept.
+        data = self.get_data(self.pointsPerSlice)
+        return self._roll(data, avg_all_rows)
+
+    @instrument.traced('daq.roll', 'daq')
+    def _roll(self, data, avg_all_rows):
+        if(self.batch_align):
+            fb, err = self._align_batched(data)
+        else:
+            fb, err = self._align_loop(data)
+
+        # If the average all rows has been passed in, return the average over all of the rows
+        if(avg_all_rows):
+            return np.average(fb, axis=1), np.average(err, axis=1)
+        else:
+            return fb, err
+
+    def _align_batched(self, data):
+        # Reuse the gather buffers for as long as the buffer shape and type stay the same
+        key = (data.shape, data.dtype)
+        if(key not in self._align_buffers):
+            self._align_buffers = {key: (np.empty(data.shape, dtype=data.dtype),
+                                         np.empty(data.shape[:-1], dtype=np.intp))}
+        out, index = self._align_buffers[key]
+        return align_to_fb_min(data, out, index, self.columns)
+
+    def _align_loop(self, data):
         fb = np.array(data[:, :, :, 1])
         err = np.array(data[:, :, :, 0])
         #Determine how far to roll for each element in the 2D array of time streams
@@ -62,33 +226,75 @@ class Daq:
             for j in range(fb.shape[1]):
                 # Check if there is a feedback value to roll too. Just print to console about the issue. 
                 if(np.all(fb[i,j,:] == fb[i,j,0])):
-                    raise self.FeedBackException("FB value is constant, this will cause erratic behavior in take_data_roll(). C={}, R={}".format(i, j))
+                    raise self.FeedBackException("FB value is constant, this will cause erratic behavior in take_data_roll(). C={}, R={}".format(self.column_number(i), j))
                 nsamp_roll = -fb[i, j, :].argmin()
                 fb[i, j, :] = np.roll(fb[i, j, :], nsamp_roll)
                 err[i, j, :] = np.roll(err[i, j, :], nsamp_roll)
-
-        # If the average all rows has been passed in, return the average over all of the rows
-        if(avg_all_rows):
-            return np.average(fb, axis=1), np.average(err, axis=1)
-        else:
-            return fb, err
+        return fb, err
         
     #
     #
     #
+    @instrument.traced('daq.take_average_data_roll', 'daq')
     def take_average_data_roll(self, avg_all_rows=False):
+        return self.process_average_roll(self.acquire_average_roll(), avg_all_rows=avg_all_rows)
 
-        if(self.averages <= 1):
-            data = self.take_data_roll(avg_all_rows=avg_all_rows)
-            return data
+    @instrument.traced('daq.acquire_average_roll', 'daq')
+    def acquire_average_roll(self):
+        #
+        # Hardware half of take_average_data_roll(), it only pulls the raw buffers from DASTARD.
+        # The slice settings go along with the buffers so process_average_roll() gives the same
+        # answer when it runs later, on another thread, after pointsPerSlice or averages changed.
+        # Returns a RawAcquisition
+        #
+        if(self.single_acquisition and self.averages > 1):
+            buffers = [self.get_data(self.pointsPerSlice * self.averages)]
         else:
-            avg_cnt = self.averages - 1
-            data = self.take_data_roll(avg_all_rows=avg_all_rows)
-            for i in range(avg_cnt):
-                data = np.add(self.take_data_roll(avg_all_rows=avg_all_rows), (data))
+            buffers = [self.get_data(self.pointsPerSlice) for i in range(max(self.averages, 1))]
+        return RawAcquisition(self.pointsPerSlice, self.averages, buffers)
 
-            return data[0]/self.averages, data[1]/self.averages
+    @instrument.traced('daq.process_average_roll', 'daq')
+    def process_average_roll(self, raw, avg_all_rows=False):
+        #
+        # Host half of take_average_data_roll(), rolls and averages a RawAcquisition.
+        # The alignment buffers are shared, so only one thread at a time may process.
+        # Returns two arrays: fb, err that belong to the caller
+        #
+        if(len(raw.buffers) == 1 and raw.averages > 1):
+            return self._roll_periods(raw.buffers[0], raw.points_per_slice, raw.averages, avg_all_rows)
+        elif(raw.averages <= 1):
+            fb, err = self._roll(raw.buffers[0], avg_all_rows)
+            # _roll may hand back its reused buffers, give the caller its own arrays
+            return np.array(fb), np.array(err)
+        else:
+            # Start the sums from copies, _roll may hand back its reused buffers
+            fb, err = self._roll(raw.buffers[0], avg_all_rows)
+            fb_sum = np.array(fb, dtype=np.float64)
+            err_sum = np.array(err, dtype=np.float64)
+            for data in raw.buffers[1:]:
+                fb, err = self._roll(data, avg_all_rows)
+                fb_sum += fb
+                err_sum += err
+
+            return fb_sum/raw.averages, err_sum/raw.averages
+
+
+    @instrument.traced('daq.roll_periods', 'daq')
+    def _roll_periods(self, data, points_per_slice, averages, avg_all_rows):
+        #
+        # Single acquisition half of process_average_roll(), the same result as rolling each
+        # period on its own and averaging. The buffer from one getNewData call is split into its
+        # periods, every period is rolled to its own FB minimum and then they are averaged.
+        # Returns two arrays: fb, err shaped like take_average_data_roll()
+        #
+        ncol, nrow = data.shape[0], data.shape[1]
+        periods = data[:, :, :averages * points_per_slice, :].reshape(
+            ncol, nrow, averages, points_per_slice, data.shape[-1])
+        fb, err = self._align_batched(periods)
 
+        # Periods are axis 2, fold the rows (axis 1) in at the same time if asked
+        axis = (1, 2) if(avg_all_rows) else 2
+        return fb.mean(axis=axis), err.mean(axis=axis)
 
     class FeedBackException(Exception):
         pass
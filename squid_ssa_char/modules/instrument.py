@@ -0,0 +1,195 @@
+#################################################################################
+#
+# Written by: Johnathon Gard, Erin Maloney
+# Purpose: Time the steps of a test run and export them as a trace
+#
+# A Tracer records timed spans, with tracer.span(name) blocks or the @traced
+# method decorator, and keeps a running total for every span name. Counter
+# sources are functions returning a dict of running counts, e.g. the serial
+# writes of the tower queue or the bytes pulled from the DAQ, that are
+# sampled at the start and end of each phase. tracer.phase(name) prints a
+# table of where the phase spent its time along with how much the counters
+# moved, and export_chrome() writes every span and counter sample in the
+# Chrome trace event format, which chrome://tracing or ui.perfetto.dev open.
+#
+# Spans nest, a ramp span includes the DAC write spans inside it, so the time
+# column of the summary does not add up to the phase time. The events kept for
+# export are capped at max_events, the totals keep counting past that.
+#
+#################################################################################
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+
+def traced(name, cat='ssa'):
+    '''
+    Method decorator that runs the method inside self.tracer.span(name, cat). With the tracer off the method
+    is called straight through, these decorate the hot paths
+    '''
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if(not self.tracer.enabled):
+                return func(self, *args, **kwargs)
+            with self.tracer.span(name, cat):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def traced_phase(name):
+    '''
+    Method decorator that runs the method inside self.tracer.phase(name)
+    '''
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if(not self.tracer.enabled):
+                return func(self, *args, **kwargs)
+            with self.tracer.phase(name):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class Tracer:
+
+    def __init__(self, enabled=True, path=None, max_events=1000000):
+        self.enabled = enabled
+        self.path = path        # If set the trace is written here at the end of every phase
+        self.max_events = max_events
+        self.events = []        # Chrome trace events, times in us since the tracer was made
+        self.totals = {}        # span name -> [calls, total s, longest s]
+        self.sources = {}       # counter source name -> function returning {count name: value}
+        self.n_dropped = 0      # Events not kept because of max_events
+        self._pid = os.getpid()
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def _now_us(self):
+        return (time.perf_counter() - self._t0) * 1e6
+
+    def _add_event(self, event):
+        if(len(self.events) < self.max_events):
+            self.events.append(event)
+        else:
+            self.n_dropped += 1
+
+    @contextlib.contextmanager
+    def span(self, name, cat='ssa', **args):
+        '''
+        Times the with block as name, extra keyword arguments are stored with the span in the trace
+        '''
+        if(not self.enabled):
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                total = self.totals.setdefault(name, [0, 0.0, 0.0])
+                total[0] += 1
+                total[1] += end - start
+                total[2] = max(total[2], end - start)
+                event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': self._pid, 'tid': threading.get_ident(),
+                         'ts': (start - self._t0) * 1e6, 'dur': (end - start) * 1e6}
+                if(args):
+                    event['args'] = args
+                self._add_event(event)
+
+    def add_counter_source(self, name, source):
+        self.sources[name] = source
+
+    def sample_counters(self):
+        '''
+        Reads every counter source, adds the values to the trace and returns {source: {count: value}}
+        '''
+        values = {name: dict(source()) for name, source in self.sources.items()}
+        if(self.enabled):
+            with self._lock:
+                for name, counts in values.items():
+                    self._add_event({'name': name, 'ph': 'C', 'pid': self._pid, 'tid': 0,
+                                     'ts': self._now_us(), 'args': counts})
+        return values
+
+    def mark(self):
+        '''
+        Snapshot of the span totals and counters for summary() to take differences from. The longest time
+        of each span starts over from here.
+        '''
+        with self._lock:
+            totals = {name: list(total) for name, total in self.totals.items()}
+            for total in self.totals.values():
+                total[2] = 0.0
+        return time.perf_counter(), totals, self.sample_counters()
+
+    def summary(self, mark):
+        '''
+        (wall seconds, rows, counter changes) since mark, rows are (name, calls, total s, longest s) from the
+        longest total down and counter changes are {source: {count: change}}
+        '''
+        start, totals, counters = mark
+        wall = time.perf_counter() - start
+        rows = []
+        with self._lock:
+            for name, (calls, total, longest) in self.totals.items():
+                calls0, total0, _ = totals.get(name, [0, 0.0, 0.0])
+                if(calls > calls0):
+                    rows.append((name, calls - calls0, total - total0, longest))
+        rows.sort(key=lambda row: row[2], reverse=True)
+        now = self.sample_counters()
+        changes = {name: {key: value - counters.get(name, {}).get(key, 0) for key, value in counts.items()}
+                   for name, counts in now.items()}
+        return wall, rows, changes
+
+    def print_summary(self, title, mark):
+        wall, rows, changes = self.summary(mark)
+        print("{} timing, {:.3f} s".format(title, wall))
+        print("{:<28s} | {:>8s} | {:>10s} | {:>7s} | {:>10s} | {:>10s}".format(
+            'Span', 'Calls', 'Total s', '% Phase', 'Mean ms', 'Longest ms'))
+        for name, calls, total, longest in rows:
+            print("{:<28s} | {:8d} | {:10.3f} | {:7.1f} | {:10.3f} | {:10.3f}".format(
+                name, calls, total, 100.0 * total / max(wall, 1e-12), 1000.0 * total / calls, 1000.0 * longest))
+        for name, counts in changes.items():
+            print("{:<28s} | ".format(name) + ", ".join(["{} {:g}".format(key, value) for key, value in counts.items()]))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''
+        Times the with block as a phase span, prints its summary when it finishes and exports the trace to path
+        '''
+        if(not self.enabled):
+            yield
+            return
+        mark = self.mark()
+        try:
+            with self.span(name, 'phase'):
+                yield
+        finally:
+            self.print_summary(name, mark)
+            if(self.path):
+                self.export_chrome(self.path)
+
+    def export_chrome(self, path):
+        '''
+        Writes the trace to path as Chrome trace event JSON, through a temporary file so path is always complete
+        '''
+        with self._lock:
+            trace = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms',
+                     'otherData': {'dropped_events': self.n_dropped}}
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(trace, f)
+        os.replace(tmp, path)
+        return path
+
+
+# Stand in for code that is not being traced
+NULL_TRACER = Tracer(enabled=False)
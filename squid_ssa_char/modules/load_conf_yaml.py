@@ -8,6 +8,16 @@
 # the system_config.yaml file. The testing config file is easy, either from 
 # where the script was called or given explicitly.
 #
+# load_config() parses a config with the libyaml loader when PyYAML has it,
+# checks it has the sections and values the scripts need and hands back a
+# read only ConfigSection. Parsed configs are kept in memory keyed on the path
+# and the SHA-256 of the file contents, so building many SSA objects only
+# parses each file once, and with persist the validated config is also written
+# as JSON to a .<name>.cache file next to the config for the next process. The
+# cache is plain data checked against the hash of the YAML it came from, a
+# stale or tampered file is never more than a parse of the YAML. Any problem
+# with the file raises a ConfigError naming the file and everything wrong.
+#
 # September 2023
 #
 #################################################################################
@@ -20,7 +30,9 @@ import glob
 import sys
 import argparse
 import textwrap
-import IPython
+import hashlib
+import json
+import threading
 
 # Installed package imports
 import yaml
@@ -42,11 +54,216 @@ else:
     SYSTEM_CONFIG_YAML = '/etc/system_config.yaml'
     LOCAL_MODULE_CONFIG_PATH = '/../conf_files/'
 
+# The C loader is many times faster, fall back to the pure python one if PyYAML was built without libyaml
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+CACHE_VERSION = 2
+
+# What the scripts read from each kind of config: section -> {key: type}. Nested dicts are sub sections.
+NUMBER = (int, float)
+CONFIG_SPECS = {
+    'system': {
+        'system': {},
+        'tower': {},
+        'crate': {},
+        'col_map': {},
+    },
+    'test': {
+        'info': {'user': str, 'system': str, 'chip_ids': list, 'chip_flavor': list, 'SSA_type': list},
+        'test_globals': {'columns': list, 'n_rows': int, 'bias_change_wait_ms': NUMBER},
+        'phase0_0': {'bias_sweep_start': int, 'bias_sweep_end': int, 'bias_sweep_npoints': int, 'n_avg': int,
+                     'bias_change_wait_ms': NUMBER, 'icmin_pickoff': NUMBER,
+                     'crate': {'tri_steps': int, 'tri_dwell': int, 'tri_step_size': int}},
+        'phase0_1': {'n_avg': int, 'bias_change_wait_ms': NUMBER,
+                     'crate': {'tri_steps': int, 'tri_dwell': int, 'tri_step_size': int}},
+        'phase1_0': {'n_avg': int, 'bias_change_wait_ms': NUMBER,
+                     'crate': {'tri_steps': int, 'tri_dwell': int, 'tri_step_size': int}},
+    },
+}
+
+_cache = {}     # (absolute path, kind) -> (sha256 of the file, ConfigSection)
+_cache_lock = threading.Lock()
+
+
+class ConfigError(ValueError):
+    pass
+
+
+class ConfigSection(dict):
+    '''
+    Read only dict of one config section, sub sections are ConfigSections and lists are ConfigLists.
+    Values can also be read as attributes, conf.test_globals.columns is conf['test_globals']['columns'].
+    '''
+
+    def __init__(self, values=()):
+        super().__init__((key, freeze(value)) for key, value in dict(values).items())
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError('Config has no {}'.format(name)) from None
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('Configs are read only, copy with thaw() to change one')
+
+    __setitem__ = __delitem__ = __setattr__ = __delattr__ = _read_only
+    clear = pop = popitem = setdefault = update = __ior__ = _read_only
+
+    def __reduce__(self):
+        return (type(self), (thaw(self),))
+
+
+class ConfigList(list):
+    '''
+    Read only list from a config
+    '''
+
+    def __init__(self, values=()):
+        super().__init__(freeze(value) for value in values)
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('Configs are read only, copy with thaw() to change one')
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+    def __reduce__(self):
+        return (type(self), (thaw(self),))
+
+
+def freeze(value):
+    if(isinstance(value, dict) and not isinstance(value, ConfigSection)):
+        return ConfigSection(value)
+    if(isinstance(value, list) and not isinstance(value, ConfigList)):
+        return ConfigList(value)
+    return value
+
+
+def thaw(value):
+    '''
+    Plain, changeable dicts and lists copied out of a config
+    '''
+    if(isinstance(value, dict)):
+        return {key: thaw(item) for key, item in value.items()}
+    if(isinstance(value, list)):
+        return [thaw(item) for item in value]
+    return value
+
+
+def _check_section(values, spec, where, errors):
+    for key, kind in spec.items():
+        name = where + key
+        if(key not in values or values[key] is None):
+            errors.append('{} is missing'.format(name))
+        elif(isinstance(kind, dict)):
+            if(not isinstance(values[key], dict)):
+                errors.append('{} has to be a section, got {!r}'.format(name, values[key]))
+            else:
+                _check_section(values[key], kind, name + '.', errors)
+        elif(isinstance(values[key], bool) or not isinstance(values[key], kind)):
+            expected = ' or '.join([k.__name__ for k in (kind if(isinstance(kind, tuple)) else (kind,))])
+            errors.append('{} has to be {}, got {!r}'.format(name, expected, values[key]))
+
+
+def validate(config, kind):
+    '''
+    Returns the list of problems with a parsed config of the given kind, 'system' or 'test'
+    '''
+    if(not isinstance(config, dict)):
+        return ['the file has to hold a mapping of sections, got {}'.format(type(config).__name__)]
+    errors = []
+    _check_section(config, CONFIG_SPECS[kind], '', errors)
+    if(kind == 'test'):
+        # Every column needs its chip id, flavor and type
+        columns = (config.get('test_globals') or {}).get('columns')
+        info = config.get('info') or {}
+        for key in ('chip_ids', 'chip_flavor', 'SSA_type'):
+            if(isinstance(columns, list) and isinstance(info.get(key), list) and len(info[key]) != len(columns)):
+                errors.append('info.{} has {} entries for {} test_globals.columns'.format(key, len(info[key]), len(columns)))
+    return errors
+
+
+def _cache_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.' + name + '.cache')
+
+
+def _read_persisted(path, key):
+    try:
+        with open(_cache_path(path), 'r') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if(not isinstance(cached, dict) or cached.get('version') != CACHE_VERSION or cached.get('sha256') != key):
+        return None
+    return cached.get('config')
+
+
+def _write_persisted(path, key, config):
+    # Best effort, a read only config directory just means no cache. Only configs that come back from JSON
+    # exactly as YAML gave them are kept, e.g. not ones with numbers for keys
+    try:
+        text = json.dumps({'version': CACHE_VERSION, 'sha256': key, 'config': config})
+    except (TypeError, ValueError):
+        return
+    if(json.loads(text)['config'] != config):
+        return
+    tmp = '{}.{}.tmp'.format(_cache_path(path), os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, _cache_path(path))
+    except OSError:
+        pass
+
+
+def load_config(path, kind, persist=False):
+    '''
+    Parses and validates the YAML config at path, kind is 'system' or 'test'. Returns a read only
+    ConfigSection, the same one for as long as the file contents are the same.
+    With persist the validated config is also kept as JSON in .<name>.cache next to the file.
+    Raises ConfigError if the file can not be read, parsed or is missing something.
+    '''
+    path = os.path.abspath(path)
+    try:
+        with open(path, 'rb') as file:
+            contents = file.read()
+    except OSError as e:
+        raise ConfigError('Can not read the {} config {}: {}'.format(kind, path, e.strerror)) from e
+    # The contents themselves, an edit inside one modification time tick that keeps the size is still seen
+    key = hashlib.sha256(contents).hexdigest()
+
+    with _cache_lock:
+        cached = _cache.get((path, kind))
+    if(cached is not None and cached[0] == key):
+        return cached[1]
+
+    raw = _read_persisted(path, key) if(persist) else None
+    parsed = raw is None
+    if(parsed):
+        try:
+            raw = yaml.load(contents, Loader=YAML_LOADER)
+        except yaml.YAMLError as exc:
+            raise ConfigError('The {} config {} is not valid YAML:\n{}'.format(kind, path, exc)) from exc
+
+    # A persisted config is checked again too, it is only plain data but nothing stops it being edited
+    errors = validate(raw, kind)
+    if(errors):
+        raise ConfigError('The {} config {} has problems:\n    '.format(kind, path) + '\n    '.join(errors))
+    if(persist and parsed):
+        _write_persisted(path, key, raw)
+
+    config = ConfigSection(raw)
+    with _cache_lock:
+        _cache[(path, kind)] = (key, config)
+    return config
+
 class Load_Conf_YAML:
     # Text before INIT
-    def __init__(self, test_config_path_arg='', system_config_path_arg=None, verbosity=0):
+    def __init__(self, test_config_path_arg='', system_config_path_arg=None, verbosity=0, persist_cache=False):
         #Text After Init
         self.verbosity = verbosity
+        self.persist_cache = persist_cache  # Keep the parsed configs in .<name>.cache files, see load_config()
         self.cwd = os.getcwd()
         self.class_file_path = os.path.dirname(__file__)
         self.system_config_path_arg = system_config_path_arg
@@ -110,17 +327,10 @@ class Load_Conf_YAML:
             self.config_file_path = self.config_file_path[0]
 
     def read_system_config(self):
-        with open(self.sys_file_path, 'r') as file:
-            try:
-                self.sys_config = yaml.safe_load(file)
-                return self.sys_config
-            except yaml.YAMLError as exc:
-                print(exc)
+        # Read only and shared with every other reader of the same file, raises ConfigError if it is no good
+        self.sys_config = load_config(self.sys_file_path, 'system', self.persist_cache)
+        return self.sys_config
 
     def read_test_config(self):
-        with open(self.config_file_path, 'r') as file:
-            try:
-                self.test_config = yaml.safe_load(file)
-                return self.test_config
-            except yaml.YAMLError as exc:
-                print(exc)
+        self.test_config = load_config(self.config_file_path, 'test', self.persist_cache)
+        return self.test_config
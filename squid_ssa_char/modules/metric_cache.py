@@ -0,0 +1,137 @@
+#################################################################################
+#
+# Written by: Johnathon Gard, Erin Maloney
+# Purpose: On disk cache of the values derived from each data file
+#
+# Entries are keyed by the SHA-256 of the data file contents, or of every file
+# in a columnar .ssa directory, together with a version string from the code
+# that derived them. A copied or renamed file still hits, and any change to the
+# data or to the processing code misses, there is nothing to invalidate by hand.
+#
+# Each entry is one pickle in the cache directory, written through a temporary
+# file and renamed into place so worker processes can share the directory.
+# Reading an entry touches its modification time, and when the directory grows
+# past max_bytes the least recently used entries are removed until it is back
+# under low_water of the limit.
+#
+#################################################################################
+
+import hashlib
+import os
+import pickle
+
+ENTRY_SUFFIX = '.pkl'
+CHUNK_BYTES = 1 << 20
+
+
+def content_hash(path):
+    '''
+    Hex SHA-256 of the file at path, or of the names and contents of the files in a directory
+    '''
+    h = hashlib.sha256()
+    if(os.path.isdir(path)):
+        for name in sorted(os.listdir(path)):
+            full = os.path.join(path, name)
+            if(os.path.isfile(full)):
+                h.update(name.encode() + b'\0')
+                _hash_file(h, full)
+    else:
+        _hash_file(h, path)
+    return h.hexdigest()
+
+
+def _hash_file(h, path):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b''):
+            h.update(chunk)
+
+
+class MetricCache:
+    '''
+    Size bounded cache of picklable values in directory, see the module header
+    '''
+
+    def __init__(self, directory, max_bytes=1e9, low_water=0.8):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        os.makedirs(directory, exist_ok=True)
+        self.n_bytes = self._scan_size()   # Running estimate, other processes share the directory
+        self.hits = 0
+        self.misses = 0
+        if(self.n_bytes > self.max_bytes):
+            self.evict()    # The limit may have been lowered since the last run
+
+    def key(self, path, version):
+        return hashlib.sha256((content_hash(path) + '\0' + version).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if(entry.name.endswith(ENTRY_SUFFIX)):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue    # Evicted by another process
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _scan_size(self):
+        return sum([size for _, size, _ in self._entries()])
+
+    def get(self, key):
+        '''
+        The value stored under key or None. A damaged entry is removed and counts as a miss
+        '''
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+            self._remove(path)
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)  # Most recently used
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.n_bytes += os.path.getsize(tmp)
+        os.replace(tmp, path)
+        if(self.n_bytes > self.max_bytes):
+            self.evict()
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache is under low_water of max_bytes
+        '''
+        entries = sorted(self._entries())
+        total = sum([size for _, size, _ in entries])
+        target = self.max_bytes * self.low_water
+        for _, size, path in entries:
+            if(total <= target):
+                break
+            # Gone either way if another process evicted it first
+            self._remove(path)
+            total -= size
+        self.n_bytes = total
+        return total
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
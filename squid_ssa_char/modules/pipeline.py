@@ -0,0 +1,91 @@
+#################################################################################
+#
+# Written by: Johnathon Gard, Erin Maloney
+# Purpose: Overlap the host side processing of a sweep point with the hardware
+#          steps of the next one
+#
+# Pipeline runs a processing function on a worker thread for every item that
+# is put() into it, in the order they were put. The queue between the two is
+# bounded, so once maxsize raw buffers are waiting put() blocks and memory use
+# stays fixed no matter how far the hardware side gets ahead. An exception in
+# the worker stops the processing and is raised again in the caller's thread
+# at the next put(), wait() or close(). With threaded=False every put() runs
+# the processing right away in the caller's thread, so the same loop can be
+# run either way.
+#
+#################################################################################
+
+import queue
+import threading
+
+_STOP = object()
+
+
+class Pipeline:
+
+    def __init__(self, process, maxsize=2, threaded=True):
+        self.process = process
+        self.threaded = threaded    # If False put() processes the item before returning
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='sweep-pipeline', daemon=True)
+        if(self.threaded):
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if(item is _STOP):
+                    return
+                # After a failure keep draining so put() and wait() never block forever
+                if(self._error is None):
+                    self.process(item)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if(self._error is not None):
+            raise self._error
+
+    def put(self, item):
+        '''
+        Hand an item to the worker, blocks while the queue is full
+        '''
+        self._raise_error()
+        if(self.threaded):
+            self._queue.put(item)
+        else:
+            self.process(item)
+
+    def wait(self):
+        '''
+        Block until every item put so far has been processed
+        '''
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        '''
+        Process what is left in the queue and stop the worker
+        '''
+        self._stop()
+        self._raise_error()
+
+    def _stop(self):
+        if(self._thread.is_alive()):
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if(exc_type is None):
+            self.close()
+        else:
+            # Already unwinding, stop the worker but let the original exception through
+            self._stop()
+        return False
@@ -0,0 +1,152 @@
+#################################################################################
+#
+# Written by: Johnathon Gard, Erin Maloney
+# Purpose: Compile the system config column map into a routing table
+#
+# The col_map section of the system config says which tower card and channel
+# drive the SA Bias, SA FB and SA Input of each column and which crate card
+# digitizes it. compile_routes() resolves all of that once, card names
+# included, into one ColumnRoute per column. The ramps then only need an
+# attribute lookup per DAC write, and every problem in the map is reported
+# together before anything is sent to the hardware.
+#
+#################################################################################
+
+
+class RoutingError(ValueError):
+    pass
+
+
+class TowerRoute:
+    '''
+    One tower DAC output: the card it is on, the card address and channel, and the card values needed for units
+    '''
+    __slots__ = ('card', 'addr', 'col_n', 'bias_r', 'gain', 'dac_ref_v', 'dac_nbits', 'dac_gain')
+
+    def __init__(self, card, addr, col_n, bias_r, gain, dac_ref_v, dac_nbits, dac_gain):
+        self.card = card
+        self.addr = addr
+        self.col_n = col_n
+        self.bias_r = bias_r
+        self.gain = gain            # Effective amplifier gain, None on cards without an amplifier
+        self.dac_ref_v = dac_ref_v
+        self.dac_nbits = dac_nbits
+        self.dac_gain = dac_gain
+
+
+class DaqRoute:
+    '''
+    The crate card and channel that digitizes a column, with its ADC and DAC values
+    '''
+    __slots__ = ('card', 'chan', 'adc_nbits', 'adc_vrange', 'adc_gain', 'dac_nbits', 'dac_vref', 'dac_gain')
+
+    def __init__(self, card, chan, adc_nbits, adc_vrange, adc_gain, dac_nbits, dac_vref, dac_gain):
+        self.card = card
+        self.chan = chan
+        self.adc_nbits = adc_nbits
+        self.adc_vrange = adc_vrange
+        self.adc_gain = adc_gain
+        self.dac_nbits = dac_nbits
+        self.dac_vref = dac_vref
+        self.dac_gain = dac_gain
+
+
+class ColumnRoute:
+    '''
+    Everything the system config says about one column. bias_addr and bias_chan repeat the SA Bias tower
+    address and channel for the ramps, which look them up for every DAC write.
+    '''
+    __slots__ = ('column', 'name', 'sa_bias', 'sa_fb', 'sa_input', 'daq', 'bias_addr', 'bias_chan')
+
+    def __init__(self, column, name, sa_bias, sa_fb, sa_input, daq):
+        self.column = column
+        self.name = name
+        self.sa_bias = sa_bias
+        self.sa_fb = sa_fb
+        self.sa_input = sa_input
+        self.daq = daq
+        self.bias_addr = sa_bias.addr
+        self.bias_chan = sa_bias.col_n
+
+
+def find_tower_card(tower_conf, card_ref):
+    '''
+    Returns (card key, card config) for card_ref, which can be the card number (card0..cardn) or the card name
+    '''
+    if(card_ref in tower_conf):
+        return card_ref, tower_conf[card_ref]
+    for key, card in tower_conf.items():
+        if(card.get('name') == card_ref):
+            return key, card
+    raise KeyError('Tower card {} is not in the system config by number or name'.format(card_ref))
+
+
+def _tower_route(tower_conf, where, entry, needs_gain, errors):
+    try:
+        key, card = find_tower_card(tower_conf, entry['tower_card'])
+        col_n = int(entry['tower_col_n'])
+        n_cols = int(card.get('n_cols', len(card['bias_R'])))
+        if(not 0 <= col_n < n_cols):
+            raise IndexError('tower_col_n {} is outside the {} channels of {}'.format(col_n, n_cols, key))
+        gain = card['gain_effective'][col_n] if(needs_gain or 'gain_effective' in card) else None
+        return TowerRoute(key, int(card['addr']), col_n, card['bias_R'][col_n], gain,
+                          card['dac_ref_v'], card['dac_nbits'], card.get('dac_gain', 1))
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        errors.append('{}: {}'.format(where, e))
+        return None
+
+
+def _daq_route(crate_conf, where, entry, errors):
+    try:
+        card = crate_conf[entry['card']]
+        return DaqRoute(entry['card'], int(entry['chan']), card['adc_n_bits'], card['adc_vin_range'],
+                        card['input_gain'], card['dac_n_bits'], card['dac_vout_range'], card['dac_gain'])
+    except (KeyError, TypeError, ValueError) as e:
+        errors.append('{}: missing or bad {}'.format(where, e))
+        return None
+
+
+def compile_routes(sys_conf, columns=()):
+    '''
+    Builds {column number: ColumnRoute} from the col_map of sys_conf. Every entry of col_map is checked, as
+    are the selected columns, and RoutingError lists all of the problems found.
+    '''
+    routes = {}
+    errors = []
+    tower_conf = sys_conf.get('tower') or {}
+    crate_conf = sys_conf.get('crate') or {}
+    for key, entry in (sys_conf.get('col_map') or {}).items():
+        try:
+            column = int(str(key)[len('col'):])
+        except ValueError:
+            errors.append('col_map {}: names have to be col<n>'.format(key))
+            continue
+        parts = {}
+        for part in ('SA_Bias', 'SA_FB', 'SA_Input', 'DAQ'):
+            if(not isinstance(entry.get(part), dict)):
+                errors.append('col_map {}: no {} section'.format(key, part))
+                parts[part] = None
+            elif(part == 'DAQ'):
+                parts[part] = _daq_route(crate_conf, 'col_map {} DAQ'.format(key), entry[part], errors)
+            else:
+                # Only the SA Bias card is an amplifier with a gain to convert units with
+                parts[part] = _tower_route(tower_conf, 'col_map {} {}'.format(key, part), entry[part], part == 'SA_Bias', errors)
+        if(None not in parts.values()):
+            routes[column] = ColumnRoute(column, entry.get('name', key), parts['SA_Bias'], parts['SA_FB'],
+                                         parts['SA_Input'], parts['DAQ'])
+
+    # Two columns on one SA Bias DAC would ramp each other
+    seen = {}
+    for column, route in sorted(routes.items()):
+        dac = (route.bias_addr, route.bias_chan)
+        if(dac in seen):
+            errors.append('col{} and col{} both have their SA_Bias on tower address {} channel {}'.format(seen[dac], column, *dac))
+        seen[dac] = column
+
+    for column in columns:
+        if(int(column) not in routes and 'col{}'.format(column) not in (sys_conf.get('col_map') or {})):
+            errors.append('Selected column {} is not in col_map'.format(column))
+
+    if(errors):
+        raise RoutingError('The system config column map has problems:\n    ' + '\n    '.join(errors))
+    return routes
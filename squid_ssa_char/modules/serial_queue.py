@@ -0,0 +1,67 @@
+#################################################################################
+#
+# Written by: Johnathon Gard, Erin Maloney
+# Purpose: Coalesce small serial writes to the rack into fewer, larger writes
+#
+# The tower and bad channel cards are commanded with a few bytes per register.
+# Each of those going out as its own write() costs a syscall and a USB round
+# trip, which dominates a DAC ramp. CommandQueue sits in front of a serial port
+# object and, while held, collects the messages in order and sends them as one
+# write() when the hold is released, when the batch is full or on flush().
+# Outside of a hold every write goes straight through, so the queue can be
+# dropped in wherever a serial port is expected.
+#
+#################################################################################
+
+import contextlib
+
+
+class CommandQueue:
+
+    def __init__(self, serialport, max_batch=0, batching=True):
+        self.serialport = serialport
+        self.max_batch = max_batch  # Most messages per write(), 0 for no limit
+        self.batching = batching    # If False hold() does nothing and every message is its own write()
+        self._pending = []
+        self._hold = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.n_commands = 0  # Messages handed to write()
+        self.n_writes = 0    # write() calls made on the serial port
+        self.n_bytes = 0     # Bytes sent to the serial port
+
+    def stats(self):
+        return {'commands': self.n_commands, 'writes': self.n_writes, 'bytes': self.n_bytes}
+
+    def write(self, msg):
+        self._pending.append(bytes(msg))
+        self.n_commands += 1
+        if((self._hold == 0) or (self.max_batch and len(self._pending) >= self.max_batch)):
+            self.flush()
+        return len(msg)
+
+    def flush(self):
+        if(self._pending):
+            msg = b''.join(self._pending)
+            self._pending.clear()
+            self.serialport.write(msg)
+            self.n_writes += 1
+            self.n_bytes += len(msg)
+
+    @contextlib.contextmanager
+    def hold(self):
+        '''
+        Collect every write made inside the with block and send them together when it exits.
+        Holds can be nested, the messages go out when the outermost one is released.
+        '''
+        if(not self.batching):
+            yield self
+            return
+        self._hold += 1
+        try:
+            yield self
+        finally:
+            self._hold -= 1
+            if(self._hold == 0):
+                self.flush()
@@ -0,0 +1,217 @@
+#################################################################################
+#
+# Written by: Johnathon Gard, Erin Maloney
+# Purpose: Hardware free stand ins for the tower, serial port and DASTARD client
+#
+# The simulated tower encodes every DAC write into a serial frame and pushes it
+# through a simulated serial port that sleeps for a realistic per write time.
+# The port decodes the frames into a shared SimRack, which is where the
+# simulated DAQ reads the SA bias of each column from. The DAQ then synthesizes
+# periodic SSA V-Phi curves, whose modulation depth depends on that bias, on
+# top of a triangle on FB or IN plus noise, in the same (ncol, nrow, npts, 2)
+# layout that easyClient.getNewData returns.
+#
+# Selected with daq_type: SIM and tower_type: SIM in the system config, the
+# device parameters come from the optional simulator section.
+#
+#################################################################################
+
+import struct
+import time
+import numpy as np
+
+from squid_ssa_char.modules import serial_queue, towerchannel
+
+# Defaults for everything in the system config simulator section
+SIM_DEFAULTS = {
+    'seed': 0,
+    'serial_write_latency_ms': 1.0,  # Fixed cost of every write() to the serial port
+    'serial_baud': 115200,           # Adds the time on the wire for each byte
+    'noise_adc': 3.0,                # Gaussian noise on the error signal, ADC units
+    'icmin_dac': 12000,              # SA bias DAC where modulation starts
+    'icmax_dac': 24000,              # SA bias DAC with the largest modulation depth
+    'icmax_decay_dac': 20000,        # 1/e fall off of the modulation above Icmax
+    'device_spread': 0.05,           # Fractional spread of Icmin/Icmax between columns
+    'row_spread': 0.0,               # Fractional spread between rows of a column
+    'vmod_adc': 1500.0,              # Peak to peak modulation depth at Icmax, ADC units
+    'rdyn_adc_per_dac': 0.05,        # Slope of the device voltage above Icmin
+    'phi0_fb_dac': 1100.0,           # FB triangle DAC units per flux quantum
+    'phi0_in_dac': 250.0,            # IN triangle DAC units per flux quantum
+    'settle_adc': 50.0,              # Size of the transient on the error signal after a bias change
+    'settle_tau_ms': 20.0,           # Time constant of that transient
+}
+
+
+class SimRack:
+    '''
+    Shared state of the simulated rack: the DAC value held at every tower (address, channel)
+    and the traffic that has gone over the serial port.
+    '''
+    def __init__(self):
+        self.dac = {}           # (address, channel) -> last DAC value written
+        self.changed_at = {}    # (address, channel) -> time.perf_counter() of the last change
+        self.n_writes = 0       # Number of write() calls on the serial port
+        self.n_bytes = 0        # Number of bytes written
+        self.n_dac_writes = 0   # Number of DAC frames decoded
+
+    def get_dac(self, address, channel):
+        return self.dac.get((address, channel), 0)
+
+    def seconds_since_change(self, address, channel):
+        return time.perf_counter() - self.changed_at.get((address, channel), float('-inf'))
+
+
+class SimSerialPort:
+    '''
+    Serial port stand in. Every write() costs a fixed latency plus the time on the wire, then the
+    5 byte frames in it are decoded into the rack DAC state.
+    '''
+    FRAME_BYTES = 5
+
+    def __init__(self, rack, write_latency_ms=1.0, baud=115200):
+        self.rack = rack
+        self.write_latency_s = write_latency_ms / 1000.0
+        self.byte_time_s = 10.0 / baud if baud else 0.0  # 8N1 is 10 bits per byte
+
+    def write(self, msg):
+        time.sleep(self.write_latency_s + len(msg) * self.byte_time_s)
+        self.rack.n_writes += 1
+        self.rack.n_bytes += len(msg)
+        for i in range(0, len(msg) - self.FRAME_BYTES + 1, self.FRAME_BYTES):
+            address, channel, value = decode_tower_frame(msg[i:i + self.FRAME_BYTES])
+            if(self.rack.dac.get((address, channel)) != value):
+                self.rack.changed_at[(address, channel)] = time.perf_counter()
+            self.rack.dac[(address, channel)] = value
+            self.rack.n_dac_writes += 1
+        return len(msg)
+
+
+def encode_tower_frame(address, channel, value):
+    # 16 bit value and 5 bit channel packed 7 bits per byte like the bad channel card registers,
+    # the last byte carries the card address with the address bit set
+    word = (int(channel) << 16) | (int(value) & 0xffff)
+    return struct.pack('BBBBB',
+                       (word & 0x7f) << 1,
+                       ((word >> 7) & 0x7f) << 1,
+                       ((word >> 14) & 0x7f) << 1,
+                       ((word >> 21) & 0x7f) << 1,
+                       (int(address) << 1) + 1)
+
+
+def decode_tower_frame(frame):
+    b0, b1, b2, b3, b4 = struct.unpack('BBBBB', frame)
+    word = (b0 >> 1) | ((b1 >> 1) << 7) | ((b2 >> 1) << 14) | ((b3 >> 1) << 21)
+    return b4 >> 1, word >> 16, word & 0xffff
+
+
+class SimBlueBox:
+    '''
+    Mirrors the parts of instruments.bluebox.BlueBox that the tower code uses
+    '''
+    def __init__(self, serialport, address=0, channel=0):
+        self.serialport = serialport
+        self.address = address
+        self.channel = channel
+
+    def setVoltDACUnits(self, value):
+        self.serialport.write(encode_tower_frame(self.address, self.channel, value))
+
+
+class SimTowerChannel:
+    '''
+    Drop in for towerchannel.TowerChannel that talks to a SimRack
+    '''
+    def __init__(self, rack, column=0, cardaddr=3, write_latency_ms=1.0, baud=115200, max_batch=0, batching=False,
+                 skip_redundant=False):
+        self.verbosity = 0
+        self.address = cardaddr
+        self.column = column
+        self.serialport = SimSerialPort(rack, write_latency_ms, baud)
+        self.queue = serial_queue.CommandQueue(self.serialport, max_batch=max_batch, batching=batching)
+        self.bluebox = SimBlueBox(self.queue, address=cardaddr, channel=column)
+        self.shadow = towerchannel.ShadowRegisters(skip_redundant)
+
+    def hold(self):
+        return self.queue.hold()
+
+    def set_value(self, dac_value):
+        address, channel, value = self.bluebox.address, self.bluebox.channel, int(dac_value)
+        if(not self.shadow.needs_write(address, channel, value)):
+            return
+        if(self.verbosity > 3):
+            print(("simtowerchannel.set_value() %g to addr %g, chn %g"%(dac_value, self.bluebox.address, self.bluebox.channel)))
+        self.bluebox.setVoltDACUnits(value)
+        self.shadow.update(address, channel, value)
+
+
+class SimEasyClient:
+    '''
+    Drop in for nasa_client.easyClient.EasyClient. bias_map is a dict of DAQ column number -> tower
+    (address, channel) of its SA bias, that is where the device bias is read from for each grab. Every
+    column up to the highest one in the map is returned, columns missing from it are never biased.
+    '''
+    def __init__(self, rack, bias_map, nrow=4, params=None, clockmhz=125):
+        self.rack = rack
+        self.bias_map = dict(bias_map)
+        self.ncol = max(self.bias_map) + 1 if(self.bias_map) else 0
+        self.nrow = nrow
+        self.clockmhz = clockmhz
+        self.params = dict(SIM_DEFAULTS)
+        self.params.update(params or {})
+        self.rng = np.random.default_rng(self.params['seed'])
+        self.samples_taken = 0
+        self.bytes_returned = 0
+
+        # Every (column, row) is its own device, spread the critical currents around a little
+        p = self.params
+        col_scale = 1.0 + p['device_spread'] * self.rng.standard_normal((self.ncol, 1))
+        row_scale = 1.0 + p['row_spread'] * self.rng.standard_normal((self.ncol, self.nrow))
+        self.icmin = p['icmin_dac'] * col_scale * row_scale
+        self.icmax = p['icmax_dac'] * col_scale * row_scale
+        self.set_triangle()
+
+    def setupAndChooseChannels(self):
+        pass
+
+    def set_triangle(self, tri_steps=12, tri_dwell=0, tri_step_size=1, tri_output='FB'):
+        '''
+        Stands in for the crate triangle that cringe sets up on a real system
+        '''
+        up = np.repeat(np.arange(2**tri_steps) * tri_step_size, 2**tri_dwell)
+        self.triangle = np.concatenate((up, up[::-1]))
+        self.phi0_dac = self.params['phi0_in_dac'] if(tri_output == 'IN') else self.params['phi0_fb_dac']
+
+    def modulation_depth(self, bias):
+        '''
+        Peak to peak modulation in ADC units for every (column, row) at the given bias DACs
+        '''
+        p = self.params
+        bias = np.asarray(bias, dtype=np.float64)
+        rise = np.sin(0.5 * np.pi * np.clip((bias - self.icmin) / (self.icmax - self.icmin), 0.0, 1.0))
+        fall = np.exp(-np.clip(bias - self.icmax, 0.0, None) / p['icmax_decay_dac'])
+        return p['vmod_adc'] * rise * fall
+
+    def getNewData(self, minimumNumPoints=4000, exactNumPoints=False, **kwargs):
+        npts = int(minimumNumPoints)
+        # Free running triangle, so each grab starts at some new phase of it
+        self.samples_taken += npts + int(self.rng.integers(0, len(self.triangle)))
+        t = (self.samples_taken + np.arange(npts)) % len(self.triangle)
+        tri = self.triangle[t]
+
+        bias = np.array([[self.rack.get_dac(*self.bias_map[c]) if(c in self.bias_map) else 0]
+                         for c in range(self.ncol)], dtype=np.float64)
+        vmod = self.modulation_depth(bias)
+        offset = self.params['rdyn_adc_per_dac'] * np.clip(bias - self.icmin, 0.0, None)
+        # Bias changes leave a decaying transient on the error signal
+        age_ms = np.array([[1e3 * self.rack.seconds_since_change(*self.bias_map[c]) if(c in self.bias_map) else np.inf]
+                           for c in range(self.ncol)])
+        offset = offset + self.params['settle_adc'] * np.exp(-age_ms / self.params['settle_tau_ms'])
+        phase = np.cos(2 * np.pi * tri / self.phi0_dac)
+
+        data = np.empty((self.ncol, self.nrow, npts, 2), dtype=np.int32)
+        err = offset[..., None] + 0.5 * vmod[..., None] * phase
+        err += self.params['noise_adc'] * self.rng.standard_normal(err.shape)
+        data[..., 0] = np.rint(err)
+        data[..., 1] = tri
+        self.bytes_returned += data.nbytes
+        return data
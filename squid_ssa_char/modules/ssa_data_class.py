@@ -5,18 +5,113 @@
 #
 # Class to hold the recoreded data values for the SQUID Series Array Screening.
 #
+# Saved either as a pickle or in the columnar format: a <file_name>.ssa
+# directory with the scalar values in meta.json and every array in its own
+# .npy file, which can be memory mapped. load(lazy=True) only reads meta.json
+# and maps each array the first time it is used, so scanning the scalar
+# results of many chips never touches their traces.
+#
 # September 2023
 #
 #################################################################################
 
 
+import json
+import os
+import shutil
 import numpy as np
 import pickle
 
+# Columnar file format, load() refuses versions newer than it knows
+COLUMNAR_FORMAT = 'ssa_columnar'
+COLUMNAR_VERSION = 1
+COLUMNAR_SUFFIX = '.ssa'
+COLUMNAR_META = 'meta.json'
+
+# Precisions the trace arrays can be held in, the integer types are scaled
+STORAGE_DTYPES = ('float64', 'float32', 'int32', 'int16')
+# Room above the signed ADC range the integer trace types leave before values are clipped
+TRACE_HEADROOM = 1.25
+
+
+def encode_trace(values, storage_dtype, scale=None, offset=0.0):
+    '''
+    Converts a float array to storage_dtype. Integer types are stored as round((values - offset) / scale), when scale
+    is not given it is picked so the values span the full integer range.
+    Returns (encoded array, scale, offset), scale is None for the float types
+    '''
+    if(storage_dtype not in STORAGE_DTYPES):
+        raise ValueError('Unknown storage_dtype {}, expected one of {}'.format(storage_dtype, ', '.join(STORAGE_DTYPES)))
+    dtype = np.dtype(storage_dtype)
+    if(dtype.kind == 'f'):
+        return np.asarray(values, dtype=dtype), None, 0.0
+
+    values = np.asarray(values, dtype=np.float64)
+    info = np.iinfo(dtype)
+    if(scale is None):
+        if(values.size > 0):
+            offset = (float(np.max(values)) + float(np.min(values))) / 2.0
+            scale = (float(np.max(values)) - float(np.min(values))) / (2.0 * info.max)
+        scale = scale or 1.0
+    return quantize((values - offset) / scale, dtype), scale, offset
+
+
+def quantize(values, dtype):
+    info = np.iinfo(dtype)
+    return np.clip(np.rint(values), info.min, info.max).astype(dtype)
+
+
+def count_clipped(values, dtype):
+    '''
+    Number of values quantize() would clip to the range of the integer dtype
+    '''
+    info = np.iinfo(dtype)
+    return int(np.count_nonzero((values < info.min - 0.5) | (values > info.max + 0.5)))
+
+
+class TraceArray:
+    '''
+    Attribute holding a trace array of SSA_Data_Class in the storage_dtype of the instance. Reading it always gives
+    floats back, scaled integer arrays are decoded with the scale and offset kept next to them.
+    '''
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.key = '_' + name   # (encoded array, scale, offset) in the instance __dict__
+
+    def __get__(self, obj, objtype=None):
+        if(obj is None):
+            return self
+        obj._map_lazy(self.name)
+        if(self.key not in obj.__dict__):
+            # Pickles from before storage_dtype have the plain float array under the attribute name
+            return obj.__dict__.get(self.name, np.array([]))
+        values, scale, offset = obj.__dict__[self.key]
+        if(scale is None):
+            return values
+        return values * scale + offset
+
+    def __set__(self, obj, values):
+        obj.__dict__.pop(self.name, None)
+        obj.__dict__[self.key] = encode_trace(values, obj.storage_dtype)
+
+    def encoded(self, obj):
+        obj._map_lazy(self.name)
+        if(self.key not in obj.__dict__):
+            obj.__dict__[self.key] = (np.asarray(obj.__dict__.pop(self.name, np.array([]))), None, 0.0)
+        return obj.__dict__[self.key]
+
+
 class System:
+    row_num = None  # Also the default for files saved before per row mode existed
+    # Files saved before version 1 hold the crate DAC reference in in_dac_vref and leave daq_dac_vref at 1,
+    # and fb_dac_nbits and in_dac_nbits hold the tower dac_gain
+    bookkeeping_version = 0
+
     def __init__(self):
+        self.bookkeeping_version = 1    # Which values the fields below hold, see the class attribute
         # System Information required to do proper unit conversions
         self.channel_num = 0    # Column number for the DAQ 
+        self.row_num = None     # Row of the device in per row mode, None when the rows were averaged
         # SSA Pre-Amp specs
         self.amp_gain = 0
         self.amp_dac_nbits = 0
@@ -31,7 +126,7 @@ class System:
         # SSA IN Bias Card Specs
         self.in_dac_nbits = 0
         self.in_dac_vref = 0
-        self.fb_dac_gain = 1
+        self.in_dac_gain = 1
         self.in_bias_r = 0
         ## DAQ Information
         # ADC Input Informations
@@ -44,7 +139,23 @@ class System:
         self.daq_dac_gain = 1
 
 class SSA_Data_Class:
-    def __init__(self):
+    # Arrays holding one entry per phase0_0 bias point, in the same order as dac_sweep_array
+    PHASE0_0_SWEEP_ARRAYS = ('dac_sweep_array', 'phase0_0_vphis', 'phase0_0_vmod_max', 'phase0_0_vmod_min',
+                             'phase0_0_vmod_sab', 'phase0_0_settle_ms')
+
+    # Trace arrays, held in storage_dtype and read back as floats
+    phase0_0_vphis = TraceArray()
+    baselines_trace = TraceArray()
+    phase0_1_icmax_vphi = TraceArray()
+    phase0_1_triangle = TraceArray()
+    phase1_0_icmax_vphi = TraceArray()
+    phase1_0_triangle = TraceArray()
+    storage_dtype = 'float64'   # Also the default for pickles saved before storage_dtype existed
+    clipped_samples = 0         # Also the default for files saved before clipping was counted
+
+    def __init__(self, storage_dtype='float64'):
+        self.storage_dtype = storage_dtype  # Precision of the trace arrays, one of STORAGE_DTYPES
+        self.clipped_samples = 0    # Trace samples set_row() clipped to the range of an integer storage_dtype
         # Testing Information storage
         self.chip_id = ''       # CHIP  ID
         self.qa_name = ''       #Name of the Person performing the test
@@ -68,11 +179,18 @@ class SSA_Data_Class:
         self.baselines_range = np.array([])
         self.baselines_average = np.array([])
         self.baselines_SNR = np.array([])
-        self.baselines_trace = np.array([])   # Place to store the trace that std, range, average, SNR was calced from
+        self.baselines_trace = np.array([])   # Averaged trace of the last baseline block, empty unless baseline_store_trace
+        self.baselines_n_blocks = 0     # Number of DAQ blocks the baseline statistics were taken over
+        self.baselines_psd = np.array([])   # One sided noise PSD of the raw baseline error data
+        self.baselines_psd_freq = np.array([])  # Frequencies of baselines_psd, Hz or cycles/sample
+        self.baselines_noise_floor = 0.0    # Median of baselines_psd, not pulled up by spectral lines
         self.phase0_0_vmod_sab = np.array([]) # SSA V Modulation depth vs bias
         self.phase0_0_vmod_min = np.array([]) # Store min value of the modulation in adc units
         self.phase0_0_vmod_max = np.array([]) # Store max value of the modulation in adc units
         self.phase0_0_vphis = np.array([])  # Place to store the VPhi for every bias value for testing 
+        self.phase0_0_settle_ms = np.array([])  # Time waited for the system to settle at each bias point
+        self.phase0_0_stop_bias = 0     # Last bias point the sweep needed, see phase0_0_stop_reason
+        self.phase0_0_stop_reason = ''  # Why the sweep stopped there, end of sweep or the early stop criteria met
         
         # Phase0_1 Bias to Ic_Max while sweeping Feed Back and save V_Phi
         self.phase0_1_icmax_vphi = np.array([])
@@ -82,22 +200,199 @@ class SSA_Data_Class:
         self.phase1_0_icmax_vphi = np.array([])
         self.phase1_0_triangle = np.array([])
         
-    def save(self, save_all=False):
-        '''
-        Method to save the data class to a pickle, if save_all is false, the bias sweep vphis
-        will be cleared out and then the data class saved using pickle
-        '''
-        with open(self.file_name + '.pickle', 'wb') as f:
-            # If save all is false, clear out the stored sweep of vphis form the data class
-            if(save_all == False):
-                self.phase0_0_vphis = np.array([])
-            # Dump the class to the pickle file type
-            pickle.dump(self, f, -1)  # -1 means use the latest encoding version of pickle
-    
+    def init_trace(self, name, shape, full_scale=None):
+        '''
+        Allocates the trace array name filled with zeros, to be written a row at a time with set_row(). The scaled
+        integer types need their scale fixed up front, it is set so +-full_scale fits. full_scale defaults to the
+        signed error signal span, 2**(daq_adc_nbits-1), with TRACE_HEADROOM on top, 16 bits when it is not known.
+        One int16 step is then full_scale/32767 ADC counts, 0.31 counts with a 14 bit ADC, so rows are rounded by
+        up to 0.16 counts. Averaged rows have finer precision than that, int32 keeps it (5e-6 counts a step).
+        Values past +-full_scale, e.g. DASTARD error summed over nsamp, are clipped. set_row() counts them in
+        clipped_samples and warns the first time, pass a larger full_scale if that happens.
+        '''
+        if(full_scale is None):
+            nbits = self.sys.daq_adc_nbits if(self.sys.daq_adc_nbits) else 16
+            full_scale = TRACE_HEADROOM * 2.0**(nbits - 1)
+        dtype = np.dtype(self.storage_dtype)
+        scale = full_scale / np.iinfo(dtype).max if(dtype.kind == 'i') else None
+        self.__dict__['_' + name] = encode_trace(np.zeros(shape), self.storage_dtype, scale)
+
+    def set_row(self, name, idx, values):
+        '''
+        Writes row idx of the array name, trace arrays are encoded with the scale they already have
+        '''
+        trace = type(self).__dict__.get(name)
+        if(not isinstance(trace, TraceArray)):
+            getattr(self, name)[idx] = values
+            return
+        encoded, scale, offset = trace.encoded(self)
+        if(scale is None):
+            encoded[idx] = values
+            return
+        scaled = (np.asarray(values, dtype=np.float64) - offset) / scale
+        n_clipped = count_clipped(scaled, encoded.dtype)
+        if(n_clipped > 0):
+            if(self.clipped_samples == 0):
+                print("WARNING: {} samples of {} row {} for {} are outside the +-{:.6g} {} holds and were clipped, "
+                      "later clipping is only counted in clipped_samples".format(
+                          n_clipped, name, idx, self.chip_id, np.iinfo(encoded.dtype).max * scale, self.storage_dtype))
+            self.clipped_samples += n_clipped
+        encoded[idx] = quantize(scaled, encoded.dtype)
+
+    def get_row(self, name, idx):
+        '''
+        Reads row idx of the array name as floats, without decoding the rest of a trace array
+        '''
+        trace = type(self).__dict__.get(name)
+        if(not isinstance(trace, TraceArray)):
+            return getattr(self, name)[idx]
+        encoded, scale, offset = trace.encoded(self)
+        if(scale is None):
+            return encoded[idx]
+        return encoded[idx] * scale + offset
+
+    def finish_sweep(self, npoints):
+        '''
+        Trims the phase0_0 sweep arrays down to the npoints that were visited and sorts them by bias, adaptive
+        sweeps visit their points out of order
+        '''
+        order = np.argsort(self.dac_sweep_array[:npoints], kind='stable')
+        in_order = np.array_equal(order, np.arange(npoints))
+        for name in self.PHASE0_0_SWEEP_ARRAYS:
+            trace = type(self).__dict__.get(name)
+            if(isinstance(trace, TraceArray)):
+                # Reorder the stored values as they are, decoding and encoding again would requantize them
+                encoded, scale, offset = trace.encoded(self)
+                encoded = encoded[:npoints]
+                self.__dict__[trace.key] = (encoded if(in_order) else encoded[order], scale, offset)
+            else:
+                values = getattr(self, name)[:npoints]
+                setattr(self, name, values if(in_order) else values[order])
+
+    def save(self, save_all=False, fmt='pickle'):
+        '''
+        Method to save the data class, if save_all is false, the bias sweep vphis will be cleared out
+        and then the data class saved. fmt is 'pickle' for file_name.pickle or 'columnar' for a
+        file_name.ssa directory. Returns the path written.
+        '''
+        # If save all is false, clear out the stored sweep of vphis form the data class
+        if(save_all == False):
+            self.phase0_0_vphis = np.array([])
+        if(fmt == 'columnar'):
+            return self.save_columnar(self.file_name + COLUMNAR_SUFFIX)
+        elif(fmt == 'pickle'):
+            self.load_arrays()
+            # Written next to the real name and renamed over it, a crash never leaves half a pickle behind
+            path = self.file_name + '.pickle'
+            with open(path + '.tmp', 'wb') as f:
+                # Dump the class to the pickle file type
+                pickle.dump(self, f, -1)  # -1 means use the latest encoding version of pickle
+            os.replace(path + '.tmp', path)
+            return path
+        raise ValueError('Unknown save format {}, expected columnar or pickle'.format(fmt))
+
+    def save_columnar(self, path):
+        '''
+        Writes the data class to the directory path, scalars go to meta.json and each array to its own .npy.
+        Trace arrays are written in their storage_dtype along with their scale and offset. Everything is
+        written to path.tmp first and then renamed into place, so path is always a complete save.
+        '''
+        self.load_arrays()
+        final_path, path = path, path + '.tmp'
+        if(os.path.exists(path)):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        meta = {'format': COLUMNAR_FORMAT, 'version': COLUMNAR_VERSION, 'scalars': {}, 'sys': {}, 'arrays': {}}
+        for key, value in self.__dict__.items():
+            trace = type(self).__dict__.get(key[1:])
+            if(isinstance(trace, TraceArray)):
+                values, scale, offset = value
+                np.save(os.path.join(path, trace.name + '.npy'), values)
+                meta['arrays'][trace.name] = {'scale': scale, 'offset': offset}
+            elif(isinstance(value, np.ndarray)):
+                np.save(os.path.join(path, key + '.npy'), value)
+                meta['arrays'][key] = {}
+            elif(isinstance(value, System)):
+                meta['sys'] = {k: _json_scalar(k, v) for k, v in value.__dict__.items()}
+            else:
+                meta['scalars'][key] = _json_scalar(key, value)
+        with open(os.path.join(path, COLUMNAR_META), 'w') as f:
+            json.dump(meta, f, indent=1)
+
+        # A directory can not be renamed over another one, move the previous save out of the way first
+        if(os.path.exists(final_path)):
+            old_path = final_path + '.old'
+            if(os.path.exists(old_path)):
+                shutil.rmtree(old_path)
+            os.replace(final_path, old_path)
+            os.replace(path, final_path)
+            shutil.rmtree(old_path)
+        else:
+            os.replace(path, final_path)
+        return final_path
+
     @classmethod
-    def load(cls, filename):
+    def load(cls, filename, lazy=False):
         '''
-        Method to load the data from an NPZ for use by other programs
+        Method to load the data for use by other programs, filename can be a pickle or a columnar .ssa directory.
+        With lazy the arrays of a columnar file are memory mapped the first time they are used, pickles are
+        always read whole.
         '''
+        if(os.path.isdir(filename)):
+            return cls.load_columnar(filename, lazy)
         with open(filename, 'rb') as f:
             return pickle.load(f)
+
+    @classmethod
+    def load_columnar(cls, path, lazy=False):
+        with open(os.path.join(path, COLUMNAR_META), 'r') as f:
+            meta = json.load(f)
+        if(meta.get('format') != COLUMNAR_FORMAT or meta.get('version', 0) > COLUMNAR_VERSION):
+            raise ValueError('{} is {} version {}, this code reads {} up to version {}'.format(
+                path, meta.get('format'), meta.get('version'), COLUMNAR_FORMAT, COLUMNAR_VERSION))
+        data = cls.__new__(cls)
+        data.__dict__.update(meta['scalars'])
+        data.sys = System()
+        data.sys.__dict__.update(meta['sys'])
+        if('bookkeeping_version' not in meta['sys']):
+            data.sys.bookkeeping_version = System.bookkeeping_version
+        data.__dict__['_lazy_arrays'] = {name: (os.path.join(path, name + '.npy'), info) for name, info in meta['arrays'].items()}
+        if(not lazy):
+            data.load_arrays(mmap_mode=None)
+        return data
+
+    def load_arrays(self, mmap_mode='c'):
+        '''
+        Reads in every array of a lazily loaded file that has not been used yet
+        '''
+        for name in list(self.__dict__.get('_lazy_arrays', ())):
+            self._map_lazy(name, mmap_mode)
+        self.__dict__.pop('_lazy_arrays', None)
+
+    def _map_lazy(self, name, mmap_mode='c'):
+        # Copy on write maps, the arrays can be changed in memory without touching the file
+        lazy = self.__dict__.get('_lazy_arrays')
+        if(not lazy or name not in lazy):
+            return
+        filename, info = lazy.pop(name)
+        values = np.load(filename, mmap_mode=mmap_mode)
+        if(isinstance(type(self).__dict__.get(name), TraceArray)):
+            self.__dict__['_' + name] = (values, info.get('scale'), info.get('offset', 0.0))
+        else:
+            self.__dict__[name] = values
+
+    def __getattr__(self, name):
+        # Only called when the attribute is not found, which is the case for arrays not mapped yet
+        lazy = self.__dict__.get('_lazy_arrays')
+        if(lazy and name in lazy):
+            self._map_lazy(name)
+            return self.__dict__[name]
+        raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+
+
+def _json_scalar(name, value):
+    if(isinstance(value, np.generic)):
+        return value.item()
+    if(value is None or isinstance(value, (str, int, float, bool))):
+        return value
+    raise TypeError('Can not store {} of type {} in the columnar format'.format(name, type(value).__name__))
@@ -0,0 +1,177 @@
+#################################################################################
+#
+# Written by: Johnathon Gard, Erin Maloney
+# Purpose: Crash safe, streaming on disk copy of the phase0_0 bias sweep
+#
+# A sweep store is a directory holding one memory mapped .npy file per sweep
+# array, shaped (ncol, max_points, ...), plus a small header.json. Every bias
+# point is written into the maps in the order it was visited as soon as it has
+# been processed. Once the rows written since the last commit are flushed the
+# header is rewritten with the number of points each column has stored,
+# through a temporary file and an atomic rename, so the header never counts a
+# point that is not on disk. Only those rows are flushed, so a commit costs the
+# same at the end of a long sweep as at the start.
+#
+# If a sweep is stopped part way, SSA.phase0_0(resume=True) opens the newest
+# incomplete store, replays its points into the sweeps and carries on from
+# the next bias point.
+#
+#################################################################################
+
+import glob
+import json
+import mmap
+import os
+import numpy as np
+
+STORE_VERSION = 1
+HEADER = 'header.json'
+
+# name -> (dtype, has a trace axis)
+ARRAYS = {
+    'dac_sweep_array': (np.int32, False),
+    'phase0_0_vphis': (np.float64, True),
+    'phase0_0_vmod_max': (np.float64, False),
+    'phase0_0_vmod_min': (np.float64, False),
+    'phase0_0_vmod_sab': (np.float64, False),
+    'phase0_0_settle_ms': (np.float64, False),
+}
+
+# Baseline values of each column needed to rebuild the adaptive sweeps on resume
+BASELINES = ('baselines_std', 'baselines_range', 'baselines_average', 'baselines_SNR', 'baselines_noise_floor',
+             'baselines_n_blocks')
+BASELINE_ARRAYS = ('baselines_trace', 'baselines_psd', 'baselines_psd_freq')
+
+
+class SweepStore:
+
+    def __init__(self, path, header, mode='r+'):
+        self.path = path
+        self.header = header
+        self.arrays = {}
+        self.dirty = {}     # col -> (first, last) row written since the last commit
+        for name in ARRAYS:
+            self.arrays[name] = np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode=mode)
+
+    @classmethod
+    def create(cls, path, data, max_points, npts, sweep_conf):
+        '''
+        Make a new store at path sized for max_points bias points of npts long traces, data is the list of
+        SSA_Data_Class with its baselines already taken and sweep_conf the settings that pick the bias points
+        '''
+        os.makedirs(path)
+        ncol = len(data)
+        for name, (dtype, trace) in ARRAYS.items():
+            shape = (ncol, max_points, npts) if(trace) else (ncol, max_points)
+            np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+', dtype=dtype, shape=shape).flush()
+        for name in BASELINE_ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), np.array([getattr(d, name) for d in data]))
+
+        header = {
+            'version': STORE_VERSION,
+            'chip_ids': [d.chip_id for d in data],
+            'columns': [int(d.sys.channel_num) for d in data],
+            'max_points': int(max_points),
+            'npts': int(npts),
+            'sweep_conf': sweep_conf,
+            'baselines': {name: [float(getattr(d, name)) for d in data] for name in BASELINES},
+            'npoints': [0] * ncol,
+            'complete': False,
+        }
+        store = cls(path, header)
+        store.write_header()
+        return store
+
+    @classmethod
+    def open(cls, path):
+        with open(os.path.join(path, HEADER), 'r') as f:
+            header = json.load(f)
+        if(header.get('version') != STORE_VERSION):
+            raise ValueError('{} is sweep store version {}, expected {}'.format(path, header.get('version'), STORE_VERSION))
+        return cls(path, header)
+
+    @staticmethod
+    def find_latest(directory, pattern='*_phase0_0.sweep'):
+        '''
+        Newest store in directory that has not been marked complete, None if there are none
+        '''
+        for path in sorted(glob.glob(os.path.join(directory, pattern)), key=os.path.getmtime, reverse=True):
+            try:
+                with open(os.path.join(path, HEADER), 'r') as f:
+                    if(not json.load(f).get('complete', False)):
+                        return path
+            except (OSError, ValueError):
+                continue
+        return None
+
+    def check_matches(self, data, max_points, npts, sweep_conf):
+        '''
+        Raises ValueError if this store was not written by the same devices and sweep settings
+        '''
+        expected = {
+            'chip_ids': [d.chip_id for d in data],
+            'columns': [int(d.sys.channel_num) for d in data],
+            'max_points': int(max_points),
+            'npts': int(npts),
+            'sweep_conf': sweep_conf,
+        }
+        for key, value in expected.items():
+            if(self.header[key] != value):
+                raise ValueError('Can not resume from {}, {} was {} and is now {}'.format(self.path, key, self.header[key], value))
+
+    def restore_baselines(self, data):
+        # Stores written before the noise PSD was added only have some of these
+        arrays = {name: np.load(os.path.join(self.path, name + '.npy')) for name in BASELINE_ARRAYS
+                  if(os.path.exists(os.path.join(self.path, name + '.npy')))}
+        for col, d in enumerate(data):
+            for name in BASELINES:
+                if(name in self.header['baselines']):
+                    setattr(d, name, np.float64(self.header['baselines'][name][col]))
+            for name, values in arrays.items():
+                setattr(d, name, values[col])
+
+    def write_point(self, col, idx, data):
+        '''
+        Copy row idx of the phase0_0 arrays of the SSA_Data_Class data into column col of the store
+        '''
+        for name, values in self.arrays.items():
+            values[col, idx] = data.get_row(name, idx)
+        first, last = self.dirty.get(col, (idx, idx))
+        self.dirty[col] = (min(first, idx), max(last, idx))
+
+    def commit(self, npoints):
+        '''
+        Flush the points written since the last commit and then record npoints, the number stored for each column
+        '''
+        for values in self.arrays.values():
+            for col, (first, last) in self.dirty.items():
+                flush_rows(values, col, first, last + 1)
+        self.dirty.clear()
+        self.header['npoints'] = [int(n) for n in npoints]
+        self.write_header()
+
+    def finish(self):
+        self.header['complete'] = True
+        self.write_header()
+
+    def write_header(self):
+        tmp = os.path.join(self.path, HEADER + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.header, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, HEADER))
+
+
+def flush_rows(values, col, start, stop):
+    '''
+    Flushes rows start:stop of column col of a (ncol, max_points, ...) memmap to disk, not the whole map
+    '''
+    if(not isinstance(values.base, mmap.mmap)):
+        values.flush()
+        return
+    # np.memmap maps from the offset rounded down to the allocation granularity
+    begin = values.offset % mmap.ALLOCATIONGRANULARITY + col * values.strides[0] + start * values.strides[1]
+    end = begin + (stop - start) * values.strides[1]
+    begin -= begin % mmap.PAGESIZE
+    values.base.flush(begin, end - begin)
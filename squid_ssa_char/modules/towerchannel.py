@@ -1,10 +1,44 @@
 import sys
-from instruments import bluebox
+from squid_ssa_char.modules import serial_queue
+
+
+class ShadowRegisters:
+    '''
+    Last value written to every tower DAC, keyed by (address, channel). The tower can not be read back, so this
+    only holds while nothing else writes to the rack, invalidate() forgets values that may have gone stale.
+    With skip_redundant, writes of the value a DAC already holds are dropped.
+    '''
+    def __init__(self, skip_redundant=True):
+        self.skip_redundant = skip_redundant
+        self.values = {}
+        self.n_skipped = 0  # Writes dropped because the DAC already held the value
+
+    def get(self, address, channel, default=None):
+        return self.values.get((address, channel), default)
+
+    def needs_write(self, address, channel, value):
+        if(self.skip_redundant and self.values.get((address, channel)) == value):
+            self.n_skipped += 1
+            return False
+        return True
+
+    def update(self, address, channel, value):
+        self.values[(address, channel)] = value
+
+    def invalidate(self, address=None, channel=None):
+        '''
+        Forget the value of one DAC, or of every DAC when no address is given
+        '''
+        if(address is None):
+            self.values.clear()
+        else:
+            self.values.pop((address, channel), None)
 
 
 class TowerChannel:
     
-    def __init__(self, column=0, cardaddr=3, serialport="tower", shockvalue=65535):
+    def __init__(self, column=0, cardaddr=3, serialport="tower", shockvalue=65535, max_batch=0, batching=False,
+                 skip_redundant=False):
 
         self.COMMAND = '\033[95m'
         self.FCTCALL = '\033[94m'
@@ -26,13 +60,34 @@ class TowerChannel:
         self.serialport = serialport
         self.shockvalue = shockvalue
 
+        # Imported here so the module can be loaded on machines without the NIST instruments package
+        from instruments import bluebox
         self.bluebox = bluebox.BlueBox(port=serialport,
                                        version='tower',
                                        address=self.address,
                                        channel=self.column,
                                        shared=True)
+        # All writes to the bluebox go through the queue so that ramps can send a tick of DAC values
+        # in one write(), see hold(). With batching False it is a pass through that keeps the counts.
+        # BlueBox has no hook for this, the queue takes the place of its open serial port, so check it is there
+        port = getattr(self.bluebox, 'serialport', None)
+        if(port is None or not callable(getattr(port, 'write', None))):
+            raise RuntimeError('BlueBox {} has no open serialport with a write() to send the tower writes through, '
+                               'this version of the instruments package is not supported'.format(serialport))
+        self.queue = serial_queue.CommandQueue(port, max_batch=max_batch, batching=batching)
+        self.bluebox.serialport = self.queue
+        # What every DAC was last set to, ramps start from here and repeated values can be skipped
+        self.shadow = ShadowRegisters(skip_redundant)
+
+    def hold(self):
+        # Context manager, every value set inside the with block goes out in one serial write
+        return self.queue.hold()
 
     def set_value(self, dac_value):
+        address, channel, value = self.bluebox.address, self.bluebox.channel, int(dac_value)
+        if(not self.shadow.needs_write(address, channel, value)):
+            return
         if(self.verbosity > 3):
             print(("towerchannel.set_value() %g to addr %g, chn %g"%(dac_value, self.bluebox.address, self.bluebox.channel)))
-        self.bluebox.setVoltDACUnits(int(dac_value))
+        self.bluebox.setVoltDACUnits(value)
+        self.shadow.update(address, channel, value)
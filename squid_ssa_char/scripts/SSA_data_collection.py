@@ -12,41 +12,49 @@
 # System Level Imports
 # import sys
 import argparse
+import os
 import textwrap
 import numpy as np
 # import pandas as pd
 import time
 
 # Installed Package Imports
-import IPython
-import named_serial # Can be sourced from multiple repos at NIST
-import tqdm
+# tqdm and IPython are slow to import, they are imported where they are used: tqdm in phase0_0() and
+# IPython in main() when it is asked for with -i
 
 # Local Imports
-from squid_ssa_char.modules import load_conf_yaml, ssa_data_class, daq, towerchannel
+from squid_ssa_char.modules import load_conf_yaml, ssa_data_class, daq, towerchannel, simulator, bias_sweep, baseline_stats, instrument, pipeline, sweep_store, async_save, routing
 
 class SSA:
     '''
     #initializes class
     '''
-    def __init__(self, system_config_path, test_config_path, verbosity):
+    def __init__(self, system_config_path, test_config_path, verbosity, config_cache=False):
         '''
         Initializes the SSA class
         '''
-        # Configuration Dictionaries loaded from External Config Files
+        # Configuration Dictionaries loaded from External Config Files, read only, see load_conf_yaml.load_config()
         self._system_config_path = system_config_path
         self._test_config_path = test_config_path
-        self._conf_parser = load_conf_yaml.Load_Conf_YAML(test_config_path, system_config_path, verbosity)
+        self._conf_parser = load_conf_yaml.Load_Conf_YAML(test_config_path, system_config_path, verbosity,
+                                                          persist_cache=config_cache)
         self.sys_conf = self._conf_parser.read_system_config()
         self.test_conf = self._conf_parser.read_test_config()
         self.verbosity = verbosity        
         self.number_rows = self.test_conf['test_globals']['n_rows']
         self.sel_col = self.test_conf['test_globals']['columns'] # Array of the selected columns
         self.ncol = len(self.test_conf['test_globals']['columns'])   # length of the selectred columns
+        # With per_row every row of a column is its own device, otherwise the rows are averaged into one
+        self.per_row = self.test_conf['test_globals'].get('per_row', False)
         
-        self.data = [ssa_data_class.SSA_Data_Class()]
-        for i in range(self.ncol - 1):
-            self.data.append(ssa_data_class.SSA_Data_Class())
+        # One device per selected column, or per (column, row). devices[n] is the (column index, row) of
+        # data[n], the row is None when the rows are averaged. column_devices[col] lists the data indices on col.
+        if(self.per_row):
+            self.devices = [(col, row) for col in range(self.ncol) for row in range(self.number_rows)]
+        else:
+            self.devices = [(col, None) for col in range(self.ncol)]
+        self.column_devices = [[dev for dev, (c, _) in enumerate(self.devices) if c == col] for col in range(self.ncol)]
+        self.data = [ssa_data_class.SSA_Data_Class() for _ in self.devices]
         
         today = time.localtime()
         self.date = '{0:04d}_'.format(today.tm_year) + \
@@ -55,23 +63,139 @@ class SSA:
                     '{0:02d}'.format(today.tm_hour) + \
                     '{0:02d}'.format(today.tm_min)
         
+        # Resolve the column map once, a bad map is reported here before any hardware is touched
+        self.routes = routing.compile_routes(self.sys_conf, self.sel_col)
+
         self.bookkeeping()
 
-        self.serialport = named_serial.Serial(port='rack', shared=True)
-        self.tower = towerchannel.TowerChannel(cardaddr=0, column=0, serialport="tower")
-        self.daq = daq.Daq() # Defaults are fine, will reassign later
+        self.create_backends()
+        # Ask DASTARD for all of the averages at once instead of one period per request
+        self.daq.single_acquisition = self.test_conf['test_globals'].get('daq_single_acquisition', False)
+        # Keep only the selected columns of every DAQ buffer, daq_index[col] is where column index col ends up
+        if(self.test_conf['test_globals'].get('daq_select_columns', False)):
+            self.daq.columns = self.sel_col
+        self.daq_index = [self.daq.column_index(c) for c in self.sel_col]
+
+        # Timed spans of the ramps, settles, DAQ reads and processing, summarized after every phase and written
+        # to <date>_trace.json in trace_dir (see modules/instrument.py)
+        test_globals = self.test_conf['test_globals']
+        trace_dir = test_globals.get('trace_dir')
+        self.tracer = instrument.Tracer(enabled=test_globals.get('instrument', False),
+                                        path=os.path.join(trace_dir, self.date + '_trace.json') if(trace_dir) else None)
+        self.tracer.add_counter_source('tower', lambda: dict(self.tower.queue.stats(), skipped=self.tower.shadow.n_skipped))
+        self.tracer.add_counter_source('daq', self.daq.stats)
+        self.daq.tracer = self.tracer
         
 
+    # picks the serial port, tower and daq classes from the system config
+    def create_backends(self):
+        '''
+        Creates the serial port, tower and DAQ classes chosen by tower_type and daq_type in the system config.
+        NIST_TOWER and NIST_TDM talk to the rack and DASTARD, SIM uses the simulator module so the phases
+        can be run and profiled without any hardware.
+        '''
+        tower_type = self.sys_conf['system'].get('tower_type', 'NIST_TOWER')
+        daq_type = self.sys_conf['system'].get('daq_type', 'NIST_TDM')
+
+        # Both simulated parts share the rack so the DAQ can see the biases the tower wrote
+        self.sim_rack = simulator.SimRack()
+        sim_conf = dict(simulator.SIM_DEFAULTS)
+        sim_conf.update(self.sys_conf.get('simulator') or {})
+
+        # Tower writes made inside tower.hold() share one serial write when batching is on
+        batching = self.test_conf['test_globals'].get('serial_batching', False)
+        max_batch = self.test_conf['test_globals'].get('serial_max_batch', 0)
+        # Drop writes of the value a DAC already holds, the tower keeps a shadow of every value it wrote
+        skip_redundant = self.test_conf['test_globals'].get('tower_skip_redundant', False)
+
+        if(tower_type == 'NIST_TOWER'):
+            import named_serial # Can be sourced from multiple repos at NIST
+            self.serialport = named_serial.Serial(port='rack', shared=True)
+            self.tower = towerchannel.TowerChannel(cardaddr=0, column=0, serialport="tower",
+                                                   max_batch=max_batch, batching=batching,
+                                                   skip_redundant=skip_redundant)
+        elif(tower_type == 'SIM'):
+            self.serialport = None
+            self.tower = simulator.SimTowerChannel(self.sim_rack,
+                                                   write_latency_ms=sim_conf['serial_write_latency_ms'],
+                                                   baud=sim_conf['serial_baud'],
+                                                   max_batch=max_batch, batching=batching,
+                                                   skip_redundant=skip_redundant)
+        else:
+            raise ValueError('Unknown tower_type {} in the system config, expected NIST_TOWER or SIM'.format(tower_type))
+
+        if(daq_type == 'NIST_TDM'):
+            self.daq = daq.Daq() # Defaults are fine, will reassign later
+        elif(daq_type == 'SIM'):
+            # Keyed by column number, the mapped columns need not start at 0 or be contiguous
+            bias_map = {col: (route.bias_addr, route.bias_chan) for col, route in self.routes.items()}
+            client = simulator.SimEasyClient(self.sim_rack, bias_map, nrow=self.number_rows, params=sim_conf)
+            self.daq = daq.Daq(client=client)
+        else:
+            raise ValueError('Unknown daq_type {} in the system config, expected NIST_TDM or SIM'.format(daq_type))
+
+    # finds a tower card by its card number or by its name
+    def get_tower_card(self, card_ref):
+        '''
+        Returns the tower card config for card_ref, which can be the card number (card0..cardn) or the card name
+        '''
+        return routing.find_tower_card(self.sys_conf['tower'], card_ref)[1]
+
+    # tower address and channel of a column SA Bias
+    def get_sa_bias_route(self, channel):
+        '''
+        Returns the (tower address, tower channel) pair the SA Bias of the given column is wired to
+        '''
+        route = self.routes[channel]
+        return route.bias_addr, route.bias_chan
+
+    # the crate triangle is normally set up by hand with cringe
+    def configure_triangle(self, crate_conf):
+        '''
+        On a real system the crate triangle is set up with cringe before running a phase, so this only
+        has to tell the simulated DAQ what triangle the phase expects.
+        '''
+        if(hasattr(self.daq.c, 'set_triangle')):
+            self.daq.c.set_triangle(crate_conf['tri_steps'], crate_conf['tri_dwell'],
+                                    crate_conf['tri_step_size'], crate_conf['tri_output'])
+
+    # last value written to a column SA Bias, from the tower shadow registers
+    def get_sa_bias_voltage(self, channel, default=0):
+        '''
+        Returns the DAC value the SA Bias of the column was last set to, or default if that is not known because
+        nothing has been written yet or the cache was invalidated
+        '''
+        return self.tower.shadow.get(*self.get_sa_bias_route(channel), default=default)
+
+    # forget what the tower DACs hold, for when something else has touched the rack
+    def invalidate_tower_cache(self):
+        '''
+        Forgets every cached DAC value. The next write to each DAC goes out even if it repeats the old value and
+        ramps start from 0 again until resync_tower() or a write sets them.
+        '''
+        self.tower.shadow.invalidate()
+
+    # write known values so the cache matches the hardware again
+    def resync_tower(self, dac_value=0):
+        '''
+        Invalidates the cache and then writes dac_value to the SA Bias of every selected column, so the cache
+        and the rack agree again. The tower can not be read back, so this is done by setting the values.
+        '''
+        self.invalidate_tower_cache()
+        with self.tower.hold():
+            for i in self.sel_col:
+                self.set_sa_bias_voltage(i, dac_value)
+
     #connects to the tower and sets the dac voltage bias for each channel  
+    @instrument.traced('set_sa_bias_voltage', 'tower')
     def set_sa_bias_voltage(self, channel, dac_value):
         '''
         Connects to the tower then sets the DAC voltage bias. Needs the desired channel and DAC value passed to it.
         '''
         # reach in and assign the proper channel to the class
-        tower_map = self.sys_conf['col_map']['col'+str(channel)]['SA_Bias']
-        tower_card_ref = self.sys_conf['tower'][tower_map['tower_card']]
-        self.tower.bluebox.address = tower_card_ref['addr']
-        self.tower.bluebox.channel = tower_map['tower_col_n']
+        route = self.routes[channel]
+        self.tower.bluebox.address = route.bias_addr
+        self.tower.bluebox.channel = route.bias_chan
         if(self.verbosity > 2):
             print('    set_sa_bias_voltage(channel={}, dac_value={})'.format(channel, dac_value))
             print('        self.tower.bluebox.address = {}'.format(self.tower.bluebox.address))
@@ -80,17 +204,61 @@ class SSA:
         self.tower.set_value(dac_value)
     
     # runs dac voltage from set start value, often 0, to set end value
-    def ramp_to_voltage(self, channel, to_dac_value, from_dac_value=0, slew_rate=8):
+    @instrument.traced('ramp_to_voltage', 'tower')
+    def ramp_to_voltage(self, channel, to_dac_value, from_dac_value=None, slew_rate=8):
         '''
-        Ramps the DAC voltage from some start value, which has a defult of 0, to some end value. Needs the desired channel
-        and the ending DAC value passed in. The starting DAC value and the slew rate can also be passed but have defaults 
-        set (DAC start value = 0 and slew rate = 8)
+        Ramps the DAC voltage from some start value, which defaults to the value last written (0 if not known), to
+        some end value. Needs the desired channel and the ending DAC value passed in. The starting DAC value and the
+        slew rate can also be passed but have defaults set (DAC start value = last written and slew rate = 8)
         '''
-        
+        if(from_dac_value is None):
+            from_dac_value = self.get_sa_bias_voltage(channel)
+
         if self.verbosity > 0:
             print('ramp_to_voltage: Channel={}, from={}, to={}'.format(channel, from_dac_value, to_dac_value))
 
+        for bias in self.ramp_steps(to_dac_value, from_dac_value, slew_rate):
+            self.set_sa_bias_voltage(channel, bias)
+
+    # ramps a set of columns together, each to its own value
+    @instrument.traced('ramp_columns_to_voltage', 'tower')
+    def ramp_columns_to_voltage(self, to_dac_values, from_dac_values=None, slew_rate=8):
+        '''
+        Ramps several columns at once. to_dac_values is a dict of {column: ending DAC value} and from_dac_values is
+        either a dict of {column: starting DAC value}, one starting value for all of them or None (the default) to
+        start each column from the value last written to it.
+        Every column still ramping moves one slew step per tick, so each column sees exactly the same steps as
+        ramp_to_voltage() and the whole ramp takes as many ticks as the longest single ramp rather than the sum.
+        '''
+        ramps = {}
+        for channel, to_dac_value in to_dac_values.items():
+            if(isinstance(from_dac_values, dict)):
+                from_dac_value = from_dac_values[channel]
+            elif(from_dac_values is None):
+                from_dac_value = self.get_sa_bias_voltage(channel)
+            else:
+                from_dac_value = from_dac_values
+            if self.verbosity > 0:
+                print('ramp_columns_to_voltage: Channel={}, from={}, to={}'.format(channel, from_dac_value, to_dac_value))
+            ramps[channel] = self.ramp_steps(to_dac_value, from_dac_value, slew_rate)
+
+        # One tick of values across the columns goes out as a single serial write when batching
+        nticks = max([len(steps) for steps in ramps.values()], default=0)
+        for tick in range(nticks):
+            with self.tower.hold():
+                for channel, steps in ramps.items():
+                    if(tick < len(steps)):
+                        self.set_sa_bias_voltage(channel, steps[tick])
+
+    # list of the dac values a ramp goes through
+    @staticmethod
+    def ramp_steps(to_dac_value, from_dac_value=0, slew_rate=8):
+        '''
+        Returns the DAC values a ramp from from_dac_value to to_dac_value writes, in order. Steps are 2**slew_rate
+        and the last value is always to_dac_value.
+        '''
         bias = from_dac_value
+        steps = []
 
         if to_dac_value == from_dac_value:
             up = False
@@ -108,23 +276,60 @@ class SSA:
         if up:
             while (bias + dac_step) < to_dac_value:
                 bias = bias + dac_step
-                self.set_sa_bias_voltage(channel, bias)
+                steps.append(bias)
             
         if down:
             while (bias + dac_step) > to_dac_value:
                 bias = bias + dac_step
-                self.set_sa_bias_voltage(channel, bias)
+                steps.append(bias)
         
-        bias = to_dac_value
-        self.set_sa_bias_voltage(channel, bias)
+        steps.append(to_dac_value)
+        return steps
     
+    # waits for the system to settle after a bias change
+    @instrument.traced('wait_for_settle', 'settle')
+    def wait_for_settle(self, wait_ms):
+        '''
+        Waits for the system transient to settle after a bias change and returns how long that took in ms.
+        With settle_mode: fixed (the default) this just sleeps for wait_ms. With settle_mode: adaptive it takes short
+        DAQ reads until the mean error of every selected column changes by no more than settle_tolerance_adc for
+        settle_n_stable reads in a row, giving up after settle_max_ms (default wait_ms).
+        '''
+        conf = self.test_conf['test_globals']
+        if(conf.get('settle_mode', 'fixed') != 'adaptive'):
+            time.sleep(wait_ms / 1000.0)
+            return wait_ms
+
+        max_ms = conf.get('settle_max_ms', wait_ms)
+        tolerance = conf.get('settle_tolerance_adc', 1.0)
+        n_stable = conf.get('settle_n_stable', 2)
+        # Default to a full triangle period so the triangle itself averages out of the reads
+        npoints = conf.get('settle_read_points', 0) or self.daq.pointsPerSlice
+
+        start = time.perf_counter()
+        previous = self.daq.take_err_average(npoints)[self.daq_index]
+        stable = 0
+        while(stable < n_stable):
+            if((time.perf_counter() - start) * 1000.0 >= max_ms):
+                break
+            current = self.daq.take_err_average(npoints)[self.daq_index]
+            if(np.all(np.abs(current - previous) <= tolerance)):
+                stable += 1
+            else:
+                stable = 0
+            previous = current
+        settle_ms = (time.perf_counter() - start) * 1000.0
+
+        if(self.verbosity > 1):
+            print('wait_for_settle: {:.1f} ms, {}'.format(settle_ms, 'settled' if(stable >= n_stable) else 'hit settle_max_ms'))
+        return settle_ms
+
     #resets all values to zero or default
     def zero_everything(self):
         '''
-        Sets the DAC bias voltage to 0 for all columns
+        Sets the DAC bias voltage to 0 for all columns. The zeros always go out, whatever the tower cache holds
         '''
-        for i in self.sel_col:
-            self.set_sa_bias_voltage(i, 0)
+        self.resync_tower(0)
     
     #name of user
     def set_qa_name(self, qa_name):
@@ -132,70 +337,141 @@ class SSA:
         Pass in the initials of the person running the QA system
         '''
         self.qa_name = qa_name    
+
+    # where a device's data sits in the DAQ buffers
+    def device_key(self, dev):
+        '''
+        Index of device dev into the (ncol, nrow, ...) DAQ arrays, its column and row in per row mode.
+        Outside per row mode it is just the column, leaving the rows to be averaged or kept together.
+        '''
+        col, row = self.devices[dev]
+        if(row is None):
+            return (self.daq_index[col],)
+        return (self.daq_index[col], row)
+
+    # picks one device's entry out of an info setting
+    def device_setting(self, name, dev):
+        '''
+        Value of the info setting name for device dev. The settings have one entry per selected column, in per
+        row mode an entry can also be a list with one value per row.
+        '''
+        col, row = self.devices[dev]
+        value = self.test_conf['info'][name][col]
+        if(isinstance(value, (list, tuple))):
+            if(row is None):
+                raise ValueError('info {} has one entry per row for column {}, set per_row to use it'.format(name, self.sel_col[col]))
+            return value[row]
+        if(row is not None and name == 'chip_ids'):
+            raise ValueError('per_row needs one chip id per row, make info chip_ids entry {} a list'.format(col))
+        return value
+
+    # noise level a column's shared bias sweep is judged against
+    def column_baseline_std(self, col):
+        '''
+        Baseline std of column index col, the RMS of its devices' baselines_std in per row mode
+        '''
+        return np.sqrt(np.mean([self.data[dev].baselines_std**2 for dev in self.column_devices[col]]))
+
+    # what a column's bias sweep gets told about one bias point
+    def sweep_feedback(self, col, idx):
+        '''
+        (modulation depth, V-Phi std) of the average of the stored idx traces of every device on column index col.
+        The stored rows are used so a resumed sweep sees the same values whatever the storage_dtype.
+        '''
+        vphi = np.mean([self.data[dev].get_row('phase0_0_vphis', idx) for dev in self.column_devices[col]], axis=0)
+        return np.max(vphi) - np.min(vphi), np.std(vphi)
    
     # determines background noise level, assumes no rows active to start
-    def get_baselines(self, bias=0):
+    @instrument.traced('get_baselines', 'ssa')
+    def get_baselines(self, bias=0, n_blocks=1, nperseg=0, store_trace=True, lsync=None):
         '''
         Ramps the voltage to 0, unless some other value is passed, then stores the data at the desired DAC bias.
         The std, range, average, and signal-to-noise ratio are all calculated and stored for each column at the set DAC bias.
         This is done at bias = 0 to get the background/baseline levels for better accuracy later.
+        The statistics are built up over n_blocks DAQ blocks of n_avg periods, one block at a time (see
+        modules/baseline_stats.py). std, range and average are of the period averaged traces, the same as the
+        vphis they are compared against, while the noise PSD is of the raw error data in nperseg long
+        segments (0 for one triangle period). With lsync the PSD is in counts**2/Hz, otherwise per cycle/sample.
+        store_trace keeps the averaged trace of the last block in baselines_trace. In per row mode every row
+        gets its own statistics and spectrum.
         '''
         
-        for i in self.sel_col:
-            self.ramp_to_voltage(i, bias)
+        self.ramp_columns_to_voltage({i: bias for i in self.sel_col})
         
-        time.sleep(self.test_conf['test_globals']['bias_change_wait_ms'] / 1000.0)
-
-        fb, err = self.daq.take_average_data()
-
-        print("Baseline Noise Data\n"
+        self.wait_for_settle(self.test_conf['test_globals']['bias_change_wait_ms'])
+
+        sample_rate = None
+        if(lsync):
+            sample_rate = getattr(self.daq.c, 'clockmhz', 125) * 1e6 / (lsync * self.daq.c.nrow)
+        keep = 2 if(self.per_row) else 1
+        moments = baseline_stats.RunningMoments(keep)
+        psd = baseline_stats.WelchPSD(nperseg if(nperseg) else self.daq.pointsPerSlice, sample_rate, keep)
+        for _ in range(max(n_blocks, 1)):
+            err_raw, err = self.daq.take_err_block()
+            moments.update(err)
+            psd.update(err_raw)
+        noise_floor = psd.noise_floor()
+
+        print("Baseline Noise Data, {} blocks\n".format(max(n_blocks, 1))
             + "Column | "
+            + ("Row | " if(self.per_row) else "")
             + "\tStd Deivation | "
             + "\tRange | "
             + "\tAverage | "
-            + "\tStd/Avg SNR |")
+            + "\tStd/Avg SNR | "
+            + "\tPSD Floor |")
         
-        for col in range(self.ncol):
-            print("{:6d} | ".format(self.data[col].sys.channel_num), end="", flush=True)
-            self.data[col].baselines_std = np.std(err[self.sel_col[col]])
-            print("\t{:13.3f} | ".format(self.data[col].baselines_std), end="", flush=True)
-            self.data[col].baselines_range = np.max(err[self.sel_col[col]]) - np.min(err[self.sel_col[col]])
-            print("\t{:5.2f} | ".format(self.data[col].baselines_range), end="", flush=True)
-            self.data[col].baselines_average = np.average(err[self.sel_col[col]])
-            print("\t{:7.3f} | ".format(self.data[col].baselines_average), end="", flush=True)
-            self.data[col].baselines_SNR = self.data[col].baselines_average/self.data[col].baselines_std
-            print("\t{:11.3f} | ".format(self.data[col].baselines_SNR), flush=True)
-            self.data[col].baselines_trace = err[self.sel_col[col]]
+        for dev, data in enumerate(self.data):
+            key = self.device_key(dev)
+            print("{:6d} | ".format(data.sys.channel_num), end="", flush=True)
+            if(self.per_row):
+                print("{:3d} | ".format(self.devices[dev][1]), end="", flush=True)
+            data.baselines_std = moments.std[key]
+            print("\t{:13.3f} | ".format(data.baselines_std), end="", flush=True)
+            data.baselines_range = moments.range[key]
+            print("\t{:5.2f} | ".format(data.baselines_range), end="", flush=True)
+            data.baselines_average = moments.mean[key]
+            print("\t{:7.3f} | ".format(data.baselines_average), end="", flush=True)
+            data.baselines_SNR = data.baselines_average/data.baselines_std
+            print("\t{:11.3f} | ".format(data.baselines_SNR), end="", flush=True)
+            data.baselines_n_blocks = max(n_blocks, 1)
+            data.baselines_psd = psd.psd[key]
+            data.baselines_psd_freq = psd.freq
+            data.baselines_noise_floor = noise_floor[key]
+            print("\t{:9.3g} |".format(data.baselines_noise_floor), flush=True)
+            if(store_trace):
+                data.baselines_trace = err[key]
     
+    @instrument.traced('calculate_ics', 'ssa')
     def calculate_ics(self):
-        '''takes bias sweep results, picks off Icmin when peaks occur, picks vmod and icmax when modulation amplitude is max'''
+        '''takes bias sweep results, picks off Icmin when peaks occur, picks vmod and icmax when modulation amplitude is max
+        Each device is done on its own, in per row mode that is every row of every column.'''
         # Print header for usefull stuff to the console
         print("Calculating IC Parameters\n"
             + "Column | "
+            + ("Row | " if(self.per_row) else "")
             + "\tICMax_IDX | "
             + "\tICMin_IDX | "
             + "\tICMax_DAC | "
             + "\tICMin_DAC |")
         for col in self.data:
             print("{:6d} | ".format(col.sys.channel_num), end="", flush=True)
-
-            # Determine Ic_max based on Vmod depths
-            icmax_idx = col.phase0_0_vmod_sab.argmax()
-            print("\t{:9d} | ".format(icmax_idx), end="", flush=True)
+            if(self.per_row):
+                print("{:3d} | ".format(col.sys.row_num), end="", flush=True)
 
             # For finding Ic_min take the std of the traces at each bias point
             vphi_std = np.std(col.phase0_0_vphis, axis=1)
 
-            # find all of the indices less than n times the std, and take the greatest index. limit to below icmax to avoid rail issues
-            if(icmax_idx != 0):
-                icmin_idx = np.where(vphi_std[:icmax_idx] < col.baselines_std * self.test_conf['phase0_0']['icmin_pickoff'])[-1][-1]
-            else:
-                icmin_idx = len(col.dac_sweep_array) - 1
-            print("\t{:9d} | ".format(icmin_idx), end="", flush=True)
+            # Ic_max is at the largest Vmod depth. For Ic_min find all of the indices less than n times the std, and
+            # take the greatest index. limit to below icmax to avoid rail issues
+            icmax_idx, icmin_idx = bias_sweep.find_ic_indices(col.phase0_0_vmod_sab, vphi_std,
+                                                               col.baselines_std * self.test_conf['phase0_0']['icmin_pickoff'])
+            print("\t{:9d} | ".format(icmax_idx), end="", flush=True)
+            print("\t{:>9s} | ".format('none' if(icmin_idx is None) else str(icmin_idx)), end="", flush=True)
 
-            # If the found index is the last point in the sweep array, we really didn't find the Ic_min
-            # so set it to the max DAC value the system can have
-            if (icmin_idx == (len(col.dac_sweep_array) - 1)):
+            # If no point below Ic_max is flat we really didn't find the Ic_min, so set it to the max DAC value
+            # the system can have rather than report the start of the sweep
+            if (icmin_idx is None):
                 col.dac_ic_min = 2**16 - 1
             else:
                 col.dac_ic_min = col.dac_sweep_array[icmin_idx]
@@ -206,68 +482,79 @@ class SSA:
                 col.dac_ic_max = col.dac_sweep_array[icmax_idx]
             print("\t{:9d} | ".format(col.dac_ic_max), end="", flush=True)
             print("\t{:9d} |".format(col.dac_ic_min), flush=True)
+            if (icmin_idx is None):
+                print("WARNING: no bias point below Ic_max has a V-Phi std under the icmin_pickoff threshold, "
+                      + "Ic_min not found, stored as {}".format(col.dac_ic_min))
 
     def bookkeeping(self):
         '''This will copy values from the config files to the SSA data structures. These values will be used to either 
         identify the devices, convert units to base units (uA and mV) and so forth.
         '''
-        for idx in range(self.ncol):
-            chan_num = int(self.test_conf['test_globals']['columns'][idx])
+        for idx, (col, row) in enumerate(self.devices):
+            chan_num = int(self.test_conf['test_globals']['columns'][col])
             self.data[idx].qa_name = self.test_conf['info']['user']
-            self.data[idx].chip_id = self.test_conf['info']['chip_ids'][idx]
+            self.data[idx].chip_id = self.device_setting('chip_ids', idx)
             self.data[idx].system_name = self.test_conf['info']['system']
-            self.data[idx].chip_flavor = self.test_conf['info']['chip_flavor'][idx]
-            self.data[idx].SSA_type = self.test_conf['info']['SSA_type'][idx]
+            self.data[idx].chip_flavor = self.device_setting('chip_flavor', idx)
+            self.data[idx].SSA_type = self.device_setting('SSA_type', idx)
             self.data[idx].timestamp = self.date
-            self.data[idx].file_name = self.test_conf['info']['chip_ids'][idx] + '_' + \
-                self.date + '_chan{0:02}'.format(self.test_conf['test_globals']['columns'][idx])
-            self.data[idx].sys.channel_num = self.test_conf['test_globals']['columns'][idx]
+            self.data[idx].storage_dtype = self.test_conf['test_globals'].get('storage_dtype', 'float64')
+            if(self.data[idx].storage_dtype not in ssa_data_class.STORAGE_DTYPES):
+                raise ValueError('Unknown storage_dtype {}, expected one of {}'.format(
+                    self.data[idx].storage_dtype, ', '.join(ssa_data_class.STORAGE_DTYPES)))
+            self.data[idx].file_name = self.data[idx].chip_id + '_' + self.date + '_chan{0:02}'.format(chan_num)
+            if(row is not None):
+                self.data[idx].file_name += '_row{0:02}'.format(row)
+            self.data[idx].sys.channel_num = chan_num
+            self.data[idx].sys.row_num = row
             self.data[idx].test_conf_path = self._test_config_path
             self.data[idx].system_conf_path = self._system_config_path
-            # Make temp vars to hold info about the card mapping
-            sa_bias_card = self.sys_conf['col_map']['col' + str(chan_num)]['SA_Bias']
-            input_card = self.sys_conf['col_map']['col' + str(chan_num)]['SA_Input']
-            feedback_card = self.sys_conf['col_map']['col' + str(chan_num)]['SA_FB']
-            crate_info = self.sys_conf['col_map']['col' + str(chan_num)]['DAQ']
-            # Now that we have the map, let us copy things into the data class
+            # The routing table has the card mapping resolved, copy things into the data class
+            route = self.routes[chan_num]
+            sys_info = self.data[idx].sys
             #   Pre-Amp with SA Bias DACs
-            self.data[idx].sys.amp_bias_r = self.sys_conf['tower'][sa_bias_card['tower_card']]['bias_R'][int(sa_bias_card['tower_col_n'])]
-            self.data[idx].sys.amp_gain = self.sys_conf['tower'][sa_bias_card['tower_card']]['gain_effective'][int(sa_bias_card['tower_col_n'])]
-            self.data[idx].sys.amp_dac_vref = self.sys_conf['tower'][sa_bias_card['tower_card']]['dac_ref_v']
-            self.data[idx].sys.amp_dac_nbits = self.sys_conf['tower'][sa_bias_card['tower_card']]['dac_nbits']
-            self.data[idx].sys.amp_dac_gain = self.sys_conf['tower'][sa_bias_card['tower_card']]['dac_gain']
+            sys_info.amp_bias_r = route.sa_bias.bias_r
+            sys_info.amp_gain = route.sa_bias.gain
+            sys_info.amp_dac_vref = route.sa_bias.dac_ref_v
+            sys_info.amp_dac_nbits = route.sa_bias.dac_nbits
+            sys_info.amp_dac_gain = route.sa_bias.dac_gain
             #   Feedback Tower Bias Card though the DACs are not user here
-            self.data[idx].sys.fb_bias_r = self.sys_conf['tower'][feedback_card['tower_card']]['bias_R'][int(feedback_card['tower_col_n'])]
-            self.data[idx].sys.fb_dac_vref = self.sys_conf['tower'][feedback_card['tower_card']]['dac_ref_v']
-            self.data[idx].sys.fb_dac_nbits = self.sys_conf['tower'][feedback_card['tower_card']]['dac_nbits']
-            self.data[idx].sys.fb_dac_nbits = self.sys_conf['tower'][feedback_card['tower_card']]['dac_gain']
-             #   Feedback Tower Bias Card though the DACs are not user here
-            self.data[idx].sys.in_bias_r = self.sys_conf['tower'][input_card['tower_card']]['bias_R'][int(input_card['tower_col_n'])]
-            self.data[idx].sys.in_dac_vref = self.sys_conf['tower'][input_card['tower_card']]['dac_ref_v']
-            self.data[idx].sys.in_dac_nbits = self.sys_conf['tower'][input_card['tower_card']]['dac_nbits']
-            self.data[idx].sys.in_dac_nbits = self.sys_conf['tower'][input_card['tower_card']]['dac_gain']    
+            sys_info.fb_bias_r = route.sa_fb.bias_r
+            sys_info.fb_dac_vref = route.sa_fb.dac_ref_v
+            sys_info.fb_dac_nbits = route.sa_fb.dac_nbits
+            sys_info.fb_dac_gain = route.sa_fb.dac_gain
+            #   Input Tower Bias Card though the DACs are not user here
+            sys_info.in_bias_r = route.sa_input.bias_r
+            sys_info.in_dac_vref = route.sa_input.dac_ref_v
+            sys_info.in_dac_nbits = route.sa_input.dac_nbits
+            sys_info.in_dac_gain = route.sa_input.dac_gain
             #   Crate DAQ Channel ADC
-            self.data[idx].sys.daq_adc_nbits = self.sys_conf['crate'][crate_info['card']]['adc_n_bits']
-            self.data[idx].sys.daq_adc_vrange = self.sys_conf['crate'][crate_info['card']]['adc_vin_range']
-            self.data[idx].sys.daq_adc_gain = self.sys_conf['crate'][crate_info['card']]['input_gain']
-            #   Crate DAQ Channel DAC
-            self.data[idx].sys.daq_dac_nbits = self.sys_conf['crate'][crate_info['card']]['dac_n_bits']
-            self.data[idx].sys.in_dac_vref = self.sys_conf['crate'][crate_info['card']]['dac_vout_range']
-            self.data[idx].sys.daq_dac_gain = self.sys_conf['crate'][crate_info['card']]['dac_gain']
+            sys_info.daq_adc_nbits = route.daq.adc_nbits
+            sys_info.daq_adc_vrange = route.daq.adc_vrange
+            sys_info.daq_adc_gain = route.daq.adc_gain
+            #   Crate DAQ Channel DAC, it makes the triangles on FB and IN
+            sys_info.daq_dac_nbits = route.daq.dac_nbits
+            sys_info.daq_dac_vref = route.daq.dac_vref
+            sys_info.daq_dac_gain = route.daq.dac_gain
 
     # send triangle down fb to get baselines, sweep bias, pick off icmin, icmax and vmod
-    def phase0_0(self):
+    @instrument.traced_phase('phase0_0')
+    def phase0_0(self, resume=False):
         '''
         Sweep SQUID SSA Bias and extract ADC_min, ADC_max, and ADC_modulation depth
         The units will be left in ADC units reported by DASTARD
         The sweep end point is in the test config file and is determined by the SSA design
+        bias_sweep_type picks how the bias points are chosen (see modules/bias_sweep.py). The adaptive types
+        visit fewer, non-uniform points that can differ per column, dac_sweep_array holds the points visited.
+        With stream_to_disk each point is also written to a sweep store in stream_dir as soon as it is taken
+        (see modules/sweep_store.py). Stores are left on disk when the sweep completes, delete them once
+        save_data() has written the data. resume=True carries on from the newest incomplete store in stream_dir,
+        or resume can be the path of the store to continue.
+        In per row mode the rows of a column still share its SA Bias and so one bias sweep, steered by the
+        average of the rows, but every row is stored as its own device.
         '''
         # gather variables from configs
         phase_conf = self.test_conf['phase0_0']
-        sa_bias_sweep_val = np.linspace(phase_conf['bias_sweep_start'], 
-                                        phase_conf['bias_sweep_end'], 
-                                        phase_conf['bias_sweep_npoints'],
-                                        dtype=np.int32) # start, stop, num
         
         #used to set up proper data structure size, calculate the number of points in the full triangle response
         npts_data = (2**phase_conf['crate']['tri_steps'])*(2**phase_conf['crate']['tri_dwell']) * 2 # mult by two because of triangle no sawtooth
@@ -275,53 +562,174 @@ class SSA:
         # Set the DAQ to appropriate values 
         self.daq.pointsPerSlice = npts_data
         self.daq.averages = phase_conf['n_avg']
+        self.configure_triangle(phase_conf['crate'])
 
-        #initiates data storage arrays through data classes
-        for i in self.data:
-            i.dac_sweep_array = sa_bias_sweep_val
-            i.sa_bias_start = phase_conf['bias_sweep_start']
-            i.sa_bias_stop = phase_conf['bias_sweep_end']
-            i.phase0_0_vphis = np.zeros((phase_conf['bias_sweep_npoints'], npts_data))
-            i.phase0_0_vmod_max = np.zeros(phase_conf['bias_sweep_npoints'])
-            i.phase0_0_vmod_min = np.zeros(phase_conf['bias_sweep_npoints'])
-            i.phase0_0_vmod_sab = np.zeros(phase_conf['bias_sweep_npoints'])
-
-        # Zero all of the columns and then grab the baseline data
+        # Zero all of the columns and then grab the baseline data, the adaptive sweeps need the noise level.
+        # A resumed sweep keeps the baselines it started with so its sweeps pick the same points again.
+        stream_dir = phase_conf.get('stream_dir', '.')
+        store = None
         self.zero_everything()
-        self.get_baselines()
-
-        # Assign the starting point for the bias sweep (same from config and sa_bias_sweep_val)
-        # This will then be used as the previous value for the ramp_to_voltage call
-        previous_bias = phase_conf['bias_sweep_start']
-
-        print("Phase0_0 Bias Sweep")
-        # Main outter for loop wrapped with tqdm class to display a progress bar and estimated time
-        for sweep_point in tqdm.tqdm(range(phase_conf['bias_sweep_npoints'])):
-            
-            # Go thru the columns and ramp the voltage to the desired value form the previous value
-            for col in self.sel_col:
-                self.ramp_to_voltage(col, sa_bias_sweep_val[sweep_point], previous_bias)         
+        if(resume):
+            path = resume if(isinstance(resume, str)) else sweep_store.SweepStore.find_latest(stream_dir)
+            if(path is None):
+                raise ValueError('No incomplete phase0_0 sweep store to resume in {}'.format(os.path.abspath(stream_dir)))
+            print("Resuming phase0_0 from {}".format(path))
+            store = sweep_store.SweepStore.open(path)
+            store.restore_baselines(self.data)
+        else:
+            self.get_baselines(n_blocks=phase_conf.get('baseline_n_blocks', 1),
+                               nperseg=phase_conf.get('baseline_psd_nperseg', 0),
+                               store_trace=phase_conf.get('baseline_store_trace', True),
+                               lsync=phase_conf['crate'].get('lsync'))
 
-            # Sleep to let system transient settle out before taking data
-            time.sleep(phase_conf['bias_change_wait_ms'] / 1000.0)
+        # One sweep per column, the Icmin threshold is the same one calculate_ics() uses
+        sweeps = [bias_sweep.make_sweep(phase_conf, self.column_baseline_std(col) * phase_conf['icmin_pickoff'], col)
+                  for col in range(self.ncol)]
+        max_points = max([sweep.max_points for sweep in sweeps])
 
-            # Take data that has been rolled and then averaged accross all of the rows
-            _, err = self.daq.take_average_data_roll(avg_all_rows=True)
-            
-            # Move the gathered data to appropriate arrays and calculate min, max, values
-            for col in range(self.ncol):
-                self.data[col].phase0_0_vphis[sweep_point] = err[self.sel_col[col]]
-                self.data[col].phase0_0_vmod_max[sweep_point] = np.max(err[self.sel_col[col]])
-                self.data[col].phase0_0_vmod_min[sweep_point] = np.min(err[self.sel_col[col]])
-                self.data[col].phase0_0_vmod_sab[sweep_point] = np.abs(self.data[col].phase0_0_vmod_max[sweep_point] - self.data[col].phase0_0_vmod_min[sweep_point])
-            
-            # the current sweep bias value now becomes the previous value
-            previous_bias = sa_bias_sweep_val[sweep_point]
+        #initiates data storage arrays through data classes, sized for the most points a sweep can visit
+        for i in self.data:
+            i.dac_sweep_array = np.zeros(max_points, dtype=np.int32)
+            i.sa_bias_start = phase_conf['bias_sweep_start']
+            i.sa_bias_stop = phase_conf['bias_sweep_end']
+            i.init_trace('phase0_0_vphis', (max_points, npts_data))
+            i.phase0_0_vmod_max = np.zeros(max_points)
+            i.phase0_0_vmod_min = np.zeros(max_points)
+            i.phase0_0_vmod_sab = np.zeros(max_points)
+            i.phase0_0_settle_ms = np.zeros(max_points)
+        npoints = [0] * self.ncol   # Number of points stored for each column, the same for all of its devices
+
+        # Everything that decides which bias points get visited, a store can only be resumed with the same
+        sweep_conf = {key: phase_conf.get(key) for key in ('bias_sweep_type', 'bias_sweep_start', 'bias_sweep_end',
+                                                           'bias_sweep_npoints', 'bias_sweep_coarse_npoints', 'icmin_pickoff',
+                                                           'early_stop', 'early_stop_fall_fraction', 'early_stop_fall_points')}
+        if(store is not None):
+            store.check_matches(self.data, max_points, npts_data, sweep_conf)
+            self.replay_sweep(store, sweeps, npoints)
+        elif(phase_conf.get('stream_to_disk', False)):
+            path = os.path.join(stream_dir, time.strftime('%Y_%m_%d_%H%M%S') + '_phase0_0.sweep')
+            store = sweep_store.SweepStore.create(path, self.data, max_points, npts_data, sweep_conf)
+            print("Streaming phase0_0 to {}".format(path))
+
+        # Assign the starting point for the bias sweep
+        # This will then be used as the previous value for the ramp_columns_to_voltage call
+        previous_bias = {col: phase_conf['bias_sweep_start'] for col in self.sel_col}
+
+        # Rolling, averaging and storing a point can run on a worker thread while the next point is ramped
+        # and settled. The adaptive sweeps need each result before they can pick their next point, so for
+        # those the loop waits for the worker to catch up before asking.
+        pipelined = phase_conf.get('pipeline', False)
+        needs_feedback = any([sweep.needs_feedback for sweep in sweeps])
+
+        def process_point(point):
+            raw, targets, active, settle_ms = point
+            # Roll the data and then average accross all of the rows, unless every row is a device
+            _, err = self.daq.process_average_roll(raw, avg_all_rows=not self.per_row)
+
+            # Move the gathered data to appropriate arrays and let each sweep pick its next point
+            for col in active:
+                # Pipelined linear sweeps can be a few points past an early stop, those are dropped
+                if(sweeps[col].stopped):
+                    continue
+                for dev in self.column_devices[col]:
+                    self.store_sweep_point(dev, npoints[col], targets[col], err[self.device_key(dev)], settle_ms)
+                    if(store is not None):
+                        store.write_point(dev, npoints[col], self.data[dev])
+                sweeps[col].record(targets[col], *self.sweep_feedback(col, npoints[col]))
+                npoints[col] += 1
+            if(store is not None):
+                store.commit([npoints[col] for col, _ in self.devices])
+
+        print("Phase0_0 Bias Sweep ({}{})".format(phase_conf.get('bias_sweep_type', 'linear'), ', pipelined' if(pipelined) else ''))
+        # Main loop with a tqdm progress bar, runs until every column's sweep is done
+        import tqdm
+        progress = tqdm.tqdm(total=max_points, initial=max(npoints))
+        settle_total_ms = 0.0   # Time spent settling, the columns settle together so this is not the sum over devices
+        with pipeline.Pipeline(process_point, maxsize=phase_conf.get('pipeline_depth', 2), threaded=pipelined) as stage:
+            while True:
+                if(needs_feedback):
+                    stage.wait()
+                targets = [sweep.next_bias() for sweep in sweeps]
+                active = [col for col in range(self.ncol) if targets[col] is not None]
+                if(len(active) == 0):
+                    break
+
+                # Ramp all of the columns together to their next value, columns that are done hold where they are
+                bias = dict(previous_bias)
+                for col in active:
+                    bias[self.sel_col[col]] = targets[col]
+                self.ramp_columns_to_voltage(bias, previous_bias)
+
+                # Let system transient settle out before taking data
+                settle_ms = self.wait_for_settle(phase_conf['bias_change_wait_ms'])
+                settle_total_ms += settle_ms
+
+                # Only the acquisition happens here, the processing is handed to the pipeline stage
+                stage.put((self.daq.acquire_average_roll(), targets, active, settle_ms))
+
+                # the current sweep bias value now becomes the previous value
+                previous_bias = bias
+                progress.update(1)
+        progress.close()
+        if(store is not None):
+            store.finish()
+
+        # Trim the arrays down to the points visited, sorted by bias, and note where each sweep stopped
+        for dev, (col, _) in enumerate(self.devices):
+            data = self.data[dev]
+            data.phase0_0_stop_bias = data.dac_sweep_array[npoints[col] - 1] if(npoints[col] > 0) else 0
+            data.phase0_0_stop_reason = 'end of sweep'
+            early_stop = sweeps[col].early_stop
+            if(early_stop is not None and early_stop.done):
+                data.phase0_0_stop_bias = early_stop.stop_bias
+                data.phase0_0_stop_reason = early_stop.stop_reason
+            if(self.verbosity > 0 or early_stop is not None):
+                print("Column {}: stopped at bias {}, {}".format(data.sys.channel_num, data.phase0_0_stop_bias, data.phase0_0_stop_reason))
+            data.finish_sweep(npoints[col])
+
+        # Every device records the settle of each point it took, a sweep that took no points has nothing to report
+        settle_ms = np.concatenate([data.phase0_0_settle_ms for data in self.data])
+        if(len(settle_ms) > 0):
+            print("Settle time per point over {} devices [ms]: min {:.1f}, median {:.1f}, max {:.1f}, waited {:.1f} s".format(
+                len(self.data), np.min(settle_ms), np.median(settle_ms), np.max(settle_ms), settle_total_ms / 1000.0))
 
         # Calc ics for the next two phases to use
         self.calculate_ics()
 
+    def replay_sweep(self, store, sweeps, npoints):
+        '''
+        Copies the points saved in a sweep store back into the data classes and feeds them to the sweeps in the
+        order they were taken, so the sweeps continue as if they had never stopped. npoints is updated in place.
+        '''
+        for col, sweep in enumerate(sweeps):
+            devs = self.column_devices[col]
+            for idx in range(min([store.header['npoints'][dev] for dev in devs])):
+                bias = sweep.next_bias()
+                if(bias != store.arrays['dac_sweep_array'][devs[0], idx]):
+                    raise ValueError('Sweep store {} does not match the sweep of column {} at point {}'.format(store.path, col, idx))
+                for dev in devs:
+                    for name in self.data[dev].PHASE0_0_SWEEP_ARRAYS:
+                        self.data[dev].set_row(name, idx, store.arrays[name][dev, idx])
+                sweep.record(bias, *self.sweep_feedback(col, idx))
+                npoints[col] = idx + 1
+        print("Replayed {} stored points per column".format(npoints))
+
+    # copies one bias point of one device into its data class
+    def store_sweep_point(self, dev, idx, bias, err, settle_ms):
+        '''
+        Stores the averaged error trace err taken at bias in row idx of the phase0_0 arrays of device dev
+        and calculates min, max and modulation depth
+        '''
+        data = self.data[dev]
+        data.dac_sweep_array[idx] = bias
+        data.set_row('phase0_0_vphis', idx, err)
+        data.phase0_0_vmod_max[idx] = np.max(err)
+        data.phase0_0_vmod_min[idx] = np.min(err)
+        data.phase0_0_vmod_sab[idx] = np.abs(data.phase0_0_vmod_max[idx] - data.phase0_0_vmod_min[idx])
+        data.phase0_0_settle_ms[idx] = settle_ms
+
     #work to get Mfb. ramp to icmax dac voltage then store the vphis
+    @instrument.traced_phase('phase0_1')
     def phase0_1(self):
         '''
         Biases squids to ADC_max value then stores the vphis and the triangle
@@ -336,31 +744,18 @@ class SSA:
         # Set the DAQ to appropriate values 
         self.daq.pointsPerSlice = npts_data
         self.daq.averages = phase_conf['n_avg']
+        self.configure_triangle(phase_conf['crate'])
 
-        # Zero all the columns
-        self.zero_everything()
+        # Zero the columns first unless told not to, without it the ramp starts from the cached bias which is
+        # only right while nothing else has written to the rack
+        if(phase_conf.get('zero_before_bias', True)):
+            self.zero_everything()
 
         print("Phase0_1 Bias to IC_Max and Save VPhi with Triagnle on SSA_FB")
-        try:
-            # Loop through the columns and ramp up to the icmax dac voltages        
-            for col in range(self.ncol):
-                self.ramp_to_voltage(self.sel_col[col], self.data[col].dac_ic_max)
-        except Exception as e:
-            print(e)
-            print('Likely Icmax is 0 - try again')
-        else:
-            # Sleep to let system transient settle out before taking data
-            time.sleep(phase_conf['bias_change_wait_ms'] / 1000.0)
-            
-            #Take data that has been rolled then averaged across all rows
-            fb, err = self.daq.take_average_data_roll(avg_all_rows=True)
-            
-            #store gathered data for processing
-            for col in range(self.ncol):
-                self.data[col].phase0_1_icmax_vphi = err[self.sel_col[col]]
-                self.data[col].phase0_1_triangle = fb[self.sel_col[col]]
+        self.take_icmax_vphis(phase_conf, 'phase0_1_icmax_vphi', 'phase0_1_triangle')
 
     #send triangle down input to get min then store the vphis
+    @instrument.traced_phase('phase1_0')
     def phase1_0(self):
         '''
         Sends signal to the inputs, biases the squids to ADC_max, then stores the vphis and the triangle
@@ -375,38 +770,64 @@ class SSA:
         # Set the DAQ to appropriate values 
         self.daq.pointsPerSlice = npts_data
         self.daq.averages = phase_conf['n_avg']
+        self.configure_triangle(phase_conf['crate'])
 
-        #zero all the columns
-        self.zero_everything()
+        # Zero the columns first unless told not to, without it the ramp starts from the cached bias which is
+        # only right while nothing else has written to the rack
+        if(phase_conf.get('zero_before_bias', True)):
+            self.zero_everything()
 
         print("Phase1_0 Bias to IC_Max and Save VPhi with Triagnle on SSA_INPUT")
-        try:
-            #loop throught the columns and ramp up to the icmax dac voltage
-            for col in range(self.ncol):
-                self.ramp_to_voltage(self.sel_col[col], self.data[col].dac_ic_max)
-        except Exception as e:
-            print(e)
-            print('Likely Icmax is 0 - try again')
-        else:
-            #sleep to let system transient settle out before taking data
-            time.sleep(phase_conf['bias_change_wait_ms'] / 1000.0)
+        self.take_icmax_vphis(phase_conf, 'phase1_0_icmax_vphi', 'phase1_0_triangle')
 
-            #take data that has been rolled then averaged across all rows
-            fb, err = self.daq.take_average_data_roll(avg_all_rows=True)
+    # bias every device to its icmax and keep the vphi and triangle, shared by phase0_1 and phase1_0
+    def take_icmax_vphis(self, phase_conf, vphi_name, triangle_name):
+        '''
+        Ramps the columns to the dac_ic_max of their devices, waits to settle and stores the rolled error and
+        triangle of each device in vphi_name and triangle_name. The rows of a column share one SA Bias, so in
+        per row mode this is done once per row with every column at the icmax of that row's device.
+        '''
+        rows = range(self.number_rows) if(self.per_row) else [None]
+        for row in rows:
+            devs = [dev for dev, (_, r) in enumerate(self.devices) if r == row]
+            try:
+                # Ramp all of the columns from their current values to their icmax dac voltages together
+                self.ramp_columns_to_voltage({self.sel_col[self.devices[dev][0]]: self.data[dev].dac_ic_max for dev in devs})
+            except Exception as e:
+                print(e)
+                print('Likely Icmax is 0 - try again')
+                continue
 
-            #store gathered data for processing
-            for col in range(self.ncol):
-                self.data[col].phase1_0_icmax_vphi = err[self.sel_col[col]]
-                self.data[col].phase1_0_triangle = fb[self.sel_col[col]]
+            # Sleep to let system transient settle out before taking data
+            self.wait_for_settle(phase_conf['bias_change_wait_ms'])
+
+            # Take data that has been rolled then averaged across all rows, unless every row is a device
+            fb, err = self.daq.take_average_data_roll(avg_all_rows=not self.per_row)
+
+            # store gathered data for processing, copied since the next row reuses the DAQ buffers
+            for dev in devs:
+                setattr(self.data[dev], vphi_name, np.array(err[self.device_key(dev)]))
+                setattr(self.data[dev], triangle_name, np.array(fb[self.device_key(dev)]))
        
     #saves data results - john currently has this as part of the dataclass module  
-    def save_data(self):
+    @instrument.traced('save_data', 'save')
+    def save_data(self, background=None):
         '''
         Save the data classes which contain the data with the assigned names from bookkeeping()
+        test_globals file_format picks pickle files (the default) or columnar <name>.ssa directories
+        With background (default test_globals save_background) a copy of the data is written by save_workers
+        threads and this returns straight away. Returns a SaveHandle, handle.done() polls and handle.report()
+        waits and prints the size and throughput of every file.
         '''
-        for i in self.data:
-            # Removed save_all_data flag from the script and will always pass in True to the save call
-            i.save(True)
+        test_globals = self.test_conf['test_globals']
+        if(background is None):
+            background = test_globals.get('save_background', False)
+        # Removed save_all_data flag from the script and will always pass in True to the save call
+        handle = async_save.save_all(self.data, True, test_globals.get('file_format', 'pickle'),
+                                     background, test_globals.get('save_workers', 4))
+        if(not background):
+            handle.report()
+        return handle
 
 HELP_TEXT = '''\
 This is the main SQUID Series Array Testing and Quality Assurance Data Collection Script
@@ -430,9 +851,12 @@ def main():
     parser.add_argument('-i', '--interactive', 
                         help='Drop into Interactive mode after setting up classes',
                         action='store_true')
+    parser.add_argument('--config_cache', 
+                        help='Keep the parsed configs in .<name>.cache files next to them for the next run',
+                        action='store_true')
     args = parser.parse_args()
 
-    test = SSA(args.sys_file_path, args.config_file_path, args.verbosity)
+    test = SSA(args.sys_file_path, args.config_file_path, args.verbosity, args.config_cache)
 
     banner = "________   SSA_data_collection   ________\n" \
         + "Squid Series Array Data Collection Script\n" \
@@ -445,19 +869,25 @@ def main():
         + "Defined Classed:\n" \
         + "  test = SSA() : Test System level class containing the phases of testing.\n" \
         + "  test.data[n] : SSA_Data class which will contain the data that has been calculated or taken.\n" \
+        + "                 One per column, or one per (column, row) with per_row, test.devices[n] says which.\n" \
+        + "  test.tracer  : Timing of every phase, test.tracer.export_chrome(path) writes a Chrome trace.\n" \
         + "\n" \
         + "_______Example Usage_______\n" \
         + "Once the system has been configured using Cringe and DATARD is running you can\n" \
         + "run the phases of testing.\n" \
         + "    test.phase0_0()   :  This runs the bias sweep to determine IC_Mod_Max and IC_Min.\n" \
+        + "    test.phase0_0(resume=True) : Continues the last phase0_0 that was streamed to disk.\n" \
         + "    test.phase0_1()   :  This biases each SSA at IC_Mod_Max and saves the SQUID VPhi.\n" \
         + "                         expecting the Feed Back to be swept by a triangle\n" \
         + "    test.phase1_0()   :  This biases each SSA at IC_Mod_Max and saves the SQUID VPhi\n" \
         + "                         expecting the Input to be swept by a triangle\n" \
-        + "    test.save_data()  :  Will save all of the data to disk as pickles, each containing\n" \
-        + "                         a pickle file for a single SSA and all related data.\n"
+        + "    test.save_data()  :  Will save all of the data to disk, one .ssa directory (or pickle)\n" \
+        + "                         for each SSA with all of its related data.\n" \
+        + "    h = test.save_data(background=True) : Saves a copy in the background, h.done() polls\n" \
+        + "                         and h.report() waits and prints the throughput.\n"
     if(args.interactive):
         print(banner)
+        import IPython
         IPython.start_ipython(argv=[], user_ns=locals())
 
 if (__name__ == '__main__'):
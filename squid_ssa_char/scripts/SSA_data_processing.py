@@ -10,14 +10,22 @@
 #################################################################################
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import functools
 import glob
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
+import hashlib
+import inspect
+import io
 import numpy as np
+import os
 import time
+import traceback
 from squid_ssa_char.modules import ssa_data_class
-import scipy.signal as sig
-import IPython
+from squid_ssa_char.modules import metric_cache
+# matplotlib, scipy and IPython are slow to import, they are imported where they are first needed so
+# --help and runs that make no plots do not pay for them
 
 #for date/time stamps on reports, now goes out to minutes 
 today = time.localtime()
@@ -58,11 +66,508 @@ def calculate_Ms(m_data, triangle_data, scale_factor):
 #smooths the data using functions within interpolate. Takes the x axis of the plot and the y axis of the plot [prescaled to be the same length
 #with no overlapping values (triangle is cut at just the up-slope)]. Also takes smoothing paramater s for splrep higher->more smoothed
 def smooth(y_arr, sm_lev):
+   import scipy.signal as sig
    filtercoeffs = sig.firwin(sm_lev,0.1,window=('hamming'))    # amt of taps passed in by call, low-pass at 0.1*fsamp/2
    ysmooth = sig.filtfilt(filtercoeffs,1.0,y_arr)              # Applies filter forward and backward
    return ysmooth
+
+#the phase0_0 windows below were picked as indices of a 256 point uniform sweep. They are kept as fractions of the
+#bias range that was visited, so adaptive (coarse_fine, binary_search) and early stopped sweeps use the same part of the curve
+SWEEP_REF_POINTS = 256
+
+#bias value that index idx (negative from the end) of the reference sweep falls on
+def sweep_bias(bias, idx):
+    n = SWEEP_REF_POINTS
+    return bias[0] + (bias[-1] - bias[0]) * (idx % n) / (n - 1)
+
+#mask of the bias points that indices first to last (inclusive) of the reference sweep cover, with half a reference
+#step either side so a uniform 256 point sweep gets exactly those indices
+def bias_window(bias, first, last):
+    half_step = 0.5 * abs(bias[-1] - bias[0]) / (SWEEP_REF_POINTS - 1)
+    lo, hi = sorted([sweep_bias(bias, first), sweep_bias(bias, last)])
+    return (bias >= lo - half_step) & (bias <= hi + half_step)
+
+#mean of values over the bias_window, nan when the sweep has no points there
+def window_mean(values, bias, first, last):
+    in_window = bias_window(bias, first, last)
+    return float(np.mean(values[in_window])) if(np.any(in_window)) else float('nan')
+
+#the fixed filter taps assume evenly spaced points, a non uniform or too short sweep is left unsmoothed
+def smooth_sweep(y_arr, bias, sm_lev):
+    steps = np.diff(bias)
+    uniform = len(steps) > 0 and np.ptp(steps) <= max(1.0, 0.01 * abs(np.mean(steps)))  # DAC values are rounded
+    if(uniform and len(y_arr) > 3 * sm_lev):
+        return smooth(y_arr, sm_lev)
+    return np.array(y_arr, dtype=np.float64)
                                 
 
+# What a worker hands back for one chip: the compute_metrics() dict, everything it printed and the error if it failed
+ChipResult = collections.namedtuple('ChipResult', ['fname', 'chip_id', 'metrics', 'report', 'output', 'error', 'seconds', 'cached'])
+
+
+def plotting_requested(args):
+    return args.full_report or args.external_report or args.pdf_report or \
+        args.fig1 or args.fig2 or args.fig3 or args.fig4 or args.fig5
+
+
+# One row per chip in the metrics export, in this column order. Currents in uA, voltages in mV, M in pH
+# and Rdyn in Ohms, M_ratio is Min/Mfb and nan where neither M could be found
+METRIC_FIELDS = ['chip_id', 'SSA_type', 'chip_flavor', 'timestamp', 'ic_min', 'ic_max', 'mod_depth', 'M_fb', 'M_in',
+                 'M_ratio', 'rdyn_max', 'rdyn_mean']
+
+
+#calculates the values for the table of one chip, no plotting is needed. Returns a dict of METRIC_FIELDS and
+#leaves the scale factors, M pickoff points and Rdyn curve on the data class for the figures
+def compute_metrics(i):
+    #plotting scaling factors and call of M value calculations, M calculation done on smoothed values to avoid noisy extra 0s
+    #the crate DAC makes both triangles, older files kept its reference in in_dac_vref (see System.bookkeeping_version)
+    #and are scaled as they always were
+    crate_dac_vref = i.sys.daq_dac_vref if(i.sys.bookkeeping_version >= 1) else i.sys.in_dac_vref
+    i.Mfb_scale_factor = ((i.sys.daq_dac_vref * scale_uA) / ((2**(i.sys.daq_dac_nbits) - 1) * i.sys.fb_bias_r)) * i.sys.daq_dac_gain
+    i.Min_scale_factor = ((crate_dac_vref * scale_uA) / ((2**(i.sys.daq_dac_nbits) - 1) * i.sys.in_bias_r)) * i.sys.daq_dac_gain
+    i.M_in, i.Min_start, i.Min_end = calculate_Ms(smooth(i.phase1_0_icmax_vphi,11), i.phase1_0_triangle, i.Min_scale_factor)
+    i.M_fb, i.Mfb_start, i.Mfb_end = calculate_Ms(smooth(i.phase0_1_icmax_vphi,11), i.phase0_1_triangle, i.Mfb_scale_factor)
+    i.factor_adc_mV = ((i.sys.daq_adc_vrange) / (2**i.sys.daq_adc_nbits - 1) / (i.sys.daq_adc_gain) / (i.sys.amp_gain)) * 1000
+    i.sab_dac_factor = ((i.sys.amp_dac_vref * scale_uA) / ((2**(i.sys.amp_dac_nbits) - 1) * i.sys.amp_bias_r)) / i.sys.amp_dac_gain
+
+    if i.M_fb > 0 and i.M_in > 0:
+            M_ratio = i.M_in / i.M_fb
+    elif i.M_fb <= 0 and i.M_in > 0:
+            M_ratio = float('inf')
+    elif i.M_fb > 0 and i.M_in <= 0:
+            M_ratio = 0.0
+    else:
+         M_ratio = float('nan')
+
+    #Rdyn calculation 
+        #find the vphi for icmax, store the indexes where thats true, take first instance then the vphi some bias up or down (3 steps of the reference sweep)
+        #difference the instance from the vphi some bias away, then convert from dac units to volts and amps, divide the voltage change by the current changes
+    bias = i.dac_sweep_array
+    max_idx = np.where(bias == i.dac_ic_max)[0][0]
+    rdyn_step = sweep_bias(bias, 3) - bias[0]
+    #rdyn calculation works by going either up or down a little bias from the icmax, this allows us to work with bad chips that put the icmax at the 
+    #end of the array of vphis AND still possibly get a decent rdyn calculation. Adaptive sweeps take the visited point nearest that bias
+    target = bias[max_idx] + rdyn_step
+    if (target > bias[-1] + 0.5 * rdyn_step / 3):
+        target = bias[max_idx] - rdyn_step
+    others = np.delete(np.arange(len(bias)), max_idx)
+    step_idx = others[np.argmin(np.abs(bias[others] - target))]
+    
+    volt_diff = (i.phase0_0_vphis[step_idx] - i.phase0_0_vphis[max_idx])*i.factor_adc_mV*(1e-3)
+    curr_diff = (float(bias[step_idx]) - float(bias[max_idx]))*i.sab_dac_factor*(1e-6)
+    i.rdyn = volt_diff/curr_diff
+    i.rdyn_smooth = smooth(i.rdyn, 31)
+    #rdyn repeats twice over the triangle, the figure and the summary use the first half
+    rdyn_half = i.rdyn_smooth[0:int(0.5*len(i.rdyn))]
+
+    return {'chip_id': i.chip_id, 'SSA_type': i.SSA_type, 'chip_flavor': i.chip_flavor, 'timestamp': i.timestamp,
+            'ic_min': float(i.dac_ic_min*i.sab_dac_factor),
+            'ic_max': float(i.dac_ic_max*i.sab_dac_factor),
+            'mod_depth': float(np.max(i.phase0_0_vmod_sab*i.factor_adc_mV)),
+            'M_fb': float(i.M_fb),
+            'M_in': float(i.M_in),
+            'M_ratio': float(M_ratio),
+            'rdyn_max': float(np.max(rdyn_half)),
+            'rdyn_mean': float(np.mean(rdyn_half))}
+
+
+#the derivative curves only the figures use, left on the data class next to the values from compute_metrics()
+def compute_curves(i):
+    #data smoothing and derivatives. Smoothing done using interpolate splrep and splev derivative with gradient
+    #These are derived then smoothed - we found for phase01 and phase10 data this method reduced noise without eliminating features
+    dVdI_fb = np.gradient(i.phase0_1_icmax_vphi*i.factor_adc_mV, i.phase0_1_triangle*i.Mfb_scale_factor)
+    dVdI_in = np.gradient(i.phase1_0_icmax_vphi*i.factor_adc_mV, i.phase1_0_triangle*i.Min_scale_factor)
+    i.dVdI_fb_smooth = (smooth(dVdI_fb[0:int(0.5*len(i.phase0_1_triangle))], 51))*1000
+    i.dVdI_in_smooth = (smooth(dVdI_in[0:int(0.5*len(i.phase1_0_triangle))], 31))*1000
+
+    #these are smoothed then derived - for phase00 data this method reduced noise without eliminating features 
+    i.dVmodmax_dIsafb = np.gradient(i.phase0_0_vmod_max*i.factor_adc_mV*1000, i.dac_sweep_array*i.sab_dac_factor)
+    i.dVmodmin_dIsafb = np.gradient(i.phase0_0_vmod_min*i.factor_adc_mV*1000, i.dac_sweep_array*i.sab_dac_factor)
+    i.dVmodmax_dIsafb_smooth = smooth_sweep(i.dVmodmax_dIsafb, i.dac_sweep_array, 11)
+    i.dVmodmin_dIsafb_smooth = smooth_sweep(i.dVmodmin_dIsafb, i.dac_sweep_array, 11)
+
+
+# Everything compute_metrics() and compute_curves() leave on the data class, what a cache entry holds besides the metrics
+DERIVED_ATTRS = ['Mfb_scale_factor', 'Min_scale_factor', 'M_in', 'Min_start', 'Min_end', 'M_fb', 'Mfb_start', 'Mfb_end',
+                 'factor_adc_mV', 'sab_dac_factor', 'rdyn', 'rdyn_smooth', 'dVdI_fb_smooth', 'dVdI_in_smooth',
+                 'dVmodmax_dIsafb', 'dVmodmin_dIsafb', 'dVmodmax_dIsafb_smooth', 'dVmodmin_dIsafb_smooth']
+# Bump for changes the source of the functions below does not show, e.g. in numpy or scipy behaviour
+METRICS_VERSION = 1
+
+
+@functools.lru_cache(maxsize=None)
+def code_version():
+    '''
+    Version of the derived values for the cache key, changes whenever the code that calculates them is edited
+    '''
+    h = hashlib.sha256(str(METRICS_VERSION).encode())
+    for func in (calculate_Ms, smooth, compute_metrics, compute_curves):
+        h.update(inspect.getsource(func).encode())
+    h.update(repr((phi0, scale_L, scale_uA, METRIC_FIELDS, DERIVED_ATTRS)).encode())
+    return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def open_cache(cache_dir, cache_size_mb):
+    '''
+    The MetricCache in cache_dir, one per process so the directory is only scanned once, or None without --cache
+    '''
+    if cache_dir is None:
+        return None
+    return metric_cache.MetricCache(cache_dir, cache_size_mb * 1e6)
+
+
+def derive(i):
+    '''
+    Calculates everything about a chip a cache entry holds
+    '''
+    metrics = compute_metrics(i)
+    compute_curves(i)
+    return {'metrics': metrics, 'derived': {name: getattr(i, name) for name in DERIVED_ATTRS}}
+
+
+#setup for data table of calculated values, the list of data for the cells (rounded to 2 decimal places)
+def table_values(metrics):
+    M_ratio = metrics['M_ratio']
+    return [round(metrics['ic_min'],2), round(metrics['ic_max'],2), round(metrics['mod_depth'],2), round(metrics['M_fb'],2),
+            round(metrics['M_in'],2), None if np.isnan(M_ratio) else round(M_ratio,2)]
+
+
+column_labels = ['Icmin [$\mu$A]', 'Icmax [$\mu$A]', 'Mod Depth [mV]', 'Mfb [pH]', 'Min [pH]', 'Min/Mfb']
+
+
+#calculates the values for one chip and makes its figures, into the pdf report_name with -r. Returns the metrics
+#entry is what derive() returned for the chip, e.g. from the cache, then nothing is calculated again and i
+#is only needed for the figures
+def process_chip(i, report_name, args, entry=None):
+    if entry is None:
+        metrics = compute_metrics(i)
+    else:
+        metrics = entry['metrics']
+        if i is not None:
+            for name, value in entry['derived'].items():
+                setattr(i, name, value)
+    #TODO: add if statments to fix 0s breaking this
+    tdata = table_values(metrics)
+    print('\n' + metrics['chip_id'])
+    print(column_labels)
+    print(tdata) 
+
+    if plotting_requested(args):
+        plot_chip(i, tdata, report_name, args)
+    return metrics
+
+
+#makes the figures of one chip from the values compute_metrics() left on it
+def plot_chip(i, tdata, report_name, args):
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+    if getattr(i, 'dVdI_fb_smooth', None) is None:
+        compute_curves(i)
+    Mfb_scale_factor = i.Mfb_scale_factor
+    Min_scale_factor = i.Min_scale_factor
+    rdyn = i.rdyn
+    rdyn_smooth = i.rdyn_smooth
+    dVdI_fb_smooth = i.dVdI_fb_smooth
+    dVdI_in_smooth = i.dVdI_in_smooth
+    dVmodmax_dIsafb = i.dVmodmax_dIsafb
+    dVmodmin_dIsafb = i.dVmodmin_dIsafb
+    dVmodmax_dIsafb_smooth = i.dVmodmax_dIsafb_smooth
+    dVmodmin_dIsafb_smooth = i.dVmodmin_dIsafb_smooth
+
+    if args.pdf_report:
+        pdf = PdfPages(report_name)
+        print('Generating Report: ', report_name)
+
+    #TODO: currently it just makes everything for either argument, make more sophisticated
+    if args.full_report or args.external_report or args.pdf_report or args.fig1:
+        #start of plotting
+        fig1, (ax0, ax1, ax2) = plt.subplots(3,1, gridspec_kw={'height_ratios': [1, 10, 10]})
+        fig1.set_size_inches(7.5, 10, forward=True)
+        fig1.subplots_adjust(hspace=0.45)
+        fig1.suptitle('Figure 1: device ' + i.chip_id, fontsize=14, fontweight='bold')
+        #table of values for the chip - turn off axes and frame then make the table
+        ax0.set_frame_on(False)
+        ax0.set_xticks([])
+        ax0.set_yticks([])
+        table = ax0.table(cellText=[tdata], colLabels=column_labels, loc='upper left', cellLoc='center', colColours=['lightgray']*7, fontsize=20)
+        table.auto_set_font_size(False)
+        table.set_fontsize(8)
+        ax0.set_title(i.chip_id + ': Table of Calculated Values', fontsize=16)
+        # plot 1: mod depth [mV] vs SA bias current [uA]
+        ax1.plot((i.dac_sweep_array * i.sab_dac_factor), (i.phase0_0_vmod_sab * i.factor_adc_mV))
+        ax1.set_title('Voltage Modulation Depth vs SA Bias', fontsize=16)
+        ax1.set_xlabel('I$_{SAFB}$ [$\mu$A]', fontsize=14)
+        ax1.set_ylabel('SA Modulation Depth [mV]', fontsize=14)
+        ax1.axvline(x = i.dac_ic_min * i.sab_dac_factor, ymin=0, ymax=1, color='b', lw=0.5)
+        ax1.axvline(x = i.dac_ic_max * i.sab_dac_factor, ymin=0, ymax=1, color='b', lw=0.5)
+        ax1.axhline(y = np.max(i.phase0_0_vmod_sab * i.factor_adc_mV), xmin=0, xmax=1, color='b', lw=0.5)
+        ax1.text(i.dac_ic_min * i.sab_dac_factor, np.max(i.phase0_0_vmod_sab * i.factor_adc_mV)*0.7, '$I_{cmin}$ \n %.1f $\mu$A' %(i.dac_ic_min*i.sab_dac_factor), \
+                ha='center', va='center', color = 'blue', backgroundcolor='w',fontsize=10)
+        ax1.text(i.dac_ic_max * i.sab_dac_factor, np.max(i.phase0_0_vmod_sab * i.factor_adc_mV)*0.4, '$I_{cmax}$ \n %.1f $\mu$A' %(i.dac_ic_max*i.sab_dac_factor), \
+                ha='center', va='center', color = 'blue', backgroundcolor='w',fontsize=10)
+        ax1.text((i.dac_sweep_array[-1]*i.sab_dac_factor)*.95, np.max(i.phase0_0_vmod_sab*i.factor_adc_mV)*0.93, \
+                '$V_{mod}$\n %.1f mV' %np.max(i.phase0_0_vmod_sab*i.factor_adc_mV), ha='center', va='center', color='blue', backgroundcolor ='w', fontsize=10)
+
+        # plot 2: V_ssa_min and V_ssa_max [mV] vs SA bias [uA]
+        ax2.plot((i.dac_sweep_array * i.sab_dac_factor), (i.phase0_0_vmod_min * i.factor_adc_mV), label = '$V_{min}$')
+        ax2.plot((i.dac_sweep_array * i.sab_dac_factor), (i.phase0_0_vmod_max * i.factor_adc_mV), label = '$V_{max}$')
+        ax2.set_title('Device Voltage vs Bias Current', fontsize=16)
+        ax2.set_ylabel('SSA Voltage [mV]', fontsize=14)
+        ax2.set_xlabel('I$_{SAFB}$ [$\mu$A]', fontsize=14)
+        ax2.legend()
+        ax2.text(np.max(i.dac_sweep_array*i.sab_dac_factor)*.95, np.max(i.phase0_0_vmod_min*i.factor_adc_mV)*.65, '$V_{min}$', ha='center', va='center', color='black', backgroundcolor='w',fontsize=10)
+        ax2.text(np.max(i.dac_sweep_array*i.sab_dac_factor)*.7, np.max(i.phase0_0_vmod_max*i.factor_adc_mV)*.85, '$V_{max}$', ha='center', va='center', color='black', backgroundcolor='w',fontsize=10)
+
+        if args.pdf_report:
+            pdf.savefig()
+
+    if args.full_report or args.external_report or args.pdf_report or args.fig2:
+        
+        fig2, (ax3, ax4) = plt.subplots(2,1)
+        fig2.set_size_inches(7.5, 10, forward=True)
+        fig2.subplots_adjust(hspace=0.35)
+        fig2.suptitle('Figure 2: device ' + i.chip_id, fontsize=14, fontweight='bold')
+        # plot 3: Vssa [mV] vs Iin [uA], Min marked on this plot
+        ax3.plot((i.phase1_0_triangle * Min_scale_factor), (i.phase1_0_icmax_vphi * i.factor_adc_mV))
+        ax3.set_title('Device Voltage vs Input Current at at I$_{cmax}$', fontsize=16)
+        ax3.set_ylabel('Device Voltage [mV]', fontsize=14)
+        ax3.set_xlabel('SAIN Current [$\mu$A]', fontsize=14)
+        sain_xlim = int(np.max(i.phase1_0_triangle * Min_scale_factor)) + 1
+        ax3.set_xlim(0, sain_xlim)
+        ax3.set_ylim((np.min(i.phase1_0_icmax_vphi*i.factor_adc_mV))-1, np.max(i.phase1_0_icmax_vphi*i.factor_adc_mV)+1)
+        ax3.axvline(x=i.Min_end, ymin=0, ymax=1, lw=0.5)
+        ax3.axvline(x=i.Min_start, ymin=0, ymax=1, lw=0.5)
+        ax3.axhline(y=np.max(i.phase1_0_icmax_vphi * i.factor_adc_mV)*.75, xmin=(1.0/sain_xlim)*i.Min_start, xmax=(1.0/sain_xlim)*i.Min_end, lw=0.5)
+        ax3.axhline(y=np.min(i.phase1_0_icmax_vphi * i.factor_adc_mV), xmin=0, xmax=1, lw=0.5)
+        ax3.axhline(y=np.max(i.phase1_0_icmax_vphi * i.factor_adc_mV), xmin=0, xmax=1, lw=0.5)
+        ax3.text((i.Min_start+i.Min_end)/2, np.max(i.phase1_0_icmax_vphi * i.factor_adc_mV)*0.75, '$M_{in}$ = %.1f pH' %i.M_in,\
+                ha='center', va='center', color='black', backgroundcolor='w', fontsize=10)
+        ax3.text(i.Min_end, np.max(i.phase1_0_icmax_vphi * i.factor_adc_mV)*0.15, '%.1f' %i.Min_end, \
+                ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
+        ax3.text(i.Min_start, np.max(i.phase1_0_icmax_vphi * i.factor_adc_mV)*0.15, '%.1f' %i.Min_start, \
+                ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
+        ax3.text(sain_xlim*0.95, np.max(i.phase1_0_icmax_vphi * i.factor_adc_mV), '%.1f' %np.max(i.phase1_0_icmax_vphi * i.factor_adc_mV), \
+                ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
+        ax3.text(sain_xlim*0.95, np.min(i.phase1_0_icmax_vphi * i.factor_adc_mV), '%.1f' %np.min(i.phase1_0_icmax_vphi * i.factor_adc_mV), \
+                ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
+
+        # derivative of Vssa vs Isain 
+        ax4.plot((i.phase1_0_triangle[5:int(0.5*len(i.phase1_0_triangle)-5)])*Min_scale_factor, dVdI_in_smooth[5:-5])
+        ax4.set_title('SA Input Gain vs SA Input Current at I$_{cmax}$', fontsize=16)
+        ax4.set_ylabel('dV$_{dev}$/dI$_{SAIN}$ [$\mu$V/$\mu$A]', fontsize=14)
+        ax4.set_xlabel('SAIN Current [$\mu$A]', fontsize=14)
+        ax4.set_xlim(0, sain_xlim)
+        ax4.axhline(y=np.max(dVdI_in_smooth[5:-5]), xmin=0, xmax=1, lw=0.5)
+        ax4.axhline(y=np.min(dVdI_in_smooth[5:-5]), xmin=0, xmax=1, lw=0.5)
+        ax4.text(sain_xlim*0.95, np.min(dVdI_in_smooth[5:-5]), '%.1f' %np.min(dVdI_in_smooth[5:-5]), \
+                ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
+        ax4.text(sain_xlim*0.95, np.max(dVdI_in_smooth[5:-5]), '%.1f' %np.max(dVdI_in_smooth[5:-5]), \
+                ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
+
+        if args.pdf_report:
+            pdf.savefig()     
+
+    if args.full_report or args.external_report or args.pdf_report or args.fig3:    
+        # plot 5: Vssa [mV] vs Ifab [uA], Mfb marked on this plot
+        fig3, (ax5, ax6) = plt.subplots(2,1)
+        fig3.set_size_inches(7.5, 10, forward=True)
+        fig3.subplots_adjust(hspace=0.35)
+        fig3.suptitle('Figure 3: device ' + i.chip_id, fontsize=14, fontweight='bold')
+        ax5.plot((i.phase0_1_triangle * Mfb_scale_factor), (i.phase0_1_icmax_vphi * i.factor_adc_mV))
+        ax5.set_title('Device Voltage vs Feedback Current at I$_{cmax}$', fontsize=16)
+        ax5.set_ylabel('Device Voltage [mV]', fontsize=14)
+        ax5.set_xlabel('SAFB Current [$\mu$A]', fontsize=14)
+        safb_xlim = int(np.max(i.phase0_1_triangle * Mfb_scale_factor)) + 1
+        ax5.set_xlim(0, safb_xlim)
+        ax5.set_ylim((np.min(i.phase0_1_icmax_vphi*i.factor_adc_mV))-1, np.max(i.phase0_1_icmax_vphi*i.factor_adc_mV)+1)
+        ax5.axvline(x=i.Mfb_end, ymin=0, ymax=1, lw=0.5)
+        ax5.axvline(x=i.Mfb_start, ymin=0, ymax=1, lw=0.5)
+        ax5.axhline(y=np.max(i.phase0_1_icmax_vphi * i.factor_adc_mV)*.75, xmin=(1.0/safb_xlim)*i.Mfb_start, xmax=(1.0/safb_xlim)*i.Mfb_end, lw=0.5)
+        ax5.axhline(y=np.min(i.phase0_1_icmax_vphi * i.factor_adc_mV), xmin=0, xmax=1, lw=0.5)
+        ax5.axhline(y=np.max(i.phase0_1_icmax_vphi * i.factor_adc_mV), xmin=0, xmax=1, lw=0.5)
+        ax5.text((i.Mfb_start+i.Mfb_end)/2, np.max(i.phase0_1_icmax_vphi * i.factor_adc_mV)*0.75, '$M_{fb}$ = %.1f pH' %i.M_fb, \
+                ha='center', va='center', color='black', backgroundcolor='w', fontsize=10)
+        ax5.text(i.Mfb_end, np.max(i.phase0_1_icmax_vphi * i.factor_adc_mV)*0.15, '%.1f' %i.Mfb_end, \
+                ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
+        ax5.text(i.Mfb_start, np.max(i.phase0_1_icmax_vphi * i.factor_adc_mV)*0.15, '%.1f' %i.Mfb_start, \
+                ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
+        ax5.text(safb_xlim*0.95, np.min(i.phase0_1_icmax_vphi * i.factor_adc_mV), '%.1f' %np.min(i.phase0_1_icmax_vphi * i.factor_adc_mV), \
+                ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
+        ax5.text(safb_xlim*0.95, np.max(i.phase0_1_icmax_vphi * i.factor_adc_mV), '%.1f' %np.max(i.phase0_1_icmax_vphi * i.factor_adc_mV), \
+                ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
+
+        #derivative of Vssa vs Isafb plot
+        ax6.plot((i.phase0_1_triangle[5:int(0.5*len(i.phase0_1_triangle))-5])*Mfb_scale_factor, dVdI_fb_smooth[5:-5])
+        ax6.set_title('Feedback Gain vs Feedback Current at I$_{cmax}$', fontsize=16)
+        ax6.set_ylabel('dV$_{dev}$/dI$_{SAFB}$ [$\mu$V/$\mu$A]', fontsize=14)
+        ax6.set_xlabel('SAFB Current [$\mu$A]', fontsize=14)
+        ax6.set_xlim(0, safb_xlim)
+        ax6.axhline(y=np.max(dVdI_fb_smooth[5:-5]), xmin=0, xmax=1, lw=0.5)
+        ax6.axhline(y=np.min(dVdI_fb_smooth[5:-5]), xmin=0, xmax=1, lw=0.5)
+        ax6.text(safb_xlim*0.95, np.min(dVdI_fb_smooth[5:-5]), '%.1f' %np.min(dVdI_fb_smooth[5:-5]), \
+                ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
+        ax6.text(safb_xlim*0.95, np.max(dVdI_fb_smooth[5:-5]), '%.1f' %np.max(dVdI_fb_smooth[5:-5]), \
+                ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
+
+        if args.pdf_report:
+            pdf.savefig()        
+
+    if args.full_report or args.external_report or args.pdf_report or args.fig4:
+        
+        fig4, (ax7, ax8) = plt.subplots(2,1)
+        fig4.set_size_inches(7.5, 10, forward=True)
+        fig4.subplots_adjust(hspace=0.35)
+        fig4.suptitle('Figure 4: device ' + i.chip_id, fontsize=14, fontweight='bold')
+        # plot 7: dVssa/dIsab vs Isab
+        #TODO: Ask carl about this title - not sure we should call this dynamic resistance when we have that later? Im confused.
+        #windows are bias ranges, see bias_window()
+        bias = i.dac_sweep_array
+        shown = bias_window(bias, 5, -8)
+        ax7.plot(bias[shown]*i.sab_dac_factor, dVmodmax_dIsafb_smooth[shown], label = 'dV$_{max}$/dI$_{SAB}$')
+        ax7.plot(bias[shown]*i.sab_dac_factor, dVmodmin_dIsafb_smooth[shown], label = 'dV$_{min}$/dI$_{SAB}$')            
+        ax7.set_title('Dynamic Resistance vs Bias Current', fontsize=16)
+        ax7.set_ylabel('dV$_{SSA}$/dI$_{SAB}$ [$\mu$V/$\mu$A]', fontsize=14)
+        ax7.set_xlabel('I$_{SAFB}$ [$\mu$A]', fontsize=14)
+        ax7.legend()
+        asymptote_max = window_mean(dVmodmax_dIsafb, bias, -20, -6)
+        asymptote_min = window_mean(dVmodmin_dIsafb, bias, -12, -6)
+        baseline = np.mean([window_mean(dVmodmax_dIsafb, bias, 20, 59), window_mean(dVmodmin_dIsafb, bias, 20, 59)])
+        ax7.axhline(y=asymptote_max, xmin=0, xmax=1, lw=0.5, ls='--', color='k')
+        ax7.axhline(y=asymptote_min, xmin=0, xmax=1, lw=0.5, ls = '--', color='k')
+        ax7.axhline(y=baseline, xmin=0, xmax=1, lw=0.5, ls = '--', color='k')
+        ax7.text(i.dac_sweep_array[-1]*i.sab_dac_factor, asymptote_max*.8, '%.1f Ohms' %asymptote_max, \
+                ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
+        ax7.text(i.dac_sweep_array[-1]*i.sab_dac_factor, asymptote_min*1.1, '%.1f Ohms' %asymptote_min, \
+                ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
+        ax7.text(sweep_bias(bias, 10)*i.sab_dac_factor, baseline*10, '%.1f Ohms' %baseline, \
+                ha='center', va='center',color='blue',fontsize=8)          
+        # plot 8: Device Transimpedance vs Device Volgtage
+        ax8.plot(i.phase1_0_icmax_vphi[0:int(0.5*len(i.phase1_0_triangle))]*i.factor_adc_mV, dVdI_in_smooth)
+        ax8.set_title('Device Transimpedance vs Device Voltage', fontsize=16)
+        ax8.set_xlabel('V$_{SSA}$ input [mV]', fontsize=14)
+        ax8.set_ylabel('dV$_{SSA}$/dI$_{in}$ [$\mu$V/$\mu$A]', fontsize=14)
+
+        if args.pdf_report:
+            pdf.savefig()
+    if args.full_report or args.external_report or args.pdf_report or args.fig5:
+        
+        fig5, (ax9, ax10, ax11) = plt.subplots(3,1, gridspec_kw={'height_ratios': [10, 10, 1]})
+        fig5.set_size_inches(7.5, 10, forward=True)
+        fig5.subplots_adjust(hspace=0.45)
+        fig5.suptitle('Figure 5: device ' + i.chip_id, fontsize=14, fontweight='bold')
+        # plot 9: Dynamic Resistance vs Current
+        #rdyn is repeating twice, plot half to get cleaner data
+        ax9.plot(i.phase0_1_triangle[0:int(0.5*len(rdyn))]*Mfb_scale_factor, rdyn_smooth[0:int(0.5*len(rdyn))])
+        ax9.set_title('Dynamic Resistence vs Current', fontsize=16)
+        ax9.set_xlabel('I$_{SAFB}$ [$\mu$A]', fontsize=14)
+        ax9.set_ylabel('Resistance [$\Omega$]', fontsize=14)
+        # plot 10: Dynamic Resistance vs Voltage
+        #circles over itself 4 times within the range, plot only 1/4 to get cleaner plot
+        ax10.plot(i.phase0_1_icmax_vphi[0:int(0.25*len(rdyn))]*i.factor_adc_mV, rdyn_smooth[0:int(0.25*len(rdyn))])
+        ax10.set_title('Dynamic Resistance vs Voltage', fontsize=16)
+        ax10.set_xlabel('V$_{SSA}$ feedback [mV]', fontsize=14)
+        ax10.set_ylabel('Resistance [$\Omega$]', fontsize=14)
+        #table of values for the chip - turn off axes and frame then make the table
+        ax11.set_frame_on(False)
+        ax11.set_xticks([])
+        ax11.set_yticks([])
+        info_table = [i.system_name, i.qa_name, i.SSA_type, i.chip_flavor, i.timestamp]
+        info_labels = ['QA System', 'User', 'SSA Type', 'Chip Flavor', 'Data Timestamp']
+        table = ax11.table(cellText=[info_table], colLabels=info_labels, loc='upper left', cellLoc='center', colColours=['lightgray']*7, fontsize=20)
+        table.auto_set_font_size(False)
+        table.set_fontsize(9)
+        ax11.set_title('\n'+'\n'+'\n'+ i.chip_id + ': Testing Setup & Device Information', fontsize=16)
+        #
+        if args.pdf_report:
+            pdf.savefig()
+    #
+    if args.pdf_report:
+        pdf.close()
+        # Nothing is shown in report mode, a batch of chips would otherwise hold every figure open
+        plt.close('all')
+
+
+def run_file(fname, report_name, args):
+    '''
+    Loads and processes one file, printing and warning into a buffer so chips processed side by side do not
+    mix their output. Any error is caught and returned in the ChipResult so one bad file does not stop the rest.
+    With --cache a chip already in the cache is only hashed, and only loaded at all when it has figures to make.
+    Returns (ChipResult, the loaded SSA_Data_Class or None)
+    '''
+    start = time.perf_counter()
+    out = io.StringIO()
+    data, metrics, error, entry = None, None, None, None
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+        try:
+            cache = open_cache(args.cache_dir, args.cache_size)
+            if cache is not None:
+                key = cache.key(fname, code_version())
+                entry = cache.get(key)
+            cached = entry is not None
+            if entry is None or plotting_requested(args) or args.interactive:
+                data = ssa_data_class.SSA_Data_Class.load(fname)
+            if entry is None and cache is not None:
+                entry = derive(data)
+                cache.put(key, entry)
+            metrics = process_chip(data, report_name, args, entry)
+        except Exception:
+            error = traceback.format_exc()
+            cached = False
+    chip_id = metrics['chip_id'] if(metrics) else getattr(data, 'chip_id', None)
+    return ChipResult(fname, chip_id, metrics, report_name if(args.pdf_report) else None, out.getvalue(), error,
+                      time.perf_counter() - start, cached), data
+
+
+def process_file(fname, report_name, args):
+    '''
+    Worker process entry point, only the small ChipResult goes back to the main process
+    '''
+    return run_file(fname, report_name, args)[0]
+
+
+def init_worker():
+    # Workers never show anything, Agg renders straight to the pdf without a display
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def write_metrics(rows, path):
+    '''
+    Writes one row per chip of METRIC_FIELDS plus the source_file it came from. The format follows the extension of
+    path: .csv, .npz (one array per column) or .parquet, which needs pandas with pyarrow or fastparquet
+    '''
+    fields = ['source_file'] + METRIC_FIELDS
+    ext = os.path.splitext(path)[1].lower()
+    if(ext == '.csv'):
+        import csv
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
+    elif(ext == '.npz'):
+        columns = {}
+        for field in fields:
+            values = [row[field] for row in rows]
+            if(field in ('source_file', 'chip_id', 'SSA_type', 'chip_flavor', 'timestamp')):
+                columns[field] = np.array([str(v) for v in values])
+            else:
+                columns[field] = np.array(values, dtype=np.float64)
+        np.savez(path, **columns)
+    elif(ext == '.parquet'):
+        import pandas
+        pandas.DataFrame(rows, columns=fields).to_parquet(path, index=False)
+    else:
+        raise ValueError('Metrics file {} has to end in .csv, .npz or .parquet'.format(path))
+    return path
+
+
+def print_result(result):
+    print(result.output, end='')
+    if(result.error is not None):
+        print('\nFailed to process ' + result.fname + ':\n' + result.error, end='')
+
+
 def main():
     parser = argparse.ArgumentParser(description='Take data from QA_DAQ, scale it, plot it and generate a PDF report'
                                      'for each device specified in list of files')
@@ -105,8 +610,50 @@ def main():
                         dest='fig5',
                         action='store_true',
                         help='Loads data from .npz and creates figure 5 - Rdyn vs SA Bias (differential) and system/device info table')   
+    parser.add_argument('-j',
+                        dest='jobs',
+                        type=int,
+                        default=1,
+                        help='Process this many chips at once in separate processes, 0 for one per CPU. Figures are '
+                        'only kept in the -r reports when this is more than 1')
+    parser.add_argument('--metrics-only',
+                        dest='metrics_only',
+                        action='store_true',
+                        help='Only calculate the table values of each chip, no figures and no matplotlib, and write '
+                        'them to the -o file')
+    parser.add_argument('--cache',
+                        dest='cache_dir',
+                        default=None,
+                        help='Keep the values calculated for each chip in this directory, a chip whose file and the '
+                        'processing code are unchanged is then not calculated again, or even loaded with --metrics-only')
+    parser.add_argument('--cache-size',
+                        dest='cache_size',
+                        type=float,
+                        default=1000,
+                        help='MB the --cache directory may grow to before the least recently used chips are removed')
+    parser.add_argument('-o',
+                        dest='metrics_file',
+                        default=None,
+                        help='Write the values of every chip, one row each, to this .csv, .npz or .parquet file. '
+                        'Defaults to metrics_<date>.csv with --metrics-only')
     
     args = parser.parse_args()
+    jobs = args.jobs if(args.jobs > 0) else (os.cpu_count() or 1)
+    plotting = plotting_requested(args)
+    if(args.metrics_only and plotting):
+        parser.error('--metrics-only makes no figures, leave out -f, -r, -e and -1 to -5')
+    if(args.metrics_only and args.metrics_file is None):
+        args.metrics_file = 'metrics_' + str(now) + '.csv'
+    if(args.metrics_file is not None and os.path.splitext(args.metrics_file)[1].lower() not in ('.csv', '.npz', '.parquet')):
+        parser.error('-o {} has to end in .csv, .npz or .parquet'.format(args.metrics_file))
+    if(args.metrics_file is not None and args.metrics_file.lower().endswith('.parquet')):
+        # Found out now rather than after processing every chip
+        try:
+            import pandas
+        except ImportError:
+            parser.error('-o {} needs pandas, use a .csv or .npz metrics file instead'.format(args.metrics_file))
+    if(jobs > 1 and plotting and not args.pdf_report):
+        parser.error('figures from -j worker processes can not be shown, add -r to put them in pdf reports')
     
     #breaks up the list of files into individual things
     print(str(args.list_of_files))
@@ -124,292 +671,52 @@ def main():
         fname_arr.append(element.rsplit('/', 1)[-1][:11])
 
     fname_arr = np.array(fname_arr)
-    #data load and format into string if file names
-    
-    if len(fnames) >= 1:
-        data = [ssa_data_class.SSA_Data_Class.load(fnames[0])]
-        for i in range(len(fnames) - 1):
-                data.append(ssa_data_class.SSA_Data_Class.load(fnames[i + 1]))
-    else:
-        print('There were no files found./n')
-        print('Contents of file list: ' + fnames)
-
-    #counter for numerical indexing during data file loop
-    cnt = -1
-
-    for i in data:
-        cnt += 1
-        #plotting scaling factors and call of M value calculations, M calculation done on smoothed values to avoid noisy extra 0s
-        Mfb_scale_factor = ((i.sys.daq_dac_vref * scale_uA) / ((2**(i.sys.daq_dac_nbits) - 1) * i.sys.fb_bias_r)) * i.sys.daq_dac_gain
-        Min_scale_factor = ((i.sys.in_dac_vref * scale_uA) / ((2**(i.sys.daq_dac_nbits) - 1) * i.sys.in_bias_r)) * i.sys.daq_dac_gain
-        i.M_in, i.Min_start, i.Min_end = calculate_Ms(smooth(i.phase1_0_icmax_vphi,11), i.phase1_0_triangle, Min_scale_factor)
-        i.M_fb, i.Mfb_start, i.Mfb_end = calculate_Ms(smooth(i.phase0_1_icmax_vphi,11), i.phase0_1_triangle, Mfb_scale_factor)
-        i.factor_adc_mV = ((i.sys.daq_adc_vrange) / (2**i.sys.daq_adc_nbits - 1) / (i.sys.daq_adc_gain) / (i.sys.amp_gain)) * 1000
-        i.sab_dac_factor = ((i.sys.amp_dac_vref * scale_uA) / ((2**(i.sys.amp_dac_nbits) - 1) * i.sys.amp_bias_r)) / i.sys.amp_dac_gain
-
-        #data smoothing and derivatives. Smoothing done using interpolate splrep and splev derivative with gradient
-        #These are derived then smoothed - we found for phase01 and phase10 data this method reduced noise without eliminating features
-        dVdI_fb = np.gradient(i.phase0_1_icmax_vphi*i.factor_adc_mV, i.phase0_1_triangle*Mfb_scale_factor)
-        dVdI_in = np.gradient(i.phase1_0_icmax_vphi*i.factor_adc_mV, i.phase1_0_triangle*Min_scale_factor)
-        dVdI_fb_smooth = (smooth(dVdI_fb[0:int(0.5*len(i.phase0_1_triangle))], 51))*1000
-        dVdI_in_smooth = (smooth(dVdI_in[0:int(0.5*len(i.phase1_0_triangle))], 31))*1000
-
-        #these are smoothed then derived - for phase00 data this method reduced noise without eliminating features 
-        dVmodmax_dIsafb = np.gradient(i.phase0_0_vmod_max*i.factor_adc_mV*1000, i.dac_sweep_array*i.sab_dac_factor)
-        dVmodmin_dIsafb = np.gradient(i.phase0_0_vmod_min*i.factor_adc_mV*1000, i.dac_sweep_array*i.sab_dac_factor)
-        dVmodmax_dIsafb_smooth = smooth(dVmodmax_dIsafb, 11)
-        dVmodmin_dIsafb_smooth = smooth(dVmodmin_dIsafb, 11)
-
-       #TODO: add if statments to fix 0s breaking this
-        #setup for data table of calculated values, creates lables and the list of data for the cells (rounded to 2 decimal places)
-        ic_min_table = round((i.dac_ic_min*i.sab_dac_factor),2)
-        ic_max_table = round((i.dac_ic_max*i.sab_dac_factor),2)
-        mod_depth_table = round((np.max(i.phase0_0_vmod_sab*i.factor_adc_mV)),2)
-        M_fb_table = round((i.M_fb),2)
-        M_in_table = round((i.M_in),2)
-        if i.M_fb > 0 and i.M_in > 0:
-                M_ratio_table = round((i.M_in)/(i.M_fb),2)
-        elif i.M_fb <= 0 and i.M_in > 0:
-                M_ratio_table = float('inf')
-        elif i.M_fb > 0 and i.M_in <= 0:
-                M_ratio_table = 0
-        else:
-             M_ratio_table = None
-
-        tdata = [ic_min_table, ic_max_table, mod_depth_table, M_fb_table, M_in_table, M_ratio_table]
-        column_labels = ['Icmin [$\mu$A]', 'Icmax [$\mu$A]', 'Mod Depth [mV]', 'Mfb [pH]', 'Min [pH]', 'Min/Mfb']
-        print('\n' + i.chip_id)
-        print(column_labels)
-        print(tdata) 
-
-        #Rdyn calculation 
-            #find the vphi for icmax, store the indexes where thats true, take first instance then some step of vphis up or down (we chose 3 steps up)
-            #difference the instance from the vphi some step away, then convert from dac units to volts and amps, divide the voltage change by the current changes
-        max_idx = np.where(i.dac_sweep_array == i.dac_ic_max)[0][0]
-        phi_step = 3
-        #rdyn calculation works by going either up or down a few steps from the icmax, this allows us to work with bad chips that put the icmax at the 
-        #end of the array of vphis AND still possibly get a decent rdyn calculation.
-        if (max_idx + phi_step >= len(i.phase0_0_vphis)):
-            phi_step = -3
-        
-        volt_diff = (i.phase0_0_vphis[max_idx+phi_step] - i.phase0_0_vphis[max_idx])*i.factor_adc_mV*(1e-3)
-        curr_diff = (i.dac_sweep_array[max_idx+phi_step] - i.dac_sweep_array[max_idx])*i.sab_dac_factor*(1e-6)
-        rdyn = volt_diff/curr_diff
-        rdyn_smooth = smooth(rdyn, 31)
-
-
-        if args.pdf_report:
-            report_name = fname_arr[cnt] + '_' + str(now) + '.pdf'
-            pdf = PdfPages(report_name)
-            print('Generating Report: ', report_name)
-
-        #TODO: currently it just makes everything for either argument, make more sophisticated
-        if args.full_report or args.external_report or args.pdf_report or args.fig1:
-            #start of plotting
-            fig1, (ax0, ax1, ax2) = plt.subplots(3,1, gridspec_kw={'height_ratios': [1, 10, 10]})
-            fig1.set_size_inches(7.5, 10, forward=True)
-            fig1.subplots_adjust(hspace=0.45)
-            fig1.suptitle('Figure 1: device ' + i.chip_id, fontsize=14, fontweight='bold')
-            #table of values for the chip - turn off axes and frame then make the table
-            ax0.set_frame_on(False)
-            ax0.set_xticks([])
-            ax0.set_yticks([])
-            table = ax0.table(cellText=[tdata], colLabels=column_labels, loc='upper left', cellLoc='center', colColours=['lightgray']*7, fontsize=20)
-            table.auto_set_font_size(False)
-            table.set_fontsize(8)
-            ax0.set_title(i.chip_id + ': Table of Calculated Values', fontsize=16)
-            # plot 1: mod depth [mV] vs SA bias current [uA]
-            ax1.plot((i.dac_sweep_array * i.sab_dac_factor), (i.phase0_0_vmod_sab * i.factor_adc_mV))
-            ax1.set_title('Voltage Modulation Depth vs SA Bias', fontsize=16)
-            ax1.set_xlabel('I$_{SAFB}$ [$\mu$A]', fontsize=14)
-            ax1.set_ylabel('SA Modulation Depth [mV]', fontsize=14)
-            ax1.axvline(x = i.dac_ic_min * i.sab_dac_factor, ymin=0, ymax=1, color='b', lw=0.5)
-            ax1.axvline(x = i.dac_ic_max * i.sab_dac_factor, ymin=0, ymax=1, color='b', lw=0.5)
-            ax1.axhline(y = np.max(i.phase0_0_vmod_sab * i.factor_adc_mV), xmin=0, xmax=1, color='b', lw=0.5)
-            ax1.text(i.dac_ic_min * i.sab_dac_factor, np.max(i.phase0_0_vmod_sab * i.factor_adc_mV)*0.7, '$I_{cmin}$ \n %.1f $\mu$A' %(i.dac_ic_min*i.sab_dac_factor), \
-                    ha='center', va='center', color = 'blue', backgroundcolor='w',fontsize=10)
-            ax1.text(i.dac_ic_max * i.sab_dac_factor, np.max(i.phase0_0_vmod_sab * i.factor_adc_mV)*0.4, '$I_{cmax}$ \n %.1f $\mu$A' %(i.dac_ic_max*i.sab_dac_factor), \
-                    ha='center', va='center', color = 'blue', backgroundcolor='w',fontsize=10)
-            ax1.text((i.dac_sweep_array[-1]*i.sab_dac_factor)*.95, np.max(i.phase0_0_vmod_sab*i.factor_adc_mV)*0.93, \
-                    '$V_{mod}$\n %.1f mV' %np.max(i.phase0_0_vmod_sab*i.factor_adc_mV), ha='center', va='center', color='blue', backgroundcolor ='w', fontsize=10)
-
-            # plot 2: V_ssa_min and V_ssa_max [mV] vs SA bias [uA]
-            ax2.plot((i.dac_sweep_array * i.sab_dac_factor), (i.phase0_0_vmod_min * i.factor_adc_mV), label = '$V_{min}$')
-            ax2.plot((i.dac_sweep_array * i.sab_dac_factor), (i.phase0_0_vmod_max * i.factor_adc_mV), label = '$V_{max}$')
-            ax2.set_title('Device Voltage vs Bias Current', fontsize=16)
-            ax2.set_ylabel('SSA Voltage [mV]', fontsize=14)
-            ax2.set_xlabel('I$_{SAFB}$ [$\mu$A]', fontsize=14)
-            ax2.legend()
-            ax2.text(np.max(i.dac_sweep_array*i.sab_dac_factor)*.95, np.max(i.phase0_0_vmod_min*i.factor_adc_mV)*.65, '$V_{min}$', ha='center', va='center', color='black', backgroundcolor='w',fontsize=10)
-            ax2.text(np.max(i.dac_sweep_array*i.sab_dac_factor)*.7, np.max(i.phase0_0_vmod_max*i.factor_adc_mV)*.85, '$V_{max}$', ha='center', va='center', color='black', backgroundcolor='w',fontsize=10)
-
-            if args.pdf_report:
-                pdf.savefig()
-
-        if args.full_report or args.external_report or args.pdf_report or args.fig2:
-            
-            fig2, (ax3, ax4) = plt.subplots(2,1)
-            fig2.set_size_inches(7.5, 10, forward=True)
-            fig2.subplots_adjust(hspace=0.35)
-            fig2.suptitle('Figure 2: device ' + i.chip_id, fontsize=14, fontweight='bold')
-            # plot 3: Vssa [mV] vs Iin [uA], Min marked on this plot
-            ax3.plot((i.phase1_0_triangle * Min_scale_factor), (i.phase1_0_icmax_vphi * i.factor_adc_mV))
-            ax3.set_title('Device Voltage vs Input Current at at I$_{cmax}$', fontsize=16)
-            ax3.set_ylabel('Device Voltage [mV]', fontsize=14)
-            ax3.set_xlabel('SAIN Current [$\mu$A]', fontsize=14)
-            sain_xlim = int(np.max(i.phase1_0_triangle * Min_scale_factor)) + 1
-            ax3.set_xlim(0, sain_xlim)
-            ax3.set_ylim((np.min(i.phase1_0_icmax_vphi*i.factor_adc_mV))-1, np.max(i.phase1_0_icmax_vphi*i.factor_adc_mV)+1)
-            ax3.axvline(x=i.Min_end, ymin=0, ymax=1, lw=0.5)
-            ax3.axvline(x=i.Min_start, ymin=0, ymax=1, lw=0.5)
-            ax3.axhline(y=np.max(i.phase1_0_icmax_vphi * i.factor_adc_mV)*.75, xmin=(1.0/sain_xlim)*i.Min_start, xmax=(1.0/sain_xlim)*i.Min_end, lw=0.5)
-            ax3.axhline(y=np.min(i.phase1_0_icmax_vphi * i.factor_adc_mV), xmin=0, xmax=1, lw=0.5)
-            ax3.axhline(y=np.max(i.phase1_0_icmax_vphi * i.factor_adc_mV), xmin=0, xmax=1, lw=0.5)
-            ax3.text((i.Min_start+i.Min_end)/2, np.max(i.phase1_0_icmax_vphi * i.factor_adc_mV)*0.75, '$M_{in}$ = %.1f pH' %i.M_in,\
-                    ha='center', va='center', color='black', backgroundcolor='w', fontsize=10)
-            ax3.text(i.Min_end, np.max(i.phase1_0_icmax_vphi * i.factor_adc_mV)*0.15, '%.1f' %i.Min_end, \
-                    ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
-            ax3.text(i.Min_start, np.max(i.phase1_0_icmax_vphi * i.factor_adc_mV)*0.15, '%.1f' %i.Min_start, \
-                    ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
-            ax3.text(sain_xlim*0.95, np.max(i.phase1_0_icmax_vphi * i.factor_adc_mV), '%.1f' %np.max(i.phase1_0_icmax_vphi * i.factor_adc_mV), \
-                    ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
-            ax3.text(sain_xlim*0.95, np.min(i.phase1_0_icmax_vphi * i.factor_adc_mV), '%.1f' %np.min(i.phase1_0_icmax_vphi * i.factor_adc_mV), \
-                    ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
-
-            # derivative of Vssa vs Isain 
-            ax4.plot((i.phase1_0_triangle[5:int(0.5*len(i.phase1_0_triangle)-5)])*Min_scale_factor, dVdI_in_smooth[5:-5])
-            ax4.set_title('SA Input Gain vs SA Input Current at I$_{cmax}$', fontsize=16)
-            ax4.set_ylabel('dV$_{dev}$/dI$_{SAIN}$ [$\mu$V/$\mu$A]', fontsize=14)
-            ax4.set_xlabel('SAIN Current [$\mu$A]', fontsize=14)
-            ax4.set_xlim(0, sain_xlim)
-            ax4.axhline(y=np.max(dVdI_in_smooth[5:-5]), xmin=0, xmax=1, lw=0.5)
-            ax4.axhline(y=np.min(dVdI_in_smooth[5:-5]), xmin=0, xmax=1, lw=0.5)
-            ax4.text(sain_xlim*0.95, np.min(dVdI_in_smooth[5:-5]), '%.1f' %np.min(dVdI_in_smooth[5:-5]), \
-                    ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
-            ax4.text(sain_xlim*0.95, np.max(dVdI_in_smooth[5:-5]), '%.1f' %np.max(dVdI_in_smooth[5:-5]), \
-                    ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
-
-            if args.pdf_report:
-                pdf.savefig()     
-
-        if args.full_report or args.external_report or args.pdf_report or args.fig3:    
-            # plot 5: Vssa [mV] vs Ifab [uA], Mfb marked on this plot
-            fig3, (ax5, ax6) = plt.subplots(2,1)
-            fig3.set_size_inches(7.5, 10, forward=True)
-            fig3.subplots_adjust(hspace=0.35)
-            fig3.suptitle('Figure 3: device ' + i.chip_id, fontsize=14, fontweight='bold')
-            ax5.plot((i.phase0_1_triangle * Mfb_scale_factor), (i.phase0_1_icmax_vphi * i.factor_adc_mV))
-            ax5.set_title('Device Voltage vs Feedback Current at I$_{cmax}$', fontsize=16)
-            ax5.set_ylabel('Device Voltage [mV]', fontsize=14)
-            ax5.set_xlabel('SAFB Current [$\mu$A]', fontsize=14)
-            safb_xlim = int(np.max(i.phase0_1_triangle * Mfb_scale_factor)) + 1
-            ax5.set_xlim(0, safb_xlim)
-            ax5.set_ylim((np.min(i.phase0_1_icmax_vphi*i.factor_adc_mV))-1, np.max(i.phase0_1_icmax_vphi*i.factor_adc_mV)+1)
-            ax5.axvline(x=i.Mfb_end, ymin=0, ymax=1, lw=0.5)
-            ax5.axvline(x=i.Mfb_start, ymin=0, ymax=1, lw=0.5)
-            ax5.axhline(y=np.max(i.phase0_1_icmax_vphi * i.factor_adc_mV)*.75, xmin=(1.0/safb_xlim)*i.Mfb_start, xmax=(1.0/safb_xlim)*i.Mfb_end, lw=0.5)
-            ax5.axhline(y=np.min(i.phase0_1_icmax_vphi * i.factor_adc_mV), xmin=0, xmax=1, lw=0.5)
-            ax5.axhline(y=np.max(i.phase0_1_icmax_vphi * i.factor_adc_mV), xmin=0, xmax=1, lw=0.5)
-            ax5.text((i.Mfb_start+i.Mfb_end)/2, np.max(i.phase0_1_icmax_vphi * i.factor_adc_mV)*0.75, '$M_{fb}$ = %.1f pH' %i.M_fb, \
-                    ha='center', va='center', color='black', backgroundcolor='w', fontsize=10)
-            ax5.text(i.Mfb_end, np.max(i.phase0_1_icmax_vphi * i.factor_adc_mV)*0.15, '%.1f' %i.Mfb_end, \
-                    ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
-            ax5.text(i.Mfb_start, np.max(i.phase0_1_icmax_vphi * i.factor_adc_mV)*0.15, '%.1f' %i.Mfb_start, \
-                    ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
-            ax5.text(safb_xlim*0.95, np.min(i.phase0_1_icmax_vphi * i.factor_adc_mV), '%.1f' %np.min(i.phase0_1_icmax_vphi * i.factor_adc_mV), \
-                    ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
-            ax5.text(safb_xlim*0.95, np.max(i.phase0_1_icmax_vphi * i.factor_adc_mV), '%.1f' %np.max(i.phase0_1_icmax_vphi * i.factor_adc_mV), \
-                    ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
-
-            #derivative of Vssa vs Isafb plot
-            ax6.plot((i.phase0_1_triangle[5:int(0.5*len(i.phase0_1_triangle))-5])*Mfb_scale_factor, dVdI_fb_smooth[5:-5])
-            ax6.set_title('Feedback Gain vs Feedback Current at I$_{cmax}$', fontsize=16)
-            ax6.set_ylabel('dV$_{dev}$/dI$_{SAFB}$ [$\mu$V/$\mu$A]', fontsize=14)
-            ax6.set_xlabel('SAFB Current [$\mu$A]', fontsize=14)
-            ax6.set_xlim(0, safb_xlim)
-            ax6.axhline(y=np.max(dVdI_fb_smooth[5:-5]), xmin=0, xmax=1, lw=0.5)
-            ax6.axhline(y=np.min(dVdI_fb_smooth[5:-5]), xmin=0, xmax=1, lw=0.5)
-            ax6.text(safb_xlim*0.95, np.min(dVdI_fb_smooth[5:-5]), '%.1f' %np.min(dVdI_fb_smooth[5:-5]), \
-                    ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
-            ax6.text(safb_xlim*0.95, np.max(dVdI_fb_smooth[5:-5]), '%.1f' %np.max(dVdI_fb_smooth[5:-5]), \
-                    ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
-
-            if args.pdf_report:
-                pdf.savefig()        
-
-        if args.full_report or args.external_report or args.pdf_report or args.fig4:
-            
-            fig4, (ax7, ax8) = plt.subplots(2,1)
-            fig4.set_size_inches(7.5, 10, forward=True)
-            fig4.subplots_adjust(hspace=0.35)
-            fig4.suptitle('Figure 4: device ' + i.chip_id, fontsize=14, fontweight='bold')
-            # plot 7: dVssa/dIsab vs Isab
-            #TODO: Ask carl about this title - not sure we should call this dynamic resistance when we have that later? Im confused.
-            ax7.plot(i.dac_sweep_array[5:-7]*i.sab_dac_factor, dVmodmax_dIsafb_smooth[5:-7], label = 'dV$_{max}$/dI$_{SAB}$')
-            ax7.plot(i.dac_sweep_array[5:-7]*i.sab_dac_factor, dVmodmin_dIsafb_smooth[5:-7], label = 'dV$_{min}$/dI$_{SAB}$')            
-            ax7.set_title('Dynamic Resistance vs Bias Current', fontsize=16)
-            ax7.set_ylabel('dV$_{SSA}$/dI$_{SAB}$ [$\mu$V/$\mu$A]', fontsize=14)
-            ax7.set_xlabel('I$_{SAFB}$ [$\mu$A]', fontsize=14)
-            ax7.legend()
-            asymptote_max = np.mean(dVmodmax_dIsafb[-20:-5])
-            asymptote_min = np.mean(dVmodmin_dIsafb[-12:-5])
-            baseline = np.mean([np.mean(dVmodmax_dIsafb[20:60]), np.mean(dVmodmin_dIsafb[20:60])])
-            ax7.axhline(y=asymptote_max, xmin=0, xmax=1, lw=0.5, ls='--', color='k')
-            ax7.axhline(y=asymptote_min, xmin=0, xmax=1, lw=0.5, ls = '--', color='k')
-            ax7.axhline(y=baseline, xmin=0, xmax=1, lw=0.5, ls = '--', color='k')
-            ax7.text(i.dac_sweep_array[-1]*i.sab_dac_factor, asymptote_max*.8, '%.1f Ohms' %asymptote_max, \
-                    ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
-            ax7.text(i.dac_sweep_array[-1]*i.sab_dac_factor, asymptote_min*1.1, '%.1f Ohms' %asymptote_min, \
-                    ha='center', va='center',color='blue',backgroundcolor='w',fontsize=8)
-            ax7.text(i.dac_sweep_array[10]*i.sab_dac_factor, baseline*10, '%.1f Ohms' %baseline, \
-                    ha='center', va='center',color='blue',fontsize=8)          
-            # plot 8: Device Transimpedance vs Device Volgtage
-            ax8.plot(i.phase1_0_icmax_vphi[0:int(0.5*len(i.phase1_0_triangle))]*i.factor_adc_mV, dVdI_in_smooth)
-            ax8.set_title('Device Transimpedance vs Device Voltage', fontsize=16)
-            ax8.set_xlabel('V$_{SSA}$ input [mV]', fontsize=14)
-            ax8.set_ylabel('dV$_{SSA}$/dI$_{in}$ [$\mu$V/$\mu$A]', fontsize=14)
-
-            if args.pdf_report:
-                pdf.savefig()
-        if args.full_report or args.external_report or args.pdf_report or args.fig5:
-            
-            fig5, (ax9, ax10, ax11) = plt.subplots(3,1, gridspec_kw={'height_ratios': [10, 10, 1]})
-            fig5.set_size_inches(7.5, 10, forward=True)
-            fig5.subplots_adjust(hspace=0.45)
-            fig5.suptitle('Figure 5: device ' + i.chip_id, fontsize=14, fontweight='bold')
-            # plot 9: Dynamic Resistance vs Current
-            #rdyn is repeating twice, plot half to get cleaner data
-            ax9.plot(i.phase0_1_triangle[0:int(0.5*len(rdyn))]*Mfb_scale_factor, rdyn_smooth[0:int(0.5*len(rdyn))])
-            ax9.set_title('Dynamic Resistence vs Current', fontsize=16)
-            ax9.set_xlabel('I$_{SAFB}$ [$\mu$A]', fontsize=14)
-            ax9.set_ylabel('Resistance [$\Omega$]', fontsize=14)
-            # plot 10: Dynamic Resistance vs Voltage
-            #circles over itself 4 times within the range, plot only 1/4 to get cleaner plot
-            ax10.plot(i.phase0_1_icmax_vphi[0:int(0.25*len(rdyn))]*i.factor_adc_mV, rdyn_smooth[0:int(0.25*len(rdyn))])
-            ax10.set_title('Dynamic Resistance vs Voltage', fontsize=16)
-            ax10.set_xlabel('V$_{SSA}$ feedback [mV]', fontsize=14)
-            ax10.set_ylabel('Resistance [$\Omega$]', fontsize=14)
-            #table of values for the chip - turn off axes and frame then make the table
-            ax11.set_frame_on(False)
-            ax11.set_xticks([])
-            ax11.set_yticks([])
-            info_table = [i.system_name, i.qa_name, i.SSA_type, i.chip_flavor, i.timestamp]
-            info_labels = ['QA System', 'User', 'SSA Type', 'Chip Flavor', 'Data Timestamp']
-            table = ax11.table(cellText=[info_table], colLabels=info_labels, loc='upper left', cellLoc='center', colColours=['lightgray']*7, fontsize=20)
-            table.auto_set_font_size(False)
-            table.set_fontsize(9)
-            ax11.set_title('\n'+'\n'+'\n'+ i.chip_id + ': Testing Setup & Device Information', fontsize=16)
-            #
-            if args.pdf_report:
-                pdf.savefig()
-        #
-        if args.pdf_report:
-            pdf.close()
 
-    if not args.pdf_report:
+    # Reports are named from the file name and the time this run started, the workers are handed their names
+    report_names = [name + '_' + str(now) + '.pdf' for name in fname_arr]
+
+    start = time.perf_counter()
+    results = []
+    data = []
+    if(jobs > 1 and len(fnames) > 1):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_worker if(plotting) else None) as executor:
+            futures = [executor.submit(process_file, fname, report_name, args) for fname, report_name in zip(fnames, report_names)]
+            # Printed in file order as each chip finishes, whatever order the workers finish in
+            for fname, future in zip(fnames, futures):
+                try:
+                    result = future.result()
+                except Exception:
+                    # The worker itself died, e.g. out of memory, rather than the processing raising
+                    result = ChipResult(fname, None, None, None, '', traceback.format_exc(), 0.0, False)
+                print_result(result)
+                results.append(result)
+    else:
+        if(plotting and args.pdf_report):
+            init_worker()
+        for fname, report_name in zip(fnames, report_names):
+            result, d = run_file(fname, report_name, args)
+            print_result(result)
+            results.append(result)
+            data.append(d)
+    elapsed = time.perf_counter() - start
+
+    failed = [r for r in results if r.error is not None]
+    print('\nProcessed {} chips in {:.1f} s with {} job(s), {:.2f} chips/s'.format(
+        len(results), elapsed, jobs, len(results) / max(elapsed, 1e-9)))
+    if(args.cache_dir is not None):
+        print('{} of them from the cache in {}'.format(len([r for r in results if r.cached]), args.cache_dir))
+    if(failed):
+        print('{} failed: '.format(len(failed)) + ', '.join([r.fname for r in failed]))
+    if(args.metrics_file is not None):
+        rows = [dict(r.metrics, source_file=r.fname) for r in results if r.metrics is not None]
+        print('Wrote the values of {} chips to {}'.format(len(rows), write_metrics(rows, args.metrics_file)))
+
+    if plotting and not args.pdf_report:
+        import matplotlib.pyplot as plt
         plt.show()
     if args.interactive:
+        import IPython
         IPython.start_ipython(argv=[], user_ns=locals())
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
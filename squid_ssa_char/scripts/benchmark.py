@@ -0,0 +1,295 @@
+#################################################################################
+#
+# Written by: Johnathon Gard, Erin Maloney
+# Purpose: Benchmarks for the host side of the SSA screening code
+#
+# Times the numerical hot paths of the data collection against the original
+# looping implementations so that speed ups (and regressions) can be checked
+# without the rack or DASTARD running. Each benchmark prints the time per call
+# of the reference and the current implementation and checks that they agree.
+#
+#################################################################################
+
+# System Level Imports
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import timeit
+import numpy as np
+
+# Installed Package Imports
+import yaml
+
+# Local Imports
+from squid_ssa_char.modules import daq
+
+CONF_DIR = os.path.join(os.path.dirname(__file__), '..', 'conf_files')
+
+
+def reference_average_data(data, points_per_slice):
+    '''
+    The original slice loop from Daq.take_average_data(), kept as the benchmark reference
+    '''
+    ncol, nrow = data.shape[0], data.shape[1]
+    slices = np.int_(data.shape[2] / points_per_slice)
+    start = 0
+    end = start + points_per_slice
+
+    i = 0
+    fb = np.zeros((ncol, nrow, points_per_slice))
+    err = np.zeros((ncol, nrow, points_per_slice))
+
+    while i != slices:
+        for col in range(ncol):
+            fb[col] += data[col, :, start:end, 1]
+            err[col] += data[col, :, start:end, 0]
+        start += points_per_slice
+        end += points_per_slice
+        i += 1
+
+    return fb / slices, err / slices
+
+
+def reference_align(data):
+    '''
+    The original per trace roll loop from Daq.take_data_roll(), kept as the benchmark reference
+    '''
+    fb = np.array(data[:, :, :, 1])
+    err = np.array(data[:, :, :, 0])
+    for i in range(fb.shape[0]):
+        for j in range(fb.shape[1]):
+            if(np.all(fb[i,j,:] == fb[i,j,0])):
+                raise daq.Daq.FeedBackException("FB value is constant. C={}, R={}".format(i, j))
+            nsamp_roll = -fb[i, j, :].argmin()
+            fb[i, j, :] = np.roll(fb[i, j, :], nsamp_roll)
+            err[i, j, :] = np.roll(err[i, j, :], nsamp_roll)
+    return fb, err
+
+
+def fake_daq_buffer(ncol, nrow, npts, rng):
+    '''
+    Build a (ncol, nrow, npts, 2) int32 buffer that looks like DASTARD output, 14 bit counts
+    '''
+    return rng.integers(-2**13, 2**13, size=(ncol, nrow, npts, 2), dtype=np.int32)
+
+
+def report(name, t_ref, t_new, ncalls):
+    print("{:<24s} reference {:9.3f} ms | current {:9.3f} ms | speed up {:6.1f}x".format(
+        name, 1e3 * t_ref / ncalls, 1e3 * t_new / ncalls, t_ref / t_new))
+
+
+def bench_averaging(args, rng):
+    data = fake_daq_buffer(args.ncol, args.nrow, args.npts * args.n_avg, rng)
+
+    fb_ref, err_ref = reference_average_data(data, args.npts)
+    avg = daq.average_slices(data, args.npts)
+    assert np.allclose(fb_ref, avg[..., 1]) and np.allclose(err_ref, avg[..., 0])
+
+    t_ref = timeit.timeit(lambda: reference_average_data(data, args.npts), number=args.ncalls)
+    t_new = timeit.timeit(lambda: daq.average_slices(data, args.npts), number=args.ncalls)
+    report('take_average_data', t_ref, t_new, args.ncalls)
+
+
+def bench_alignment(args, rng):
+    data = fake_daq_buffer(args.ncol, args.nrow, args.npts, rng)
+    out = np.empty(data.shape, dtype=data.dtype)
+    index = np.empty(data.shape[:-1], dtype=np.intp)
+
+    fb_ref, err_ref = reference_align(data)
+    fb, err = daq.align_to_fb_min(data, out, index)
+    assert np.array_equal(fb_ref, fb) and np.array_equal(err_ref, err)
+
+    t_ref = timeit.timeit(lambda: reference_align(data), number=args.ncalls)
+    t_new = timeit.timeit(lambda: daq.align_to_fb_min(data, out, index), number=args.ncalls)
+    report('take_data_roll', t_ref, t_new, args.ncalls)
+
+
+def write_sim_configs(out_dir, args):
+    '''
+    Copy the packaged configs into out_dir switched over to the simulator and sized from args
+    '''
+    with open(os.path.join(CONF_DIR, 'system_config.yaml'), 'r') as f:
+        sys_conf = yaml.safe_load(f)
+    with open(os.path.join(CONF_DIR, 'ssa_test_config.yaml'), 'r') as f:
+        test_conf = yaml.safe_load(f)
+
+    sys_conf['system']['tower_type'] = 'SIM'
+    sys_conf['system']['daq_type'] = 'SIM'
+    test_conf['test_globals']['columns'] = list(range(args.ncol))
+    test_conf['test_globals']['n_rows'] = args.nrow
+    test_conf['phase0_0']['bias_sweep_npoints'] = args.npoints
+    if(args.sweep_type is not None):
+        test_conf['phase0_0']['bias_sweep_type'] = args.sweep_type
+    if(args.settle_mode is not None):
+        test_conf['test_globals']['settle_mode'] = args.settle_mode
+    if(args.pipeline):
+        test_conf['phase0_0']['pipeline'] = True
+    if(args.early_stop):
+        test_conf['phase0_0']['early_stop'] = True
+    # The info lists need an entry for every simulated column, and a chip id for every row in per row mode
+    info = test_conf['info']
+    info['chip_ids'] = ['sim_c{:02d}'.format(col) for col in range(args.ncol)]
+    info['chip_flavor'] = [info['chip_flavor'][0]] * args.ncol
+    info['SSA_type'] = [info['SSA_type'][0]] * args.ncol
+    if(args.per_row):
+        test_conf['test_globals']['per_row'] = True
+        info['chip_ids'] = [[chip_id + '_r{:02d}'.format(row) for row in range(args.nrow)] for chip_id in info['chip_ids']]
+    test_conf['phase0_0']['stream_dir'] = out_dir
+    test_conf['test_globals']['trace_dir'] = out_dir
+    for section in ('test_globals', 'phase0_0', 'phase0_1', 'phase1_0'):
+        if(section != 'test_globals'):
+            test_conf[section]['n_avg'] = args.n_avg
+        if(args.wait_ms is not None):
+            test_conf[section]['bias_change_wait_ms'] = args.wait_ms
+
+    sys_path = os.path.join(out_dir, 'system_config.yaml')
+    test_path = os.path.join(out_dir, 'ssa_test_config.yaml')
+    with open(sys_path, 'w') as f:
+        yaml.safe_dump(sys_conf, f)
+    with open(test_path, 'w') as f:
+        yaml.safe_dump(test_conf, f)
+    return sys_path, test_path
+
+
+def bench_phases(args, rng):
+    # Imported here, the collection script pulls in a lot more than the other benchmarks need
+    from squid_ssa_char.scripts import SSA_data_collection
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sys_path, test_path = write_sim_configs(tmp, args)
+        test = SSA_data_collection.SSA(sys_path, test_path, 0)
+
+        total = 0.0
+        for phase in ('phase0_0', 'phase0_1', 'phase1_0'):
+            writes = test.sim_rack.n_writes
+            start = time.perf_counter()
+            getattr(test, phase)()
+            elapsed = time.perf_counter() - start
+            total += elapsed
+            print("{:<24s} {:9.3f} s | {:7d} serial writes".format(phase, elapsed, test.sim_rack.n_writes - writes))
+        print("{:<24s} {:9.3f} s | {:9.2f} sweep points/s".format('total', total, args.npoints / total))
+
+    # Let scripted runs catch throughput regressions
+    if(args.max_seconds is not None and total > args.max_seconds):
+        print('FAIL: phases took {:.3f} s, limit is {:.3f} s'.format(total, args.max_seconds))
+        sys.exit(1)
+
+
+def bench_loading(args, rng):
+    # Scanning the scalar results of many chips, whole pickles against lazily loaded columnar files
+    from squid_ssa_char.modules import ssa_data_class
+
+    with tempfile.TemporaryDirectory() as tmp:
+        names = []
+        for i in range(args.nfiles):
+            data = ssa_data_class.SSA_Data_Class()
+            data.file_name = os.path.join(tmp, 'chip{:03d}'.format(i))
+            data.dac_ic_max = int(rng.integers(0, 40000))
+            data.phase0_0_vphis = rng.standard_normal((args.npoints, args.npts))
+            data.save(True, 'pickle')
+            data.save(True, 'columnar')
+            names.append(data.file_name)
+
+        def scan(suffix, lazy):
+            return [ssa_data_class.SSA_Data_Class.load(name + suffix, lazy=lazy).dac_ic_max for name in names]
+
+        assert scan('.pickle', False) == scan('.ssa', True)
+        t_ref = timeit.timeit(lambda: scan('.pickle', False), number=1)
+        t_new = timeit.timeit(lambda: scan('.ssa', True), number=1)
+        report('load dac_ic_max', t_ref, t_new, args.nfiles)
+
+
+# Modules the entry points only need for one feature, importing any of them at startup is a regression
+HEAVY_MODULES = ('IPython', 'matplotlib', 'scipy')
+ENTRY_MODULES = ('squid_ssa_char.scripts.SSA_data_collection', 'squid_ssa_char.scripts.SSA_data_processing',
+                 'squid_ssa_char.scripts.config_check', 'squid_ssa_char.scripts.convert_pickles',
+                 'squid_ssa_char.modules.load_conf_yaml')
+
+
+def import_time(module):
+    '''
+    Imports module in a fresh interpreter with -X importtime. Returns (cumulative import time in s, the heavy
+    modules that got imported along with it)
+    '''
+    code = 'import sys, json, {}; print(json.dumps([m for m in {!r} if m in sys.modules]))'.format(module, HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, check=True)
+    cumulative = 0
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if(len(fields) == 3 and fields[2].strip() == module):
+            cumulative = int(fields[1])
+    return cumulative / 1e6, json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def bench_imports(args, rng):
+    # Startup cost of each entry point, and a check that the heavy optional imports stay lazy
+    failed = False
+    for module in ENTRY_MODULES:
+        seconds, heavy = import_time(module)
+        print("import {:<42s} {:9.1f} ms | heavy modules loaded: {}".format(module, seconds * 1000.0, ', '.join(heavy) or 'none'))
+        if(heavy or (args.max_import_ms is not None and seconds * 1000.0 > args.max_import_ms)):
+            failed = True
+    if(failed):
+        print('FAIL: an entry point imports {} at startup or is over --max_import_ms'.format(' / '.join(HEAVY_MODULES)))
+        sys.exit(1)
+
+
+BENCHMARKS = {
+    'averaging': bench_averaging,
+    'alignment': bench_alignment,
+    'phases': bench_phases,
+    'loading': bench_loading,
+    'imports': bench_imports,
+}
+
+HELP_TEXT = '''\
+Run the host side benchmarks. With no benchmark names given, all of them are run.
+The default sizes match a full 8 column system with the phase0_0 triangle.
+The phases benchmark runs phase0_0, phase0_1 and phase1_0 end to end against the
+simulated tower and DAQ, using the packaged configs switched over to SIM.
+The loading benchmark reads one scalar from each of nfiles saved chips.
+The imports benchmark times importing each entry point in a fresh interpreter and
+fails if IPython, matplotlib or scipy get imported at startup.
+'''
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='benchmark',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=textwrap.dedent(HELP_TEXT))
+    parser.add_argument('benchmarks',
+                        nargs='*',
+                        help='Benchmarks to run: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--ncol', type=int, default=8, help='Number of columns in the fake buffer')
+    parser.add_argument('--nrow', type=int, default=4, help='Number of rows in the fake buffer')
+    parser.add_argument('--npts', type=int, default=8192, help='Points per triangle period')
+    parser.add_argument('--n_avg', type=int, default=4, help='Number of periods to average')
+    parser.add_argument('--ncalls', type=int, default=20, help='Number of calls to time')
+    parser.add_argument('--npoints', type=int, default=256, help='phases, loading: Number of phase0_0 bias sweep points')
+    parser.add_argument('--nfiles', type=int, default=20, help='loading: Number of chip files to scan')
+    parser.add_argument('--wait_ms', type=float, default=None, help='phases: Override every bias_change_wait_ms')
+    parser.add_argument('--sweep_type', choices=['linear', 'coarse_fine', 'binary_search'], default=None, help='phases: Override bias_sweep_type')
+    parser.add_argument('--settle_mode', choices=['fixed', 'adaptive'], default=None, help='phases: Override settle_mode')
+    parser.add_argument('--pipeline', action='store_true', help='phases: Process the phase0_0 points on a worker thread')
+    parser.add_argument('--early_stop', action='store_true', help='phases: Stop the phase0_0 sweep once both Ics are found')
+    parser.add_argument('--per_row', action='store_true', help='phases: Characterize every row as its own device')
+    parser.add_argument('--max_seconds', type=float, default=None, help='phases: Exit with an error if the phases take longer')
+    parser.add_argument('--max_import_ms', type=float, default=None, help='imports: Exit with an error if an import takes longer')
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if(name not in BENCHMARKS):
+            parser.error('unknown benchmark {}, choose from: {}'.format(name, ', '.join(BENCHMARKS)))
+
+    rng = np.random.default_rng(0)
+    for name in (args.benchmarks or BENCHMARKS):
+        BENCHMARKS[name](args, rng)
+
+if (__name__ == '__main__'):
+    main()
@@ -22,12 +22,11 @@ import glob
 import sys
 import argparse
 import textwrap
-import IPython
 
 # Installed package imports
-import yaml
 
 # Local imports
+from squid_ssa_char.modules import load_conf_yaml
 
 
 # In the future I envision the ability to have a prescedance level
@@ -131,28 +130,21 @@ if (__name__ == '__main__'):
 
     
     #####################################
-    # Here we go, let us load up the yaml
-    with open(sys_file_path, 'r') as file:
-        try:
-            sys_config = yaml.safe_load(file)
-        except yaml.YAMLError as exc:
-            print(exc)
-        
-    with open(config_file_path, 'r') as file:
-        try:
-            test_config = yaml.safe_load(file)
-        except yaml.YAMLError as exc:
-            print(exc)
+    # Here we go, let us load up the yaml, a ConfigError lists everything wrong with a file
+    sys_config = load_conf_yaml.load_config(sys_file_path, 'system')
+    test_config = load_conf_yaml.load_config(config_file_path, 'test')
+    print('Both configs loaded and have the sections and values the scripts need')
 
         
     # If the argument for interactive was passed, drop into embeded IPython
     if(args.interactive):
+        import IPython  # Only loaded when it is used, it is slow to import
         IPython.embed()
 
     sys_num_col = len(sys_config['col_map'])
 
     # first check the number of columns list and verify it is valid
-    test_num_columns = len(test_config['test_globals']['column'])
+    test_num_columns = len(test_config['test_globals']['columns'])
     # TODO: check that there are 8 or less numbers
     # TODO: Check the elements for numbers greater than 7
     # TODO: check that the number of elements in the col_map is the same or more
@@ -0,0 +1,63 @@
+#################################################################################
+#
+# Written by: Johnathon Gard, Erin Maloney
+# Purpose: Convert SSA_Data_Class pickles to the columnar .ssa format
+#
+# Each <name>.pickle is loaded and written back out as a <name>.ssa directory,
+# next to the pickle or in the given output directory. The pickles are left
+# in place.
+#
+#################################################################################
+
+# System Level Imports
+import argparse
+import glob
+import os
+import textwrap
+
+# Local Imports
+from squid_ssa_char.modules import ssa_data_class
+
+HELP_TEXT = '''\
+Convert SSA data pickles to columnar .ssa directories that can be loaded lazily.
+Patterns are expanded with glob, quote them to keep the shell from doing it.
+'''
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='convert_pickles',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=textwrap.dedent(HELP_TEXT))
+    parser.add_argument('files',
+                        nargs='+',
+                        help='Pickle files or glob patterns to convert')
+    parser.add_argument('-o', '--out_dir',
+                        default=None,
+                        help='Directory to write the .ssa directories to, default is next to each pickle')
+    parser.add_argument('-f', '--force',
+                        action='store_true',
+                        help='Convert again even if the .ssa directory already exists')
+    args = parser.parse_args()
+
+    fnames = sorted(set(name for pattern in args.files for name in glob.glob(pattern)))
+    if(len(fnames) == 0):
+        print('No files matched: ' + ' '.join(args.files))
+
+    for fname in fnames:
+        base = os.path.splitext(os.path.basename(fname))[0]
+        out_dir = args.out_dir if(args.out_dir is not None) else os.path.dirname(fname)
+        path = os.path.join(out_dir, base + ssa_data_class.COLUMNAR_SUFFIX)
+        if(os.path.exists(path) and not args.force):
+            print('{} exists, skipping'.format(path))
+            continue
+        data = ssa_data_class.SSA_Data_Class.load(fname)
+        data.save_columnar(path)
+        print('{} -> {} ({:.1f} MB -> {:.1f} MB)'.format(fname, path, os.path.getsize(fname) / 1e6, dir_size(path) / 1e6))
+
+if (__name__ == '__main__'):
+    main()